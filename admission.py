@@ -0,0 +1,238 @@
+"""
+Admission control for requests that call the LLM.
+
+Routes run two checks (`admit`) once they know a request will reach the LLM, so cached
+answers and queued background jobs cost nothing:
+
+- a token bucket per user (`TokenBucketLimiter`), so one user cannot take the whole LLM
+  quota; excess calls get `RateLimited` (429)
+- a global limit on LLM calls running at once, with a short bounded queue in front of it
+  (`AdmissionController`); calls that find the queue full, or wait in it too long, get
+  `Overloaded` (503) instead of piling up until they time out
+
+Both raise straight away with a `retry_after` in seconds. Limits are per worker process.
+"""
+import asyncio
+import math
+import time
+import weakref
+from collections import OrderedDict, deque
+from typing import Any, Dict, Optional
+
+from quart import Response
+from quart.wrappers.response import IterableBody
+
+from metrics import registry
+
+llm_admission_rejections = registry.counter(
+    "llm_admission_rejections_total", "LLM route calls refused by admission control.", ["reason"]
+)
+
+
+class RateLimited(Exception):
+    """Raised when a user has used up their request allowance; `retry_after` is in seconds."""
+    def __init__(self, retry_after: float):
+        super().__init__(f"Too many requests, retry in {math.ceil(retry_after)} seconds.")
+        self.retry_after = retry_after
+
+
+class Overloaded(Exception):
+    """Raised when too many calls are running and queued; `retry_after` is in seconds."""
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucketLimiter:
+    """
+    Token bucket per key (a user id).
+
+    Each key holds up to `burst` tokens and regains `rate` tokens per second; a call spends
+    one. At most `max_keys` keys are tracked, least recently used first out, which only ever
+    hands a forgotten key a full bucket.
+    """
+    def __init__(self, rate: float, burst: int, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict = OrderedDict()  # key -> (tokens, updated)
+        self.counters = {"allowed": 0, "limited": 0, "refunded": 0}
+
+    def tokens(self, key) -> float:
+        """Tokens `key` has now."""
+        tokens, updated = self._buckets.get(key, (self.burst, None))
+        if updated is None:
+            return float(tokens)
+        return min(self.burst, tokens + (time.monotonic() - updated) * self.rate)
+
+    def take(self, key) -> float:
+        """Spend a token of `key`; returns 0 if it had one, else the seconds until it will."""
+        tokens = self.tokens(key)
+        if tokens < 1:
+            self.counters["limited"] += 1
+            return (1 - tokens) / self.rate
+        self._buckets[key] = (tokens - 1, time.monotonic())
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        self.counters["allowed"] += 1
+        return 0.0
+
+    def refund(self, key):
+        """Give back a token spent by a call that never ran."""
+        self._buckets[key] = (min(self.burst, self.tokens(key) + 1), time.monotonic())
+        self.counters["refunded"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"rate_per_second": self.rate, "burst": self.burst, "tracked_keys": len(self._buckets), **self.counters}
+
+
+class Slot:
+    """Permission to run one call; `release` it exactly once when the call is over (repeat calls are ignored)."""
+    def __init__(self, controller: "AdmissionController"):
+        self.controller = controller
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(time.monotonic() - self.started)
+
+
+class AdmissionController:
+    """
+    Runs at most `max_in_flight` calls at once; up to `max_queue` more wait, first come first
+    served, for at most `queue_timeout` seconds. Anything beyond that is refused immediately.
+    """
+    def __init__(self, max_in_flight: int = 16, max_queue: int = 32, queue_timeout: float = 10.0,
+                 alpha: float = 0.2):
+        """
+        Args:
+            max_in_flight (int): Calls allowed to run at once.
+            max_queue (int): Calls allowed to wait for a free slot; 0 refuses as soon as all are busy.
+            queue_timeout (float): Seconds a call may wait before it is refused.
+            alpha (float): Weight of the newest call duration in the average used for `Retry-After`.
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.alpha = alpha
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.peak_queued = 0
+        self.average_duration: Optional[float] = None
+        self._waiters: deque = deque()
+        self.counters = {"admitted": 0, "waited": 0, "rejected_queue_full": 0, "rejected_timeout": 0}
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for waiter in self._waiters if not waiter.done())
+
+    def retry_after(self) -> float:
+        """Rough seconds until the current backlog has drained, at least 1."""
+        duration = self.average_duration or 1.0
+        return max(1.0, duration * (self.queued + 1) / self.max_in_flight)
+
+    async def acquire(self) -> Slot:
+        """Wait for a slot, or raise `Overloaded` if the queue is full or the wait times out."""
+        if self.in_flight < self.max_in_flight and not self.queued:
+            return self._admit()
+        if self.queued >= self.max_queue:
+            self.counters["rejected_queue_full"] += 1
+            llm_admission_rejections.inc(reason="queue_full")
+            raise Overloaded("The server is at capacity, try again shortly.", self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.counters["waited"] += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.counters["rejected_timeout"] += 1
+            llm_admission_rejections.inc(reason="queue_timeout")
+            raise Overloaded("Timed out waiting for capacity, try again shortly.", self.retry_after())
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # A slot was handed over just as the caller went away: pass it on
+                self._release(None)
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        # `_release` handed its slot over without decrementing `in_flight`
+        self.counters["admitted"] += 1
+        return Slot(self)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "peak_in_flight": self.peak_in_flight,
+            "peak_queued": self.peak_queued,
+            "average_duration": self.average_duration,
+            **self.counters,
+        }
+
+    def _admit(self) -> Slot:
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        self.counters["admitted"] += 1
+        return Slot(self)
+
+    def _release(self, duration: Optional[float]):
+        if duration is not None:
+            self.average_duration = duration if self.average_duration is None else (
+                self.alpha * duration + (1 - self.alpha) * self.average_duration
+            )
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+class _ReleasingBody(IterableBody):
+    """A streamed response body that releases its admission slot once sent or abandoned."""
+    def __init__(self, iterable, slot: Slot):
+        super().__init__(iterable)
+        self.slot = slot
+        # Backstop for a response that is dropped before its body is ever entered
+        weakref.finalize(self, slot.release)
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        try:
+            await super().__aexit__(exc_type, exc_value, tb)
+        finally:
+            self.slot.release()
+
+
+async def admit(limiter: TokenBucketLimiter, controller: AdmissionController, key) -> Slot:
+    """
+    Spend a token of `key` (a user id) and wait for a slot; raises `RateLimited` or `Overloaded`.
+
+    The token is refunded if no slot is granted, so a call shed for overload costs the user nothing.
+    """
+    wait = limiter.take(key)
+    if wait:
+        llm_admission_rejections.inc(reason="rate_limited")
+        raise RateLimited(wait)
+    try:
+        return await controller.acquire()
+    except (Overloaded, asyncio.CancelledError):
+        limiter.refund(key)
+        raise
+
+
+def release_when_sent(response: Response, slot: Slot) -> Response:
+    """Hold `slot` until a streamed `response` has been sent, or release it now for any other response."""
+    if isinstance(response.response, IterableBody):
+        response.response = _ReleasingBody(response.response.iter, slot)
+    else:
+        slot.release()
+    return response
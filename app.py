@@ -1,24 +1,268 @@
-from quart import Quart, jsonify, request, session
+from quart import Quart, Request, Response, g, jsonify, request, session
 from db_utils import db_manager
-from models import Book, Review
-from auth_manager import AuthManager, require_login
+from models import Book, Review, BookRatingStats
+from migrations import migrate, pending_migrations
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from auth_manager import (
+    AuthManager, PasswordHasher, LoginThrottle, IdentityCache, HasherBusy, LoginThrottled, require_login
+)
+from book_manager import SmartLibrary
+from bulk_import import import_books, CONFLICT_MODES
+import asyncio
 import os
+import json
+import math
+import orjson
 from dotenv import load_dotenv
-from llm_utils import HuggingFaceModel
-import pandas as pd
+from llm_utils import HuggingFaceModel, LLMResponseCache
+from llm_router import LLMRouter, LLMUnavailable
+from recommendation_engine import RecommendationEngine, RecommendationCache
+from similar_books import SimilarBooksIndex
+from admission import AdmissionController, Overloaded, RateLimited, TokenBucketLimiter, admit, release_when_sent
+from metrics import registry, RequestStats, current_request_stats, COUNT_BUCKETS
+import time
 
 load_dotenv()
 
+# Bulk uploads are streamed into the database, so they get their own limits instead of
+# Quart's MAX_CONTENT_LENGTH (16 MB) and BODY_TIMEOUT; 0 removes a limit
+BULK_IMPORT_MAX_BYTES = int(os.getenv('BULK_IMPORT_MAX_BYTES', 2 * 1024 ** 3)) or None
+BULK_IMPORT_IDLE_TIMEOUT = float(os.getenv('BULK_IMPORT_IDLE_TIMEOUT', 300)) or None
+# Reverse proxies in front of the app that append the caller to X-Forwarded-For; 0 ignores the header
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', 0))
+
+
+class LibraryRequest(Request):
+    """Applies the bulk import limits to `POST /books/bulk`; the body is created before routing, so match here."""
+    def __init__(self, method, scheme, path, *args, max_content_length=None, body_timeout=None, **kwargs):
+        if method == 'POST' and path == '/books/bulk':
+            max_content_length = BULK_IMPORT_MAX_BYTES
+            body_timeout = BULK_IMPORT_IDLE_TIMEOUT
+        super().__init__(
+            method, scheme, path, *args, max_content_length=max_content_length, body_timeout=body_timeout, **kwargs
+        )
+
+
 app = Quart(__name__)
-auth_manager = AuthManager(db_manager)  # Initialize AuthManager with db_manager
+app.request_class = LibraryRequest
+auth_manager = AuthManager(
+    db_manager,
+    hasher=PasswordHasher(
+        method=os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1'),
+        workers=int(os.getenv('PASSWORD_HASH_WORKERS', 2)),
+        max_pending=int(os.getenv('PASSWORD_HASH_MAX_PENDING', 32)),
+    ),
+    user_throttle=LoginThrottle(max_failures=int(os.getenv('LOGIN_MAX_FAILURES_PER_USER', 5))),
+    client_throttle=LoginThrottle(max_failures=int(os.getenv('LOGIN_MAX_ATTEMPTS_PER_CLIENT', 50))),
+    registration_throttle=LoginThrottle(max_failures=int(os.getenv('REGISTRATIONS_PER_CLIENT', 20))),
+    identities=IdentityCache(
+        max_size=int(os.getenv('IDENTITY_CACHE_SIZE', 10000)),
+        ttl=float(os.getenv('IDENTITY_CACHE_TTL', 60)),
+    ),
+)
+auth_manager.init_app(app)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'qwe')
-hf_model = HuggingFaceModel(model_name="meta-llama/Llama-3.2-3B-Instruct")
+llm_cache = LLMResponseCache(
+    db_manager,
+    max_size=int(os.getenv('LLM_CACHE_SIZE', 1024)),
+    ttl=float(os.getenv('LLM_CACHE_TTL', 3600)),
+)
+if os.getenv('LLM_BACKENDS'):
+    # Several endpoints: route by latency, hedge slow calls and skip failing backends
+    hf_model = LLMRouter.from_config(
+        json.loads(os.getenv('LLM_BACKENDS')),
+        cache=llm_cache,
+        failure_threshold=int(os.getenv('LLM_BREAKER_FAILURES', 5)),
+        reset_timeout=float(os.getenv('LLM_BREAKER_RESET', 30)),
+        hedge_percentile=float(os.getenv('LLM_HEDGE_PERCENTILE', 0.95)),
+        max_hedges=int(os.getenv('LLM_MAX_HEDGES', 1)),
+    )
+else:
+    hf_model = HuggingFaceModel(model_name="meta-llama/Llama-3.2-3B-Instruct", cache=llm_cache)
+recommender = RecommendationEngine(
+    db_manager, refresh_interval=float(os.getenv('RECOMMENDER_REFRESH_INTERVAL', 300))
+)
+similar_books = SimilarBooksIndex(
+    db_manager,
+    dimensions=int(os.getenv('SIMILAR_BOOKS_DIMENSIONS', 256)),
+    snapshot_path=os.getenv('SIMILAR_BOOKS_SNAPSHOT') or None,
+    refresh_interval=float(os.getenv('SIMILAR_BOOKS_REFRESH_INTERVAL', 600)),
+)
+library = SmartLibrary(
+    db_manager,
+    llm_model=hf_model,
+    workers=int(os.getenv('SUMMARY_WORKERS', 4)),
+    max_attempts=int(os.getenv('SUMMARY_MAX_ATTEMPTS', 3)),
+)
+# Guards the routes that call the LLM; limits are per worker process
+llm_rate_limiter = TokenBucketLimiter(
+    rate=float(os.getenv('LLM_USER_RATE_PER_MINUTE', 30)) / 60,
+    burst=int(os.getenv('LLM_USER_BURST', 10)),
+)
+llm_admission = AdmissionController(
+    max_in_flight=int(os.getenv('LLM_MAX_IN_FLIGHT', 16)),
+    max_queue=int(os.getenv('LLM_MAX_QUEUE', 32)),
+    queue_timeout=float(os.getenv('LLM_QUEUE_TIMEOUT', 10)),
+)
+recommendation_cache = RecommendationCache(
+    max_users=int(os.getenv('RECOMMENDATION_CACHE_USERS', 10000)),
+    stale_while_revalidate=os.getenv('RECOMMENDATION_STALE_WHILE_REVALIDATE', '1') == '1',
+)
+
+_background_tasks = set()
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+BOOK_UPDATE_FIELDS = {'title', 'author', 'genre', 'year_published', 'summary'}
+N_PLUS_ONE_THRESHOLD = int(os.getenv('DB_N_PLUS_ONE_THRESHOLD', 10))
+
+http_request_seconds = registry.histogram(
+    "http_request_duration_seconds", "Time to produce a response (streamed bodies excluded).", ["method", "route", "status"]
+)
+http_request_queries = registry.histogram(
+    "http_request_db_queries", "SQL statements issued per request.", ["route"], buckets=COUNT_BUCKETS
+)
+http_request_db_seconds = registry.histogram(
+    "http_request_db_duration_seconds", "Time spent in SQL statements per request.", ["route"]
+)
 
 
 @app.before_serving
 async def setup():
-    """Initialize database tables before starting the server."""
-    await db_manager.create_tables()
+    """
+    Check the schema and start background work.
+
+    Migrations are an explicit deploy step (`python migrations.py`); set AUTO_MIGRATE=1 to apply
+    them here instead, e.g. for local development. LLM_WARMUP=1 connects to the model provider in
+    the background so that the first summary does not pay for the TLS handshake.
+    """
+    if _flag(os.getenv('AUTO_MIGRATE')):
+        await migrate(db_manager)
+    else:
+        pending = await pending_migrations(db_manager)
+        if pending:
+            raise RuntimeError(
+                f"Database schema is missing migrations {pending}; run `python migrations.py` first."
+            )
+    recommender.start()
+    similar_books.start()
+    library.start()
+    if _flag(os.getenv('LLM_WARMUP')):
+        task = asyncio.create_task(hf_model.warm_up())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+
+@app.after_serving
+async def shutdown():
+    """Stop background work and release pooled LLM and database connections when the server stops."""
+    await recommender.stop()
+    await similar_books.stop()
+    await library.stop()
+    await hf_model.aclose()
+    await auth_manager.hasher.shutdown()
+    await db_manager.engine.dispose()
+
+
+@app.before_request
+async def start_request_metrics():
+    """Start timing the request and collecting the queries it issues."""
+    g.request_started = time.perf_counter()
+    g.request_stats = RequestStats(_route_label(), N_PLUS_ONE_THRESHOLD)
+    g.request_stats_token = current_request_stats.set(g.request_stats)
+
+
+@app.after_request
+async def record_request_metrics(response):
+    """Record latency and per-request query totals once the response is ready."""
+    stats = g.get('request_stats')
+    if stats is None:
+        return response
+    current_request_stats.reset(g.request_stats_token)
+    http_request_seconds.observe(
+        time.perf_counter() - g.request_started, method=request.method, route=stats.route, status=response.status_code
+    )
+    http_request_queries.observe(stats.queries, route=stats.route)
+    http_request_db_seconds.observe(stats.query_seconds, route=stats.route)
+    return response
+
+
+@app.before_request
+async def open_unit_of_work():
+    """Give the request one lazily opened session and transaction."""
+    g.unit_of_work, g.unit_of_work_token = db_manager.begin_unit_of_work()
+
+
+@app.after_request
+async def commit_unit_of_work(response):
+    """Commit the request's writes before the response is sent; error responses roll back."""
+    unit_of_work = g.get('unit_of_work')
+    if unit_of_work is not None:
+        g.unit_of_work = None
+        await db_manager.end_unit_of_work(unit_of_work, g.unit_of_work_token, commit=response.status_code < 400)
+    return response
+
+
+@app.teardown_request
+async def close_unit_of_work(exc):
+    """Roll back and release the session of a request that failed before its response was ready."""
+    unit_of_work = g.get('unit_of_work')
+    if unit_of_work is not None:
+        g.unit_of_work = None
+        await db_manager.end_unit_of_work(unit_of_work, g.unit_of_work_token, commit=False)
+
+
+def _route_label():
+    """The matched URL rule, so that ids do not create one time series per book."""
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _component_gauges():
+    """Scrape-time gauges for the caches and background workers."""
+    cache = llm_cache.stats()
+    yield "llm_cache_memory_hits", "LLM responses served from memory.", cache["memory_hits"]
+    yield "llm_cache_persistent_hits", "LLM responses served from the database cache.", cache["persistent_hits"]
+    yield "llm_cache_misses", "LLM cache lookups that called the model.", cache["misses"]
+    yield "llm_cache_memory_entries", "LLM responses held in memory.", cache["memory_entries"]
+    yield "llm_requests_in_flight", "Distinct LLM generations currently running.", hf_model.single_flight.in_flight()
+    identities = auth_manager.identities.stats()
+    yield "identity_cache_hits", "Signed-in user lookups served from memory.", identities["hits"]
+    yield "identity_cache_misses", "Signed-in user lookups that queried the database.", identities["misses"]
+    yield "llm_admission_in_flight", "LLM route calls running.", llm_admission.in_flight
+    yield "llm_admission_queued", "LLM route calls waiting for a slot.", llm_admission.queued
+    cached = recommendation_cache.stats()
+    yield "recommendation_cache_users", "Users with cached recommendations.", cached["users"]
+    snapshot = recommender.stats()
+    if snapshot.get("built"):
+        yield "recommender_snapshot_age_seconds", "Age of the item-similarity snapshot.", snapshot["age_seconds"]
+        yield "recommender_similarity_entries", "Stored item-item similarities.", snapshot["similarity_entries"]
+    index = similar_books.stats()
+    if index.get("built"):
+        yield "similar_books_indexed", "Books in the similar-books vector index.", index["books"]
+        yield "similar_books_index_age_seconds", "Time since the similar-books index was last rebuilt.", index["age_seconds"]
+
+
+registry.add_collector(_component_gauges)
+
+
+_warned_untrusted_proxy = False
+
+
+def client_address():
+    """The caller's address for throttling: as seen by the outermost trusted proxy, else the peer address."""
+    global _warned_untrusted_proxy
+    if not TRUSTED_PROXY_HOPS and 'X-Forwarded-For' in request.headers and not _warned_untrusted_proxy:
+        _warned_untrusted_proxy = True
+        print(
+            "Requests carry X-Forwarded-For but TRUSTED_PROXY_HOPS is 0: if the app is behind a reverse proxy, "
+            "every client shares the proxy's address for login and registration throttling. Set TRUSTED_PROXY_HOPS."
+        )
+    if TRUSTED_PROXY_HOPS:
+        forwarded = [hop.strip() for hop in request.headers.get('X-Forwarded-For', '').split(',') if hop.strip()]
+        # Entries before the ones our proxies appended are whatever the client chose to send
+        if len(forwarded) >= TRUSTED_PROXY_HOPS:
+            return forwarded[-TRUSTED_PROXY_HOPS]
+    return request.remote_addr
 
 
 @app.route('/register', methods=['POST'])
@@ -34,7 +278,8 @@ async def register():
         data['username'], 
         data['password'], 
         data['email'], 
-        data['full_name']
+        data['full_name'],
+        client=client_address(),
     )
     return jsonify(result)
 
@@ -46,10 +291,45 @@ async def login():
     if not data.get('username') or not data.get('password'):
         return jsonify({"error": "Username and password are required."}), 400
 
-    result = await auth_manager.sign_in(data['username'], data['password'])
+    result = await auth_manager.sign_in(data['username'], data['password'], client=client_address())
     return jsonify(result)
 
 
+@app.errorhandler(LoginThrottled)
+async def login_throttled(e):
+    response = jsonify({"is_success": False, "message": str(e)})
+    response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+    return response, 429
+
+
+@app.errorhandler(LLMUnavailable)
+async def llm_unavailable(e):
+    response = jsonify({"error": str(e)})
+    response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+    return response, 503
+
+
+@app.errorhandler(RateLimited)
+async def rate_limited(e):
+    response = jsonify({"error": str(e)})
+    response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+    return response, 429
+
+
+@app.errorhandler(Overloaded)
+async def overloaded(e):
+    response = jsonify({"error": str(e)})
+    response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+    return response, 503
+
+
+@app.errorhandler(HasherBusy)
+async def hasher_busy(e):
+    response = jsonify({"is_success": False, "message": str(e)})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+
 @app.route('/logout', methods=['POST'])
 @require_login
 async def logout():
@@ -63,7 +343,9 @@ async def logout():
 async def profile():
     """Fetch the current user's profile information."""
     current_user = await auth_manager.get_current_user()
-    return jsonify(current_user) if current_user else jsonify({"error": "User not found."}), 404
+    if not current_user:
+        return jsonify({"error": "User not found."}), 404
+    return jsonify(current_user)
 
 
 @app.route('/books', methods=['POST'])
@@ -76,21 +358,135 @@ async def add_book():
     return jsonify({"message": "Book added successfully!"}), 201
 
 
+@app.route('/books/bulk', methods=['POST'])
+@require_login
+async def bulk_add_books():
+    """
+    Import books from a CSV (with header) or NDJSON upload.
+
+    The body is parsed while it streams in and loaded in COPY batches.
+    Query parameters: `format` (csv|ndjson, else taken from Content-Type), `batch_size`
+    and `on_conflict` (error|skip|update, matched on id).
+    """
+    fmt = request.args.get('format') or (
+        'ndjson' if request.mimetype in ('application/x-ndjson', 'application/jsonl') else 'csv'
+    )
+    batch_size = request.args.get('batch_size', default=5000, type=int)
+    on_conflict = request.args.get('on_conflict', default='error')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({"error": "format must be csv or ndjson."}), 400
+    if on_conflict not in CONFLICT_MODES:
+        return jsonify({"error": f"on_conflict must be one of {', '.join(CONFLICT_MODES)}."}), 400
+    if not 1 <= batch_size <= 50000:
+        return jsonify({"error": "batch_size must be between 1 and 50000."}), 400
+
+    try:
+        report = await import_books(
+            db_manager, _body_chunks(request.body, request.body_timeout), fmt, batch_size, on_conflict
+        )
+    except asyncio.TimeoutError:
+        return jsonify({
+            "error": f"No data received for {request.body_timeout:g} seconds; batches loaded before that were kept."
+        }), 408
+    if report["loaded"]:
+        # COPY batches bypass the ORM events that keep the vector index current
+        similar_books.mark_dirty()
+    status = 201 if report["loaded"] and not report["failed_batches"] else 207 if report["loaded"] else 400
+    return jsonify(report), status
+
+
+async def _body_chunks(body, idle_timeout):
+    """Iterate a request body, giving up if the client sends nothing for `idle_timeout` seconds."""
+    chunks = body.__aiter__()
+    while True:
+        try:
+            chunk = await asyncio.wait_for(chunks.__anext__(), idle_timeout)
+        except StopAsyncIteration:
+            return
+        yield chunk
+
+
 @app.route('/books', methods=['GET'])
 @require_login
 async def get_books():
-    """Fetch all books."""
-    books = await db_manager.fetch_all(Book)
-    return jsonify([book.to_dict() for book in books])
+    """
+    Fetch books.
+
+    - `?after=<id>&limit=<n>` returns one keyset page plus the cursor for the next one.
+    - `?format=ndjson` (or `Accept: application/x-ndjson`) streams one book per line.
+    - Without parameters the whole catalog is streamed as a chunked JSON array.
+    - `?include=rating` adds each book's average rating and review count via the same query.
+    """
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', type=int)
+    if ('after' in request.args and after is None) or ('limit' in request.args and limit is None):
+        return jsonify({"error": "after and limit must be integers."}), 400
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}."}), 400
+
+    include_rating = request.args.get('include') == 'rating'
+    # Listings skip the ORM: plain rows, a serializer compiled from the table and orjson
+    query, serialize = Book.listing(include_rating)
+
+    wants_ndjson = (
+        request.args.get('format') == 'ndjson'
+        or request.accept_mimetypes.best == 'application/x-ndjson'
+    )
+    if wants_ndjson:
+        async def generate_ndjson():
+            async for row in db_manager.stream_rows(db_manager.keyset(query, Book.id, after, limit)):
+                yield orjson.dumps(serialize(row), default=str) + b'\n'
+
+        return Response(generate_ndjson(), mimetype='application/x-ndjson')
+
+    if after is not None or limit is not None:
+        limit = limit or DEFAULT_PAGE_SIZE
+        rows = await db_manager.fetch_rows(db_manager.keyset(query, Book.id, after, limit))
+        next_after = rows[-1].id if len(rows) == limit else None
+        return _json_response({"books": [serialize(row) for row in rows], "next_after": next_after})
+
+    async def generate_array():
+        separator = b'['
+        async for row in db_manager.stream_rows(db_manager.keyset(query, Book.id)):
+            yield separator + orjson.dumps(serialize(row), default=str)
+            separator = b','
+        yield b']' if separator == b',' else b'[]'
+
+    return Response(generate_array(), mimetype='application/json')
+
+
+@app.route('/books/search', methods=['GET'])
+@require_login
+async def search_books():
+    """
+    Search books by title, author, genre and summary, tolerating typos in author names.
+
+    Query parameters: `q` (required), `limit`, and `cursor` from the previous page's `next_cursor`.
+    """
+    query = (request.args.get('q') or '').strip()
+    limit = request.args.get('limit', default=20, type=int)
+    if not query:
+        return jsonify({"error": "q is required."}), 400
+    if not 1 <= limit <= 100:
+        return jsonify({"error": "limit must be between 1 and 100."}), 400
+    try:
+        results, next_cursor = await Book.search(db_manager, query, limit, request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"results": results, "next_cursor": next_cursor})
 
 
 @app.route('/books/<int:book_id>', methods=['GET'])
 @require_login
 async def get_book(book_id):
-    """Fetch a specific book."""
+    """Fetch a specific book; a matching `If-None-Match` gets a 304 after only a version lookup."""
+    not_modified = await _not_modified(book_id, lambda versions: _book_etag('book', book_id, versions.version))
+    if not_modified is not None:
+        return not_modified
     book = await db_manager.fetch_one(Book, {'id':book_id})
     if book: 
-        return jsonify(book.to_dict()), 200 
+        response = _json_response(book.to_dict())
+        return _with_validators(response, _book_etag('book', book_id, book.version), book.updated_at)
     else:
         return jsonify({"error": "Book not found"}), 404
 
@@ -100,9 +496,15 @@ async def get_book(book_id):
 async def update_book(book_id):
     """Update an existing book."""
     data = await request.get_json()
+    if not isinstance(data, dict) or not data:
+        return jsonify({"error": "Provide the fields to update."}), 400
+    unknown = set(data) - BOOK_UPDATE_FIELDS
+    if unknown:
+        return jsonify({"error": f"Unknown or read-only fields: {', '.join(sorted(unknown))}"}), 400
     updated_results = await db_manager.update_one_or_more(Book,filters= {'id':book_id}, updates = data)
-    if updated_results:
-        book = updated_results[0]
+    if not updated_results:
+        return jsonify({"error": "Book not found"}), 404
+    book = updated_results[0]
 
     return jsonify({"message": "Book updated successfully!", "updated_book": book.to_dict()}), 200
 
@@ -110,12 +512,10 @@ async def update_book(book_id):
 @app.route('/books/<int:book_id>', methods=['DELETE'])
 @require_login
 async def delete_book(book_id):
-    """Delete a specific book."""
-    book = await db_manager.fetch_one(Book, {'id':book_id})
-    if not book:
+    """Delete a specific book; its reviews, rating aggregate and jobs go with it through ON DELETE CASCADE."""
+    deleted = await db_manager.delete_where(Book, {'id': book_id})
+    if not deleted:
         return jsonify({"error": "Book not found"}), 404
-
-    await db_manager.delete(book)
     return jsonify({"message": "Book deleted successfully!"})
 
 
@@ -124,100 +524,418 @@ async def delete_book(book_id):
 async def add_review(book_id):
     """Add a review to a book."""
     data = await request.get_json()
+    book = await db_manager.fetch_one(Book, {'id': book_id})
+    if not book:
+        return jsonify({"error": "Book not found"}), 404
     review = Review(
         book_id=book_id,
         user_id=session.get('user_id'),
         review_text=data['review_text'],
         rating=data['rating']
     )
-    await db_manager.add_or_save(review)
+    try:
+        await db_manager.add_or_save(review)
+    except IntegrityError as e:
+        if not Review.is_duplicate(e):
+            raise
+        return jsonify({"error": "You have already reviewed this book."}), 409
+    user_id = session.get('user_id')
+
+    def invalidate_recommendations():
+        # Only once the review is committed, so a rebuild cannot cache the pre-review history
+        recommender.mark_dirty()
+        recommendation_cache.note_review(user_id, book.author, book.genre)
+
+    db_manager.after_commit(invalidate_recommendations)
     return jsonify({"message": "Review added successfully!"}), 201
 
 
 @app.route('/books/<int:book_id>/reviews', methods=['GET'])
 @require_login
 async def get_reviews(book_id):
-    """Fetch reviews for a specific book."""
-    reviews = await db_manager.fetch_all(Review, filters={"book_id": book_id})
-    return jsonify([review.to_dict() for review in reviews])
+    """Fetch reviews for a specific book, tagged with the book's review version."""
+    # Read the version before the reviews, so the ETag can only be older than the body, never newer
+    versions = await _book_versions(book_id)
+    etag = _book_etag('reviews', book_id, versions.reviews_version if versions else 0)
+    if request.if_none_match.contains(etag):
+        return _with_validators(Response(status=304), etag)
+    rows = await db_manager.fetch_rows(Review.for_book(book_id))
+    serialize = Review.row_serializer()
+    return _with_validators(_json_response([serialize(row) for row in rows]), etag)
+
+
+@app.route('/books/<int:book_id>/similar', methods=['GET'])
+@require_login
+async def get_similar_books(book_id):
+    """
+    Books most like this one by title, author, genre and summary, best first.
+
+    Query parameter: `limit` (default 10, at most 50). Each book carries its cosine `score`.
+    """
+    limit = request.args.get('limit', default=10, type=int)
+    if not 1 <= limit <= 50:
+        return jsonify({"error": "limit must be between 1 and 50."}), 400
+    neighbours = await similar_books.similar(book_id, limit)
+    if neighbours is None:
+        return jsonify({"error": "Book not found"}), 404
+    scores = dict(neighbours)
+    query, serialize = Book.listing()
+    rows = await db_manager.fetch_rows(query.where(Book.id.in_(list(scores))))
+    books = sorted((serialize(row) for row in rows), key=lambda book: scores[book["id"]], reverse=True)
+    return _json_response({
+        "book_id": book_id,
+        "similar": [{**book, "score": round(scores[book["id"]], 4)} for book in books],
+    })
 
 
 @app.route('/books/<int:book_id>/summary', methods=['GET'])
 @require_login
 async def get_book_summary(book_id):
-    """Fetch book summary and average rating."""
-    book = await db_manager.fetch_one(Book, {'id':book_id})
+    """Fetch book summary and its rating aggregate; the ETag covers both the book and its reviews."""
+    not_modified = await _not_modified(
+        book_id, lambda versions: _book_etag('summary', book_id, versions.version, versions.reviews_version)
+    )
+    if not_modified is not None:
+        return not_modified
+    book = await db_manager.fetch_one(Book, {'id':book_id}, options=[joinedload(Book.rating_stats)])
     if not book:
         return jsonify({"error": "Book not found"}), 404
 
-    reviews = await db_manager.fetch_all(Review, filters={"book_id": book_id})
-    average_rating = (
-        sum(review.rating for review in reviews) / len(reviews) if reviews else 0
-    )
-
-    return jsonify({
+    rating = BookRatingStats.describe(book.rating_stats)
+    etag = _book_etag('summary', book_id, book.version, book.reviews_version)
+    return _with_validators(_json_response({
         "book": book.to_dict(),
-        "average_rating": average_rating,
-        "review_count": len(reviews)
-    })
+        "average_rating": rating["average_rating"],
+        "review_count": rating["review_count"],
+        "rating_min": rating["rating_min"],
+        "rating_max": rating["rating_max"],
+        "histogram": rating["histogram"],
+    }), etag)
 
 
 @app.route('/recommendations', methods=['GET'])
 @require_login
 async def get_recommendations():
-    """Fetch recommended books based on user reviews."""
-    
-    # Query to get the user's preferred genres and authors from their reviews
-    query = """SELECT DISTINCT 
-                    B.author, 
-                    B.genre
-                    FROM books B
-                    JOIN reviews R 
-                        ON B.id = R.book_id
-                    WHERE R.user_id = :user_id
-            """
-    # Execute the query asynchronously and fetch results
-    result = await db_manager.execute_raw(query=query, params={'user_id': session.get('user_id')})
-    df = pd.DataFrame(result.fetchall(), columns=result.keys())
-
-    # Extract unique authors and genres
-    authors = df['author'].unique().tolist()
-    genres = df['genre'].unique().tolist()
+    """
+    Fetch recommended catalog books based on user reviews.
+
+    Candidates come from the collaborative-filtering engine. With `?explain=true` the LLM
+    additionally writes a short note introducing them, based on the user's favourite
+    authors and genres. Responses are cached per user until a review changes those
+    authors and genres; `?refresh=true` forces a rebuild.
+
+    With `?stream=true` (or `Accept: text/event-stream`) the picks are sent as a
+    `recommendations` event; with `explain` the note follows as `token` events, otherwise
+    `done` comes straight after.
+    """
+    user_id = session.get('user_id')
+    limit = request.args.get('limit', default=10, type=int)
+    if not 1 <= limit <= 50:
+        return jsonify({"error": "limit must be between 1 and 50."}), 400
+    explain = _flag(request.args.get('explain'))
+    refresh = _flag(request.args.get('refresh'))
+    if _wants_event_stream():
+        return await stream_recommendations(user_id, limit, explain, refresh)
+
+    # Only a note that has to be written costs LLM quota; cached responses are free
+    needs_llm = explain and (refresh or not recommendation_cache.is_cached(user_id, (limit, explain)))
+    await db_manager.checkpoint()
+    slot = await _admit_llm_call() if needs_llm else None
+    try:
+        payload = await recommendation_cache.get_or_build(
+            user_id,
+            (limit, explain),
+            lambda: build_recommendations(user_id, limit, explain, refresh),
+            force=refresh,
+            background_build=(lambda: refresh_explained_recommendations(user_id, limit)) if explain else None,
+        )
+    except LLMUnavailable:
+        raise
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if slot is not None:
+            slot.release()
+
+    return jsonify(payload)
+
+
+async def stream_recommendations(user_id, limit, explain=False, refresh=False):
+    """Send the cached picks immediately, then, with `explain`, stream the LLM's note about them."""
+    await db_manager.checkpoint()
+    payload = await recommendation_cache.get_or_build(
+        user_id,
+        (limit, False),
+        lambda: build_recommendations(user_id, limit, False, refresh),
+        force=refresh,
+    )
+    explain = explain and bool(payload["recommendations"])
+    slot = None
+    if explain:
+        prompt = recommendation_prompt(await favourite_pairs(user_id), payload["recommendations"])
+        if refresh or not await hf_model.is_cached(prompt):
+            slot = await _admit_llm_call()
+
+    async def events():
+        yield sse_event(payload, event='recommendations')
+        if not explain:
+            yield sse_event({"message": ""}, event='done')
+            return
+        parts = []
+        try:
+            async for token in hf_model.stream_response(prompt, bypass_cache=refresh):
+                parts.append(token)
+                yield sse_event({"token": token}, event='token')
+        except RuntimeError as e:
+            yield sse_event({"error": str(e)}, event='error')
+            return
+        yield sse_event({"message": ''.join(parts)}, event='done')
+
+    response = event_stream_response(events())
+    return release_when_sent(response, slot) if slot is not None else response
+
+
+async def refresh_explained_recommendations(user_id, limit):
+    """Rebuild a stale explained response in the background, or skip it (None) if the user's LLM quota or capacity is out."""
+    try:
+        slot = await admit(llm_rate_limiter, llm_admission, user_id)
+    except (RateLimited, Overloaded):
+        return None
+    try:
+        return await build_recommendations(user_id, limit, explain=True)
+    finally:
+        slot.release()
+
+
+async def _admit_llm_call():
+    """Charge the signed-in user's LLM quota and take a slot; release it once the call is over."""
+    return await admit(llm_rate_limiter, llm_admission, session.get('user_id'))
+
+
+async def favourite_pairs(user_id):
+    """Return the distinct (author, genre) pairs of books the user has reviewed."""
+    rows = await db_manager.fetch_rows(Review.favourite_pairs_query(user_id))
+    return [(author, genre) for author, genre in rows]
+
+
+def recommendation_prompt(pairs, books):
+    """Build the prompt asking the LLM to introduce the picked books (given as dicts)."""
+    # Extract unique authors and genres, keeping their order
+    authors = list(dict.fromkeys(author for author, _ in pairs))
+    genres = list(dict.fromkeys(genre for _, genre in pairs))
+    picks = '\n'.join(f"    - {book['title']} by {book['author']} ({book['genre']})" for book in books)
     
-    # Construct a persona-based prompt for the recommendation model
-    persona_prompt =  f"""You are a friendly and knowledgeable book recommender with a passion for literature. 
-    Your goal is to recommend books that align with the user's reading preferences. 
-    You know a lot about different authors, genres, and trends in literature. 
-    The user has given you their reading history, and you should provide book recommendations based on their favorite authors and genres. 
-    Keep your recommendations diverse, but always ensure they reflect the user’s interests. 
+    # Construct a persona-based prompt that only phrases the engine's picks
+    return f"""You are a friendly and knowledgeable book recommender with a passion for literature. 
+    The user has given you their reading history, and our library has already picked books for them from its own catalog. 
+    Introduce these picks in a few warm sentences, explaining how they connect to the user's interests. 
+    Only mention books from the list below and do not suggest any others. 
     Here are their favorite authors and genres:
     
     - Authors: {', '.join(authors)}
     - Genres: {', '.join(genres)}
 
-    Now, please recommend some books that the user might enjoy based on these preferences. """
-    
-    # Generate the recommendation using your HuggingFace model's generate_response function
-    try:
-        recommendations = await hf_model.generate_response(persona_prompt)
-    except RuntimeError as e:
-        return jsonify({"error": str(e)}), 500
+    Here are the books picked for them:
+{picks}
+    """
 
-    # Return the recommendations as part of the response
-    return jsonify({"recommendations": recommendations})
+
+async def build_recommendations(user_id, limit, explain=False, refresh=False):
+    """Build a recommendations payload; returns the user's (author, genre) pairs alongside it."""
+    pairs = await favourite_pairs(user_id)
+
+    candidates = await recommender.recommend(user_id, limit=limit)
+    scores = dict(candidates)
+    books = await db_manager.fetch_all(Book, filters={'id': list(scores)})
+    books.sort(key=lambda book: scores[book.id], reverse=True)
+    payload = {"recommendations": [{**book.to_dict(), "score": scores[book.id]} for book in books]}
+
+    if not explain or not books:
+        return pairs, payload
+
+    # Generate the note using your HuggingFace model's generate_response function
+    payload["message"] = await hf_model.generate_response(
+        recommendation_prompt(pairs, payload["recommendations"]), bypass_cache=refresh
+    )
+    return pairs, payload
 
 
 
 @app.route('/books/<int:book_id>/generate-summary', methods=['POST'])
 @require_login
 async def generate_summary(book_id):
-    """Generate a summary for book content."""
+    """
+    Generate a summary for book content.
+
+    With `?async=true` a background job is queued instead and 202 is returned with its id.
+    With `?stream=true` (or `Accept: text/event-stream`) the summary is streamed as `token`
+    events and saved to the book when the stream completes.
+    """
     book = await db_manager.fetch_one(Book, filters={'id': book_id})
-    summary = await book.generate_summary(llm_model = hf_model, db_manager= db_manager)
+    if not book:
+        return jsonify({"error": "Book not found"}), 404
+    regenerate = _flag(request.args.get('regenerate'))
+
+    if _flag(request.args.get('async')):
+        job = await library.generate_summary_for_book(book_id, regenerate=regenerate)
+        return jsonify({"job": job, "status_url": f"/jobs/{job['id']}"}), 202
+
+    # A summary the LLM cache already holds costs no quota
+    needs_llm = regenerate or not await hf_model.is_cached(book.summary_prompt())
+    # Nothing has been written yet; don't hold a pooled connection while waiting on the LLM
+    await db_manager.checkpoint()
+    slot = await _admit_llm_call() if needs_llm else None
+
+    if _wants_event_stream():
+        async def events():
+            try:
+                async for token in book.stream_summary(hf_model, db_manager, regenerate=regenerate):
+                    yield sse_event({"token": token}, event='token')
+            except RuntimeError as e:
+                yield sse_event({"error": str(e)}, event='error')
+                return
+            yield sse_event({"summary": book.summary}, event='done')
+
+        response = event_stream_response(events())
+        return release_when_sent(response, slot) if slot is not None else response
+
+    try:
+        summary = await book.generate_summary(
+            llm_model = hf_model, db_manager= db_manager, regenerate=regenerate
+        )
+    finally:
+        if slot is not None:
+            slot.release()
 
     return jsonify({"summary": summary})
 
 
+@app.route('/books/summaries/backfill', methods=['POST'])
+@require_login
+async def backfill_summaries():
+    """Queue summary jobs for every book that has no summary yet."""
+    batch = await library.generate_missing_summaries()
+    return jsonify({**batch, "status_url": f"/jobs/batches/{batch['batch_id']}"}), 202
+
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+@require_login
+async def get_job(job_id):
+    """Fetch the status of a summary job."""
+    job = await library.get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
+@app.route('/jobs/batches/<batch_id>', methods=['GET'])
+@require_login
+async def get_job_batch(batch_id):
+    """Fetch per-status counts for a backfill batch."""
+    batch = await library.get_batch(batch_id)
+    if not batch:
+        return jsonify({"error": "Batch not found"}), 404
+    return jsonify(batch)
+
+
+@app.route('/llm/cache', methods=['GET'])
+@require_login
+async def get_llm_cache_stats():
+    """Report LLM response cache hit/miss counters."""
+    return jsonify(llm_cache.stats())
+
+
+@app.route('/llm/backends', methods=['GET'])
+@require_login
+async def get_llm_backend_stats():
+    """Report per-backend latency, circuit state and call outcomes when LLM_BACKENDS routing is on."""
+    if not isinstance(hf_model, LLMRouter):
+        return jsonify({"error": "LLM routing is not enabled (set LLM_BACKENDS)."}), 404
+    return jsonify(hf_model.stats())
+
+
+@app.route('/llm/admission', methods=['GET'])
+@require_login
+async def get_llm_admission_stats():
+    """Report the LLM routes' limits, current load and queue depth, and the caller's remaining requests."""
+    return jsonify({
+        "admission": llm_admission.stats(),
+        "rate_limit": {**llm_rate_limiter.stats(), "your_tokens": llm_rate_limiter.tokens(session.get('user_id'))},
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics():
+    """Expose request, database and cache metrics in the Prometheus text format."""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def sse_event(data, event=None):
+    """Format one server-sent event carrying JSON data."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, default=str)}\n\n"
+
+
+def event_stream_response(events):
+    """Wrap an async generator of SSE strings in an unbuffered, untimed streaming response."""
+    response = Response(events, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.timeout = None
+    return response
+
+
+def _wants_event_stream():
+    return _flag(request.args.get('stream')) or request.accept_mimetypes.best == 'text/event-stream'
+
+
+def _book_etag(kind, book_id, *versions):
+    """Strong ETag for one representation of a book at the given version numbers."""
+    return f"{kind}-{book_id}-" + ".".join(str(version) for version in versions)
+
+
+async def _book_versions(book_id):
+    """A book's (version, reviews_version) by primary key, or None if it does not exist."""
+    rows = await db_manager.fetch_rows(Book.versions_query(book_id))
+    return rows[0] if rows else None
+
+
+async def _not_modified(book_id, make_etag):
+    """
+    Return a 304 if the request's `If-None-Match` holds the book's current ETag, else None.
+
+    Only requests that carry `If-None-Match` pay for the version lookup.
+    """
+    if not request.if_none_match:
+        return None
+    versions = await _book_versions(book_id)
+    if versions is None:
+        return None
+    etag = make_etag(versions)
+    if not request.if_none_match.contains(etag):
+        return None
+    return _with_validators(Response(status=304), etag)
+
+
+def _with_validators(response, etag, last_modified=None):
+    """Attach the ETag (and Last-Modified); clients must revalidate before reusing the private body."""
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def _json_response(payload, status=200):
+    """Encode a JSON body with orjson, which is several times faster than `jsonify` on large lists."""
+    return Response(orjson.dumps(payload, default=str), status=status, mimetype='application/json')
+
+
+def _flag(value):
+    """Interpret a query-string value as a boolean flag."""
+    return (value or '').lower() in ('1', 'true', 'yes')
+
+
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -1,16 +1,277 @@
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
 from db_utils import DatabaseManager  # Assuming this is the new db_manager
 from models import User  # Assuming User is a model class
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from functools import wraps
-from quart import session, jsonify
+from itertools import chain
+from quart import current_app, g, session, jsonify
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+import asyncio
+import math
+import time
+import weakref
+
+
+class HasherBusy(Exception):
+    """Raised when too many password hashes are already queued."""
+
+
+class LoginThrottled(Exception):
+    """Raised when a username or client has failed too often; `retry_after` is in seconds."""
+    def __init__(self, retry_after: float):
+        super().__init__(f"Too many attempts, retry in {math.ceil(retry_after)} seconds.")
+        self.retry_after = retry_after
+
+
+def expand_hash_method(method: str) -> str:
+    """
+    Spell out the parameters werkzeug fills in for a method spec, so "scrypt" and
+    "scrypt:32768:8:1" compare equal. Unknown or malformed specs are returned unchanged.
+    """
+    name, *args = method.split(":")
+    try:
+        if name == "scrypt":
+            n, r, p = map(int, args) if args else (2**15, 8, 1)
+            return f"scrypt:{n}:{r}:{p}"
+        if name == "pbkdf2" and len(args) <= 2:
+            hash_name = args[0] if args else "sha256"
+            iterations = int(args[1]) if len(args) == 2 else DEFAULT_PBKDF2_ITERATIONS
+            return f"pbkdf2:{hash_name}:{iterations}"
+    except ValueError:
+        pass
+    return method
+
+
+class PasswordHasher:
+    """
+    Runs werkzeug's password KDFs in a bounded process pool so they never block the event loop.
+
+    At most `max_pending` hashes may be queued or running; beyond that callers get `HasherBusy`
+    straight away instead of waiting behind a backlog.
+    """
+    def __init__(self, method: str = "scrypt:32768:8:1", workers: int = 2, max_pending: int = 32):
+        """
+        Args:
+            method (str): werkzeug method spec for new hashes, e.g. "scrypt:32768:8:1" or
+                "pbkdf2:sha256:1000000"; omitted parameters take werkzeug's defaults. Stored
+                hashes made with other parameters are upgraded on login.
+            workers (int): Processes computing hashes.
+            max_pending (int): Hashes allowed in the pool's queue and workers at once.
+        """
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(generate_password_hash, password, self.method)
+
+    async def verify(self, password_hash: str, password: str) -> bool:
+        return await self._submit(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """True if the hash was made with different KDF parameters than `method`."""
+        return expand_hash_method(password_hash.split("$", 1)[0]) != expand_hash_method(self.method)
+
+    async def shutdown(self):
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await asyncio.to_thread(pool.shutdown)
+
+    async def _submit(self, func, *args):
+        if self.pending >= self.max_pending:
+            raise HasherBusy("Password hashing is at capacity, try again shortly.")
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, func, *args)
+        finally:
+            self.pending -= 1
+
+
+class LoginThrottle:
+    """
+    Sliding-window failure counter per key (a client address, or a username and client address).
+
+    A key that failed `max_failures` times within `window` seconds is refused until its oldest
+    failure leaves the window. At most `max_keys` keys are tracked, oldest first out.
+    """
+    def __init__(self, max_failures: int, window: float = 300.0, max_keys: int = 100000):
+        self.max_failures = max_failures
+        self.window = window
+        self.max_keys = max_keys
+        self._failures: OrderedDict = OrderedDict()
+
+    def retry_after(self, key) -> float:
+        """Seconds until `key` may try again, 0 if it may try now."""
+        failures = self._failures.get(key)
+        if not failures:
+            return 0.0
+        now = time.monotonic()
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+            return 0.0
+        if len(failures) < self.max_failures:
+            return 0.0
+        return failures[0] + self.window - now
+
+    def record_failure(self, key):
+        failures = self._failures.get(key)
+        if failures is None:
+            failures = self._failures[key] = deque(maxlen=self.max_failures)
+        failures.append(time.monotonic())
+        self._failures.move_to_end(key)
+        while len(self._failures) > self.max_keys:
+            self._failures.popitem(last=False)
+
+    def reset(self, key):
+        self._failures.pop(key, None)
+
+
+class IdentityCache:
+    """
+    LRU cache of signed-in users' identities keyed by user id, with a TTL.
+
+    Entries are dropped when a transaction that changed or deleted the user commits (see the
+    session listeners below). That only reaches this process, so the TTL bounds how long other
+    worker processes may serve an outdated identity.
+    """
+    _instances = weakref.WeakSet()
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "invalidations": 0}
+        IdentityCache._instances.add(self)
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.counters["misses"] += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.counters["hits"] += 1
+        return entry[1]
+
+    def set(self, user_id: int, identity: Dict[str, Any]):
+        self._entries[user_id] = (time.monotonic() + self.ttl, identity)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        if self._entries.pop(user_id, None) is not None:
+            self.counters["invalidations"] += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.counters, "entries": len(self._entries)}
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_users(session, flush_context):
+    changed = {obj.id for obj in chain(session.dirty, session.deleted) if isinstance(obj, User)}
+    if changed:
+        session.info.setdefault("changed_user_ids", set()).update(changed)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _collect_bulk_user_changes(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ is not User:
+        return
+    affected = select(User.id)
+    if orm_execute_state.statement.whereclause is not None:
+        affected = affected.where(orm_execute_state.statement.whereclause)
+    changed = orm_execute_state.session.connection().execute(affected).scalars()
+    orm_execute_state.session.info.setdefault("changed_user_ids", set()).update(changed)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_users(session):
+    for user_id in session.info.pop("changed_user_ids", ()):
+        for cache in IdentityCache._instances:
+            cache.invalidate(user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_users(session):
+    session.info.pop("changed_user_ids", None)
+
+
+def _identity(user: User) -> Dict[str, Any]:
+    return {
+        "id": user.id,
+        "username": user.username,
+        "email": user.email,
+        "full_name": user.full_name,
+        "is_admin": bool(user.is_admin),
+    }
+
 
 class AuthManager:
-    def __init__(self, db_manager: DatabaseManager):
+    def __init__(
+        self,
+        db_manager: DatabaseManager,
+        hasher: Optional[PasswordHasher] = None,
+        user_throttle: Optional[LoginThrottle] = None,
+        client_throttle: Optional[LoginThrottle] = None,
+        registration_throttle: Optional[LoginThrottle] = None,
+        identities: Optional[IdentityCache] = None,
+    ):
+        """
+        Args:
+            db_manager (DatabaseManager): Database holding users.
+            hasher (PasswordHasher): Pool computing password hashes.
+            user_throttle (LoginThrottle): Failed sign-ins allowed per username from one client address.
+            client_throttle (LoginThrottle): Failed sign-ins allowed per client address.
+            registration_throttle (LoginThrottle): Registrations allowed per client address.
+            identities (IdentityCache): Signed-in users shared by `require_login` and `get_current_user`.
+        """
         self.db_manager = db_manager
+        self.hasher = hasher or PasswordHasher()
+        self.user_throttle = user_throttle or LoginThrottle(max_failures=5)
+        self.client_throttle = client_throttle or LoginThrottle(max_failures=50)
+        self.registration_throttle = registration_throttle or LoginThrottle(max_failures=20)
+        self.identities = identities or IdentityCache()
+
+    def init_app(self, app):
+        """Make this manager the one `require_login` resolves users with."""
+        app.extensions["auth_manager"] = self
+
+    async def load_identity(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Return a user's identity from the cache, loading it on a miss; None if the user is gone."""
+        identity = self.identities.get(user_id)
+        if identity is None:
+            user = await self.db_manager.fetch_one(User, {"id": user_id})
+            if user is None:
+                return None
+            identity = _identity(user)
+            self.identities.set(user_id, identity)
+        return identity
 
-    async def register(self, username: str, password: str, email: str, full_name: str) -> Dict[str, Any]:
+    def _check_throttle(self, *keys):
+        """Raise LoginThrottled if any of the (throttle, key) pairs is over its limit."""
+        wait = max(throttle.retry_after(key) for throttle, key in keys)
+        if wait > 0:
+            raise LoginThrottled(wait)
+
+    async def register(self, username: str, password: str, email: str, full_name: str, client: Optional[str] = None) -> Dict[str, Any]:
         """Register a new user with hashed password."""
+        # Every registration costs a hash, so they have a per-client budget of their own; counting
+        # them as failed logins would let a burst of sign-ups lock out every login from that address
+        self._check_throttle((self.registration_throttle, client))
+        self.registration_throttle.record_failure(client)
+
         # Check if username already exists
         existing_user = await self.db_manager.fetch_one(User, filters={"username": username})
 
@@ -18,7 +279,7 @@ class AuthManager:
             return {"is_success": False, "message": "Username already exists"}
 
         # Hash the password before storing
-        hashed_password = generate_password_hash(password)
+        hashed_password = await self.hasher.hash(password)
         new_user = User(username=username, password_hash=hashed_password, email=email, full_name=full_name)
 
         try:
@@ -28,15 +289,24 @@ class AuthManager:
         except Exception as e:
             return {"is_success": False, "message": f"Error creating user: {e}"}
 
-    async def sign_in(self, username: str, password: str) -> Dict[str, Any]:
-        """Sign in the user by verifying credentials."""
+    async def sign_in(self, username: str, password: str, client: Optional[str] = None) -> Dict[str, Any]:
+        """Sign in the user by verifying credentials, upgrading the stored hash if its parameters are outdated."""
+        # Keyed on the client too, so failures from elsewhere cannot lock the owner out of their account
+        user_key = (username.lower(), client)
+        self._check_throttle((self.user_throttle, user_key), (self.client_throttle, client))
+
         # Fetch the user by username
         user = await self.db_manager.fetch_one(User, filters={"username": username})
 
-        if user and check_password_hash(user.password_hash, password):
+        if user and await self.hasher.verify(user.password_hash, password):
+            self.user_throttle.reset(user_key)
+            if self.hasher.needs_rehash(user.password_hash):
+                new_hash = await self.hasher.hash(password)
+                await self.db_manager.update_one_or_more(User, {"id": user.id}, {"password_hash": new_hash})
             # Store user info in session
             session['user_id'] = user.id
             session['username'] = user.username
+            self.identities.set(user.id, _identity(user))
             return {
                 "is_success": True,
                 "message": "Sign in successful",
@@ -45,6 +315,8 @@ class AuthManager:
                 "full_name": user.full_name
             }
         else:
+            self.user_throttle.record_failure(user_key)
+            self.client_throttle.record_failure(client)
             return {"is_success": False, "message": "Invalid credentials"}
 
     async def sign_out(self) -> Dict[str, Any]:
@@ -57,17 +329,16 @@ class AuthManager:
         return 'user_id' in session
 
     async def get_current_user(self) -> Dict[str, Any]:
-        """Retrieve the current logged-in user based on the session."""
-        user_id = session.get('user_id')
-        if user_id:
-            user = await self.db_manager.fetch_one(User, user_id)
-            return {
-                "id": user.id,
-                "username": user.username,
-                "email": user.email,
-                "full_name": user.full_name
-            } if user else None
-        return None
+        """Retrieve the current logged-in user based on the session, usually without a query."""
+        identity = g.get('current_user')
+        if identity is None:
+            user_id = session.get('user_id')
+            if not user_id:
+                return None
+            identity = await self.load_identity(user_id)
+            if identity is None:
+                return None
+        return {key: identity[key] for key in ("id", "username", "email", "full_name")}
 
 # Decorator to require login for certain routes
 
@@ -76,8 +347,16 @@ def require_login(f):
     @wraps(f)
     async def decorated_function(*args, **kwargs):
         # Ensure session is correctly checked in an async environment
-        if session.get('user_id') is None:
+        user_id = session.get('user_id')
+        if user_id is None:
             # Return a 403 Forbidden response if not logged in
             return jsonify({"error": "User must be logged in."}), 403
+        auth_manager = current_app.extensions.get("auth_manager")
+        if auth_manager is not None:
+            # Resolve the user once per request (normally from memory) and reject deleted accounts
+            g.current_user = await auth_manager.load_identity(user_id)
+            if g.current_user is None:
+                session.clear()
+                return jsonify({"error": "User must be logged in."}), 403
         return await f(*args, **kwargs)
     return decorated_function
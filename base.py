@@ -1,17 +1,61 @@
+from operator import attrgetter
+from sqlalchemy import select
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 
 Base = declarative_base()
 
+
+def compile_serializer(names):
+    """Build a function turning a row (any sequence whose fields follow `names`) into a dict."""
+    names = tuple(names)
+
+    def serialize(row):
+        return dict(zip(names, row))
+    return serialize
+
+
 class BaseModel(Base):
     __abstract__ = True
+    # Bookkeeping columns (versions, timestamps) kept out of `to_dict` and the row serializers
+    _internal_columns: tuple = ()
 
     @declared_attr
     def __tablename__(cls):
         return cls.__name__.lower() + 's'
 
+    @classmethod
+    def _compiled_columns(cls):
+        """Column attribute getter and row serializer, built once per model from its table."""
+        compiled = cls.__dict__.get("_compiled")
+        if compiled is None:
+            names = tuple(column.name for column in cls._public_columns())
+            if len(names) == 1:
+                # attrgetter of a single name returns the bare value rather than a 1-tuple
+                name, = names
+                getter = lambda obj: (getattr(obj, name),)
+            else:
+                getter = attrgetter(*names)
+            compiled = cls._compiled = (getter, compile_serializer(names))
+        return compiled
+
+    @classmethod
+    def _public_columns(cls):
+        return [column for column in cls.__table__.columns if column.name not in cls._internal_columns]
+
+    @classmethod
+    def row_query(cls):
+        """Core select of every public column, for reads served with `row_serializer` instead of ORM instances."""
+        return select(*cls._public_columns())
+
+    @classmethod
+    def row_serializer(cls):
+        """Turn a `row_query` row into the same dict `to_dict` returns."""
+        return cls._compiled_columns()[1]
+
     def to_dict(self):
         """Convert model instance to dictionary."""
-        return {column.name: getattr(self, column.name) for column in self.__table__.columns}
+        getter, serialize = self._compiled_columns()
+        return serialize(getter(self))
 
     @classmethod
     def from_dict(cls, data):
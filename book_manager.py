@@ -1,10 +1,59 @@
-from llm_utils import HuggingFaceModel
-from models import Book
-from db_utils import db_manager
+import asyncio
+import uuid
+from datetime import timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import select, update, insert, func, and_, literal
+
+from llm_utils import LLM_Base
+from models import Book, SummaryJob, utcnow
+from db_utils import db_manager, DatabaseManager
 
 class SmartLibrary:
-    def __init__(self) -> None:
-        pass
+    """
+    Orchestrates background summary generation.
+
+    Jobs are stored in the `summary_jobs` table, so they survive restarts and can be picked up
+    by any worker process. Each process runs a bounded pool of asyncio workers fed by a poller
+    that scans for due jobs; a job is claimed atomically before it runs, failed attempts are
+    retried with exponential backoff, and jobs left running by a crashed process are re-queued.
+    """
+    def __init__(
+        self,
+        db_manager: DatabaseManager = db_manager,
+        llm_model: Optional[LLM_Base] = None,
+        workers: int = 4,
+        max_attempts: int = 3,
+        backoff_base: float = 5.0,
+        poll_interval: float = 2.0,
+        lease_timeout: float = 600.0,
+        stop_timeout: float = 10.0,
+    ) -> None:
+        """
+        Args:
+            db_manager (DatabaseManager): Database holding books and jobs.
+            llm_model (LLM_Base): Model used to write summaries.
+            workers (int): Number of concurrent summary generations in this process.
+            max_attempts (int): Attempts before a job is marked failed.
+            backoff_base (float): Delay in seconds before the first retry, doubled for each further one.
+            poll_interval (float): Seconds between scans for due jobs.
+            lease_timeout (float): Seconds after which a running job is assumed abandoned.
+            stop_timeout (float): Seconds `stop` lets running jobs finish before cancelling them.
+        """
+        self.db_manager = db_manager
+        self.llm_model = llm_model
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.poll_interval = poll_interval
+        self.lease_timeout = lease_timeout
+        self.stop_timeout = stop_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: set = set()
+        self._tasks: list = []
+        self._busy: set = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
 
     def add_new_book(self):
         pass
@@ -15,11 +64,219 @@ class SmartLibrary:
     def delete_book_by_id(self, book_id):
         pass
 
-    def generate_summary_for_book(self, book_id):
-        pass
+    async def generate_summary_for_book(self, book_id: int, regenerate: bool = False) -> Dict[str, Any]:
+        """Queue a summary job for one book and return it."""
+        result = await self.db_manager.execute(
+            insert(SummaryJob)
+            .values(book_id=book_id, regenerate=regenerate, max_attempts=self.max_attempts)
+            .returning(SummaryJob.id)
+        )
+        job_id = result.scalar_one()
+        self.db_manager.after_commit(lambda: self._notify(job_id))
+        return await self.get_job(job_id)
+
+    async def generate_missing_summaries(self) -> Dict[str, Any]:
+        """
+        Queue a job for every book whose summary is NULL and has no job pending or running.
+
+        Returns the batch id, which can be polled with `get_batch`, and the number of jobs queued.
+        """
+        batch_id = str(uuid.uuid4())
+        now = utcnow()
+        active = select(SummaryJob.book_id).where(SummaryJob.status.in_([SummaryJob.PENDING, SummaryJob.RUNNING]))
+        books = select(
+            Book.id,
+            literal(batch_id),
+            literal(SummaryJob.PENDING),
+            literal(False),
+            literal(0),
+            literal(self.max_attempts),
+            literal(now),
+            literal(now),
+            literal(now),
+        ).where(and_(Book.summary.is_(None), Book.id.not_in(active)))
+        result = await self.db_manager.execute(
+            insert(SummaryJob).from_select(
+                ["book_id", "batch_id", "status", "regenerate", "attempts", "max_attempts",
+                 "run_after", "created_at", "updated_at"],
+                books,
+            )
+        )
+        self.db_manager.after_commit(self._notify)
+        return {"batch_id": batch_id, "queued": result.rowcount}
 
     def get_book_summary(self, book_id):
-        pass    
+        pass
+
+    async def get_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Return a job's current state, or None if it does not exist."""
+        job = await self.db_manager.fetch_one(SummaryJob, {"id": job_id})
+        return job.to_dict() if job else None
+
+    async def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """Return per-status job counts for a backfill batch, or None if it does not exist."""
+        result = await self.db_manager.execute(
+            select(SummaryJob.status, func.count())
+            .where(SummaryJob.batch_id == batch_id)
+            .group_by(SummaryJob.status)
+        )
+        counts = {status: count for status, count in result.all()}
+        if not counts:
+            return None
+        return {"batch_id": batch_id, "total": sum(counts.values()), "by_status": counts}
+
+    def start(self):
+        """Recover abandoned jobs and start the poller and worker pool."""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.workers * 4)
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._poll())]
+        self._tasks += [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """
+        Stop idle workers and the poller, give running jobs and a scan in progress `stop_timeout`
+        seconds to finish, then cancel them; interrupted jobs are recovered after the lease timeout.
+        """
+        # Workers finishing a job exit on this flag instead of taking the next one. It also
+        # catches a cancellation that a driver call turned into an ordinary error.
+        self._stopping = True
+        busy = [task for task in self._tasks if task in self._busy]
+        for task in self._tasks:
+            if task not in self._busy:
+                task.cancel()
+        if busy:
+            # Cancelling mid-query can strand a driver connection (and, on SQLite, its thread)
+            _, pending = await asyncio.wait(busy, timeout=self.stop_timeout)
+            for task in pending:
+                task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queued.clear()
+
+    def _notify(self, job_id: Optional[int] = None):
+        """Hand a new job straight to the workers when there is room, otherwise wake the poller."""
+        if self._queue is None:
+            return
+        if job_id is not None and job_id not in self._queued:
+            try:
+                self._queue.put_nowait(job_id)
+                self._queued.add(job_id)
+                return
+            except asyncio.QueueFull:
+                pass
+        self._wakeup.set()
+
+    async def _poll(self):
+        task = asyncio.current_task()
+        while not self._stopping:
+            # Busy while querying so that `stop` lets the scan finish; the queue and wakeup waits are safe to cancel
+            self._busy.add(task)
+            try:
+                await self._requeue_abandoned()
+                due = await self._due_jobs()
+            except Exception as e:
+                print(f"Summary job poll failed: {e}")
+                due = []
+            finally:
+                self._busy.discard(task)
+            for job_id in due:
+                if job_id not in self._queued:
+                    # Blocks while the pool is saturated, which bounds memory and DB pressure
+                    await self._queue.put(job_id)
+                    self._queued.add(job_id)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    @staticmethod
+    def due_jobs_query(limit: int):
+        """Ids of pending jobs whose retry time has come, oldest first."""
+        return (
+            select(SummaryJob.id)
+            .where(and_(SummaryJob.status == SummaryJob.PENDING, SummaryJob.run_after <= utcnow()))
+            .order_by(SummaryJob.run_after, SummaryJob.id)
+            .limit(limit)
+        )
+
+    @staticmethod
+    def claim_query(job_id: int):
+        """Mark a pending job with attempts left as running; returns nothing if another worker got it first."""
+        return (
+            update(SummaryJob)
+            .where(and_(
+                SummaryJob.id == job_id,
+                SummaryJob.status == SummaryJob.PENDING,
+                SummaryJob.attempts < SummaryJob.max_attempts,
+            ))
+            .values(status=SummaryJob.RUNNING, attempts=SummaryJob.attempts + 1, updated_at=utcnow())
+            .returning(SummaryJob.book_id, SummaryJob.regenerate, SummaryJob.attempts, SummaryJob.max_attempts)
+        )
+
+    async def _requeue_abandoned(self):
+        cutoff = utcnow() - timedelta(seconds=self.lease_timeout)
+        abandoned = and_(SummaryJob.status == SummaryJob.RUNNING, SummaryJob.updated_at < cutoff)
+        # A job whose worker keeps dying (OOM, killed pod) would otherwise be claimed forever
+        await self.db_manager.execute(
+            update(SummaryJob)
+            .where(and_(abandoned, SummaryJob.attempts >= SummaryJob.max_attempts))
+            .values(status=SummaryJob.FAILED, last_error="Worker stopped before finishing; out of attempts")
+        )
+        await self.db_manager.execute(
+            update(SummaryJob)
+            .where(and_(abandoned, SummaryJob.attempts < SummaryJob.max_attempts))
+            .values(status=SummaryJob.PENDING)
+        )
+
+    async def _due_jobs(self) -> list:
+        room = self._queue.maxsize - self._queue.qsize()
+        if room <= 0:
+            return []
+        result = await self.db_manager.execute(self.due_jobs_query(room + len(self._queued)))
+        return result.scalars().all()
+
+    async def _work(self):
+        while not self._stopping:
+            job_id = await self._queue.get()
+            task = asyncio.current_task()
+            self._busy.add(task)
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                print(f"Summary job {job_id} crashed: {e}")
+            finally:
+                self._busy.discard(task)
+                self._queued.discard(job_id)
+                self._queue.task_done()
+
+    async def _run(self, job_id: int):
+        # Claim the job; another worker or process may have taken it already
+        result = await self.db_manager.execute(self.claim_query(job_id))
+        claimed = result.first()
+        if claimed is None:
+            return
+        book_id, regenerate, attempts, max_attempts = claimed
 
+        try:
+            book = await self.db_manager.fetch_one(Book, {"id": book_id})
+            if book is None:
+                raise LookupError(f"Book {book_id} no longer exists")
+            await book.generate_summary(llm_model=self.llm_model, db_manager=self.db_manager, regenerate=regenerate)
+        except Exception as e:
+            if attempts < max_attempts and not isinstance(e, LookupError):
+                delay = self.backoff_base * 2 ** (attempts - 1)
+                values = dict(status=SummaryJob.PENDING, run_after=utcnow() + timedelta(seconds=delay))
+            else:
+                values = dict(status=SummaryJob.FAILED)
+            await self.db_manager.execute(
+                update(SummaryJob).where(SummaryJob.id == job_id).values(last_error=str(e), **values)
+            )
+            return
 
-    
\ No newline at end of file
+        await self.db_manager.execute(
+            update(SummaryJob).where(SummaryJob.id == job_id).values(status=SummaryJob.SUCCEEDED, last_error=None)
+        )
@@ -0,0 +1,285 @@
+"""
+High-throughput book import.
+
+Rows are parsed and validated incrementally from a CSV or NDJSON byte stream and loaded in
+batches with asyncpg's `copy_records_to_table`, one transaction per batch (on SQLite, with one
+multi-row INSERT per batch instead). CSV input needs a header line and one record per line.
+
+    python bulk_import.py books.csv --batch-size 5000 --on-conflict update
+"""
+import argparse
+import asyncio
+import csv
+import json
+import sys
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, text
+
+BOOK_COLUMNS = ("id", "title", "author", "genre", "year_published", "summary")
+CONFLICT_MODES = ("error", "skip", "update")
+STAGING_TABLE = "book_import_staging"
+
+
+class RowError(ValueError):
+    """Raised when an input row cannot be turned into a book."""
+
+
+def validate_book_row(row: Dict[str, Any]) -> Tuple:
+    """Validate one input row and return it as a record ordered like `BOOK_COLUMNS`."""
+    if not isinstance(row, dict):
+        raise RowError("Row must be an object.")
+    unknown = set(row) - set(BOOK_COLUMNS)
+    if unknown:
+        raise RowError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    record = []
+    for column in BOOK_COLUMNS:
+        value = row.get(column)
+        if isinstance(value, str):
+            value = value.strip()
+            if value == "":
+                value = None
+        if column in ("title", "author", "genre"):
+            if not value:
+                raise RowError(f"{column} is required.")
+            value = str(value)
+        elif column in ("id", "year_published") and value is not None:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise RowError(f"{column} must be an integer.")
+        elif column == "summary" and value is not None:
+            value = str(value)
+        record.append(value)
+    return tuple(record)
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Split a stream of byte chunks into raw lines without buffering the whole body."""
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r")
+    if pending:
+        yield pending.rstrip(b"\r")
+
+
+async def iter_rows(chunks: AsyncIterator[bytes], fmt: str) -> AsyncIterator[Tuple[int, Any]]:
+    """
+    Yield `(line_number, row)` pairs parsed from CSV (with a header line) or NDJSON.
+
+    Lines that cannot be parsed are yielded as `(line_number, RowError)`.
+    """
+    header = None
+    line_number = 0
+    async for raw in iter_lines(chunks):
+        line_number += 1
+        if not raw.strip():
+            continue
+        try:
+            # Decoded per line so that one bad byte only costs its own row
+            line = raw.decode("utf-8")
+            if fmt == "ndjson":
+                yield line_number, json.loads(line)
+            elif header is None:
+                header = [name.strip() for name in next(csv.reader([line]))]
+            else:
+                values = next(csv.reader([line]))
+                if len(values) != len(header):
+                    raise RowError(f"Expected {len(header)} fields, got {len(values)}.")
+                yield line_number, dict(zip(header, values))
+        except UnicodeDecodeError as e:
+            yield line_number, RowError(f"Line is not valid UTF-8: {e}")
+        except (ValueError, csv.Error) as e:
+            yield line_number, RowError(f"Unparseable line: {e}")
+
+
+async def import_books(
+    db_manager,
+    chunks: AsyncIterator[bytes],
+    fmt: str = "csv",
+    batch_size: int = 5000,
+    on_conflict: str = "error",
+    max_errors: int = 100,
+) -> Dict[str, Any]:
+    """
+    Stream rows into the books table in batches.
+
+    Args:
+        db_manager (DatabaseManager): Target database.
+        chunks (AsyncIterator[bytes]): Raw upload body.
+        fmt (str): "csv" or "ndjson".
+        batch_size (int): Rows per COPY and transaction.
+        on_conflict (str): What to do with rows whose id already exists: "error" fails the
+            batch, "skip" keeps the existing book, "update" overwrites it.
+        max_errors (int): Row errors listed in the report (all are counted).
+    Returns:
+        dict: Totals plus per-row validation errors and per-batch load errors.
+    """
+    if fmt not in ("csv", "ndjson"):
+        raise ValueError("format must be csv or ndjson")
+    if on_conflict not in CONFLICT_MODES:
+        raise ValueError(f"on_conflict must be one of {', '.join(CONFLICT_MODES)}")
+
+    report = {"rows": 0, "loaded": 0, "invalid": 0, "batches": 0, "failed_batches": 0,
+              "row_errors": [], "batch_errors": []}
+    batch: List[Tuple] = []
+    first_line = None
+    explicit_ids = False
+
+    async def flush(last_line):
+        nonlocal batch, first_line
+        report["batches"] += 1
+        try:
+            report["loaded"] += await load_batch(db_manager, batch, on_conflict)
+        except Exception as e:
+            report["failed_batches"] += 1
+            report["batch_errors"].append({
+                "batch": report["batches"], "first_line": first_line, "last_line": last_line,
+                "rows": len(batch), "error": str(e),
+            })
+        batch, first_line = [], None
+
+    last_line = 0
+    async for line_number, row in iter_rows(chunks, fmt):
+        last_line = line_number
+        report["rows"] += 1
+        try:
+            if isinstance(row, RowError):
+                raise row
+            record = validate_book_row(row)
+        except RowError as e:
+            report["invalid"] += 1
+            if len(report["row_errors"]) < max_errors:
+                report["row_errors"].append({"line": line_number, "error": str(e)})
+            continue
+        explicit_ids = explicit_ids or record[0] is not None
+        if first_line is None:
+            first_line = line_number
+        batch.append(record)
+        if len(batch) >= batch_size:
+            await flush(line_number)
+    if batch:
+        await flush(last_line)
+
+    if explicit_ids and report["loaded"]:
+        await sync_book_id_sequence(db_manager)
+    return report
+
+
+async def load_batch(db_manager, records: List[Tuple], on_conflict: str = "error") -> int:
+    """Load one batch of validated records in a single transaction; returns the rows written."""
+    if db_manager.engine.dialect.name != "postgresql":
+        return await insert_batch(db_manager, records, on_conflict)
+    async with db_manager.engine.begin() as conn:
+        # Opening the staging table first also starts the transaction the COPY runs in
+        await conn.execute(text(
+            f"CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} ("
+            "id integer, title text, author text, genre text, year_published integer, summary text"
+            ") ON COMMIT DELETE ROWS"
+        ))
+        raw = await conn.get_raw_connection()
+        driver = raw.driver_connection
+
+        if on_conflict == "error" and all(record[0] is None for record in records):
+            # Nothing can conflict: COPY straight into the table
+            await driver.copy_records_to_table(
+                "books", records=[record[1:] for record in records], columns=list(BOOK_COLUMNS[1:])
+            )
+            return len(records)
+
+        await driver.copy_records_to_table(STAGING_TABLE, records=records, columns=list(BOOK_COLUMNS))
+        conflict = {
+            "error": "",
+            "skip": "ON CONFLICT (id) DO NOTHING",
+            "update": "ON CONFLICT (id) DO UPDATE SET " + ", ".join(
+                f"{column} = EXCLUDED.{column}" for column in BOOK_COLUMNS[1:]
+            ) + ", version = books.version + 1, updated_at = now()",
+        }[on_conflict]
+        result = await conn.execute(text(
+            f"INSERT INTO books ({', '.join(BOOK_COLUMNS)}) "
+            f"SELECT COALESCE(id, nextval(pg_get_serial_sequence('books', 'id'))), "
+            f"{', '.join(BOOK_COLUMNS[1:])} FROM {STAGING_TABLE} {conflict}"
+        ))
+        return result.rowcount
+
+
+async def insert_batch(db_manager, records: List[Tuple], on_conflict: str = "error") -> int:
+    """Load one batch with an executemany INSERT, for databases without COPY."""
+    from models import Book
+
+    stmt = db_manager.insert(Book)
+    if on_conflict == "skip":
+        stmt = stmt.on_conflict_do_nothing(index_elements=["id"])
+    elif on_conflict == "update":
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["id"],
+            set_={
+                **{column: stmt.excluded[column] for column in BOOK_COLUMNS[1:]},
+                "version": Book.version + 1,
+                "updated_at": func.now(),
+            },
+        )
+    with_ids = [dict(zip(BOOK_COLUMNS, record)) for record in records if record[0] is not None]
+    without_ids = [dict(zip(BOOK_COLUMNS[1:], record[1:])) for record in records if record[0] is None]
+    written = 0
+    async with db_manager.engine.begin() as conn:
+        # executemany needs every row to carry the same columns
+        for rows in (with_ids, without_ids):
+            if rows:
+                written += (await conn.execute(stmt, rows)).rowcount
+    return written
+
+
+async def sync_book_id_sequence(db_manager):
+    """Move the books id sequence past explicitly imported ids (PostgreSQL only)."""
+    if db_manager.engine.dialect.name != "postgresql":
+        return
+    async with db_manager.engine.begin() as conn:
+        await conn.execute(text(
+            "SELECT setval(pg_get_serial_sequence('books', 'id'), GREATEST((SELECT max(id) FROM books), 1))"
+        ))
+
+
+async def read_file(path: str, chunk_size: int = 1 << 20) -> AsyncIterator[bytes]:
+    """Read a file (or stdin for "-") in chunks without blocking the event loop."""
+    handle = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        while True:
+            chunk = await asyncio.to_thread(handle.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        if handle is not sys.stdin.buffer:
+            handle.close()
+
+
+def main(argv: Optional[Iterable[str]] = None):
+    parser = argparse.ArgumentParser(description="Bulk import books from CSV or NDJSON.")
+    parser.add_argument("path", help="File to import, or - for stdin")
+    parser.add_argument("--format", choices=("csv", "ndjson"),
+                        help="Input format (defaults to the file extension, else csv)")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--on-conflict", choices=CONFLICT_MODES, default="error")
+    args = parser.parse_args(argv)
+    fmt = args.format or ("ndjson" if args.path.endswith((".ndjson", ".jsonl")) else "csv")
+
+    from db_utils import db_manager
+
+    async def run():
+        try:
+            return await import_books(db_manager, read_file(args.path), fmt, args.batch_size, args.on_conflict)
+        finally:
+            await db_manager.engine.dispose()
+
+    report = asyncio.run(run())
+    print(json.dumps(report, indent=2))
+    return 1 if report["failed_batches"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,17 @@
 import asyncio
+import contextvars
+from contextlib import asynccontextmanager
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy import event, select, update, delete, text
+from sqlalchemy.util import await_only
 from dotenv import load_dotenv
 import os
+import weakref
 from base import Base
+from metrics import instrument_engine, statement_operation, timed_pool
 
 load_dotenv()
 
@@ -15,13 +22,179 @@ db_password = os.getenv('POSTGRES_PASSWORD')
 db_port = 5432
 db_host = os.getenv('DB_HOST', 'localhost')
 
-DATABASE_URL = f"postgresql+asyncpg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+# DATABASE_URL, when set, overrides the POSTGRES_* settings (used by the benchmark harness)
+DATABASE_URL = os.getenv('DATABASE_URL') or f"postgresql+asyncpg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+
+# Applied to every new SQLite connection: WAL lets readers run alongside the writer, and
+# NORMAL sync is durable across application crashes while skipping an fsync per commit
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA busy_timeout={busy_timeout_ms}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+class SQLiteWriteQueue:
+    """
+    Serialises write transactions on a SQLite database within this process.
+
+    SQLite allows one writer at a time. Instead of letting concurrent writers collide inside
+    SQLite's busy handler (which blocks a driver thread per waiter), a transaction takes this
+    FIFO lock just before its first write statement and holds it until it commits or rolls
+    back. The driver only opens its transaction at that first write, so reads never wait and
+    never hold a stale snapshot. Writers in other processes are still arbitrated by SQLite's
+    busy timeout.
+    """
+    WRITE_OPERATIONS = {"insert", "update", "delete", "replace", "create", "drop", "alter"}
+
+    def __init__(self, timeout=30.0):
+        self.timeout = timeout
+        self.reset()
+
+    def reset(self):
+        """Drop the lock state, e.g. in a forked child where the parent's holder does not exist."""
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+        self.loop = None
+
+    def install(self, sync_engine):
+        event.listen(sync_engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(sync_engine, "commit", self._release)
+        event.listen(sync_engine, "rollback", self._release)
+        event.listen(sync_engine.pool, "checkin", self._release_on_checkin)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if conn.info.get("holds_write_lock") or statement_operation(statement) not in self.WRITE_OPERATIONS:
+            return
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # An asyncio lock only works on one event loop; a new loop (consecutive asyncio.run
+            # calls, test cases) cannot meet a holder from the old one, so start afresh
+            self.reset()
+            self.loop = loop
+        self.waiting += 1
+        try:
+            await_only(asyncio.wait_for(self.lock.acquire(), self.timeout))
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Timed out after {self.timeout}s waiting for the SQLite writer")
+        finally:
+            self.waiting -= 1
+        conn.info["holds_write_lock"] = True
+
+    def _release(self, conn):
+        if conn.info.pop("holds_write_lock", False):
+            self.lock.release()
+
+    def _release_on_checkin(self, dbapi_connection, connection_record):
+        # Safety net for connections returned without an explicit commit or rollback
+        if connection_record is not None and connection_record.info.pop("holds_write_lock", False):
+            self.lock.release()
+
+
+_unit_of_work = contextvars.ContextVar("unit_of_work", default=None)
+
+
+class UnitOfWork:
+    """
+    One session and transaction shared by every `DatabaseManager` call made from the task that
+    opened it, typically a request handler. The session is opened on first use, so requests
+    that never touch the database cost nothing. Tasks spawned from the request (coalesced LLM
+    calls, background refreshes) inherit the context but not the session: they run their own
+    transactions, since an AsyncSession must not be shared between tasks.
+    """
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+        self.task = asyncio.current_task()
+        self.session = None
+        self.active = True
+        self._after_commit = []
+
+    def owns_current_task(self):
+        return self.active and asyncio.current_task() is self.task
+
+    def get_session(self):
+        if self.session is None:
+            self.session = self.db_manager.Session()
+        return self.session
+
+    def after_commit(self, callback):
+        self._after_commit.append(callback)
+
+    async def commit(self):
+        """Commit the transaction (if one was started) and run the post-commit callbacks."""
+        if self.session is not None:
+            await self.session.commit()
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
+
+    async def rollback(self):
+        self._after_commit = []
+        if self.session is not None:
+            await self.session.rollback()
+
+    async def close(self):
+        """End the unit of work, rolling back anything left uncommitted."""
+        self.active = False
+        self._after_commit = []
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
 
 
 class DatabaseManager:
-    def __init__(self, database_url):
-        self.engine = create_async_engine(database_url, echo=True)
+    _instances = weakref.WeakSet()
+
+    def __init__(self, database_url, echo=None, sqlite_busy_timeout=None):
+        """
+        Accepts any async SQLAlchemy URL. PostgreSQL (asyncpg) is the primary target; SQLite
+        (aiosqlite, e.g. "sqlite+aiosqlite:///library.db") runs embedded with WAL, tuned pragmas
+        and a single-writer queue.
+
+        Statement logging is off unless `echo` is true or the SQL_ECHO environment variable is set;
+        query, pool and per-request metrics are always collected (see metrics.py).
+        """
+        if echo is None:
+            echo = os.getenv('SQL_ECHO', '').lower() in ('1', 'true', 'yes', 'on')
+        if sqlite_busy_timeout is None:
+            sqlite_busy_timeout = float(os.getenv('SQLITE_BUSY_TIMEOUT', 30))
+        url = make_url(database_url)
+        backend = url.get_backend_name()
+        engine_options = {}
+        if backend == 'postgresql':
+            engine_options['poolclass'] = timed_pool(AsyncAdaptedQueuePool)
+        elif backend == 'sqlite' and url.database not in (None, '', ':memory:'):
+            # aiosqlite defaults to NullPool, which opens a connection (and its thread) per checkout
+            engine_options['poolclass'] = timed_pool(AsyncAdaptedQueuePool)
+        self.engine = instrument_engine(create_async_engine(database_url, echo=echo, **engine_options))
+        self.write_queue = None
+        if backend == 'sqlite':
+            self._configure_sqlite(sqlite_busy_timeout)
         self.Session = sessionmaker(bind=self.engine, class_=AsyncSession, expire_on_commit=False)
+        DatabaseManager._instances.add(self)
+
+    def _after_fork(self):
+        """Forget pooled connections inherited from the parent; the child opens its own."""
+        self.engine.sync_engine.dispose(close=False)
+        if self.write_queue is not None:
+            self.write_queue.reset()
+
+    def _configure_sqlite(self, busy_timeout):
+        pragmas = [pragma.format(busy_timeout_ms=int(busy_timeout * 1000)) for pragma in SQLITE_PRAGMAS]
+
+        @event.listens_for(self.engine.sync_engine, "connect")
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+
+        self.write_queue = SQLiteWriteQueue(timeout=busy_timeout)
+        self.write_queue.install(self.engine.sync_engine)
 
     async def create_tables(self):
         """Create all tables defined in the metadata."""
@@ -30,39 +203,167 @@ class DatabaseManager:
             await conn.run_sync(Base.metadata.create_all)
         print('created tables')
 
-    async def add_or_save(self, obj):
-        """Add an ORM object to the database."""
+    def begin_unit_of_work(self):
+        """Start a unit of work for the current task; pass the returned token to `end_unit_of_work`."""
+        unit_of_work = UnitOfWork(self)
+        return unit_of_work, _unit_of_work.set(unit_of_work)
+
+    async def end_unit_of_work(self, unit_of_work, token, commit=True):
+        """Commit (or roll back) and close a unit of work started with `begin_unit_of_work`."""
+        try:
+            if commit:
+                await unit_of_work.commit()
+            else:
+                await unit_of_work.rollback()
+        finally:
+            await unit_of_work.close()
+            _unit_of_work.reset(token)
+
+    @asynccontextmanager
+    async def unit_of_work(self):
+        """Run a block in one transaction, committed on success and rolled back on error."""
+        unit_of_work, token = self.begin_unit_of_work()
+        try:
+            yield unit_of_work
+        except BaseException:
+            await self.end_unit_of_work(unit_of_work, token, commit=False)
+            raise
+        await self.end_unit_of_work(unit_of_work, token)
+
+    def current_unit_of_work(self):
+        """The unit of work owned by the current task, or None."""
+        unit_of_work = _unit_of_work.get()
+        if unit_of_work is not None and unit_of_work.db_manager is self and unit_of_work.owns_current_task():
+            return unit_of_work
+        return None
+
+    async def checkpoint(self):
+        """
+        Commit the current unit of work so far and return its connection to the pool.
+
+        Call it before a long wait such as an LLM call: a burst of requests holding their
+        connections through it can exhaust the pool, starving the very tasks they wait on.
+        Later calls in the unit of work start a new transaction.
+        """
+        unit_of_work = self.current_unit_of_work()
+        if unit_of_work is not None:
+            await unit_of_work.commit()
+
+    def after_commit(self, callback):
+        """Call `callback` once the current unit of work commits, or right away outside of one."""
+        unit_of_work = self.current_unit_of_work()
+        if unit_of_work is None:
+            callback()
+        else:
+            unit_of_work.after_commit(callback)
+
+    @asynccontextmanager
+    async def session(self):
+        """Yield the current unit of work's session, or a new session committed when the block exits."""
+        unit_of_work = self.current_unit_of_work()
+        if unit_of_work is not None:
+            yield unit_of_work.get_session()
+            return
         async with self.Session() as session:
             async with session.begin():
-                session.add(obj)
-            await session.commit()
+                yield session
+
+    async def add_or_save(self, obj):
+        """Add an ORM object to the database, flushing it so that defaults and ids are populated."""
+        async with self.session() as session:
+            session.add(obj)
+            await session.flush()
 
     async def delete(self, obj):
         """Delete an ORM object from the database."""
-        async with self.Session() as session:
-            async with session.begin():
-                await session.delete(obj)
-            await session.commit()
+        async with self.session() as session:
+            await session.delete(obj)
+            await session.flush()
 
-    async def fetch_all(self, model, filters=None):
-        """Fetch all objects of a specific model with optional filters."""
-        async with self.Session() as session:
+    async def delete_where(self, model, filters):
+        """Delete every row matching `filters` in one statement; returns the deleted primary keys."""
+        async with self.session() as session:
+            result = await session.execute(delete(model).filter_by(**filters).returning(model.id))
+            return result.scalars().all()
+
+    async def fetch_all(self, model, filters=None, options=None):
+        """Fetch all objects of a specific model with optional filters and loader options."""
+        async with self.session() as session:
             # Start building the query
             stmt = select(model)
+            if options:
+                stmt = stmt.options(*options)
             
-            # Apply filters if provided
+            # Apply filters if provided; list values match any of their elements
             if filters:
                 for column, value in filters.items():
-                    stmt = stmt.filter(getattr(model, column) == value)
+                    if isinstance(value, (list, tuple, set)):
+                        stmt = stmt.filter(getattr(model, column).in_(value))
+                    else:
+                        stmt = stmt.filter(getattr(model, column) == value)
 
             result = await session.execute(stmt)
-            return result.scalars().all()  # Return all matching records
+            return list(result.scalars().all())  # Return all matching records
 
-    async def fetch_one(self, model, filters=None):
-        """Fetch a single object of a specific model with optional filters."""
-        async with self.Session() as session:
+    async def fetch_page(self, model, filters=None, after=None, limit=100, options=None):
+        """Fetch one keyset page of a model ordered by primary key, starting after the given id."""
+        async with self.session() as session:
+            stmt = self._keyset_query(model, filters, after, limit, options)
+            result = await session.execute(stmt)
+            return result.scalars().all()
+
+    def _keyset_query(self, model, filters=None, after=None, limit=None, options=None):
+        """Build a primary-key ordered select for keyset pagination."""
+        stmt = select(model)
+        if options:
+            stmt = stmt.options(*options)
+        if filters:
+            for column, value in filters.items():
+                stmt = stmt.filter(getattr(model, column) == value)
+        return self.keyset(stmt, model.id, after, limit)
+
+    @staticmethod
+    def keyset(stmt, key, after=None, limit=None):
+        """Order a select by `key` and restrict it to the page starting after the given key value."""
+        if after is not None:
+            stmt = stmt.where(key > after)
+        stmt = stmt.order_by(key)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return stmt
+
+    async def fetch_rows(self, stmt):
+        """
+        Execute a Core select and return its rows as plain tuples.
+
+        Runs on the unit of work's connection but below the ORM, so no instances are built or
+        tracked in the identity map; pair it with a serializer from `base.compile_serializer`.
+        """
+        async with self.session() as session:
+            connection = await session.connection()
+            result = await connection.execute(stmt)
+            return result.all()
+
+    async def stream_rows(self, stmt, batch_size=500):
+        """
+        Like `fetch_rows`, but yields rows from a server-side cursor ``batch_size`` at a time.
+
+        Memory stays flat no matter how many rows match. Always uses its own connection, because
+        the cursor outlives the request handler that creates the stream.
+        """
+        async with self.engine.connect() as connection:
+            result = await connection.stream(stmt.execution_options(yield_per=batch_size))
+            async for partition in result.partitions():
+                for row in partition:
+                    yield row
+
+    async def fetch_one(self, model, filters=None, options=None):
+        """Fetch a single object of a specific model with optional filters and loader options."""
+        async with self.session() as session:
             # Start building the query
             stmt = select(model)
+            if options:
+                stmt = stmt.options(*options)
             
             # Apply filters if provided
             if filters:
@@ -73,35 +374,59 @@ class DatabaseManager:
             return result.scalars().first()  # Return the first matching record, or None
 
     async def update_one_or_more(self, model, filters, updates):
-        """Update one or more objects of the specified model with the given filters and new data."""
-        async with self.Session() as session:
-            # Start building the query
-            stmt = select(model).filter_by(**filters)
-            
+        """
+        Update every row matching `filters` with one UPDATE ... RETURNING statement.
+
+        Returns the updated objects, or an empty list if nothing matched.
+        """
+        async with self.session() as session:
+            stmt = update(model).filter_by(**filters).values(**updates).returning(model)
             result = await session.execute(stmt)
-            instances = result.scalars().all()
-    
-            if instances:
-                for instance in instances:
-                    for key, value in updates.items():
-                        setattr(instance, key, value)
-    
-                # We don't need to call session.begin() again if we're already within the transaction context.
-                # Simply add the instances to the session and commit.
-                session.add_all(instances)  # Use add_all to add multiple instances at once
-                await session.commit()
-    
-                return instances  # Return the list of updated instances
-            else:
-                return []  # Return an empty list if no records were found
-    
+            return result.scalars().all()
+
+    async def upsert(self, model, values, index_elements, update_columns=None):
+        """
+        Insert a row, or update it when it conflicts on the given unique columns.
+
+        `update_columns` defaults to every provided value outside `index_elements`.
+        """
+        stmt = self.insert(model).values(**values)
+        if update_columns is None:
+            update_columns = [column for column in values if column not in index_elements]
+        stmt = stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: stmt.excluded[column] for column in update_columns},
+        )
+        async with self.session() as session:
+            await session.execute(stmt)
+
+    def insert(self, model):
+        """Return a dialect-specific INSERT construct that supports ON CONFLICT clauses."""
+        dialect = self.engine.dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            raise NotImplementedError(f"Upserts are not supported for dialect: {dialect}")
+        return insert(model)
+
+    async def execute(self, stmt):
+        """Execute a Core or ORM statement in the current unit of work (or its own transaction) and return the buffered result."""
+        async with self.session() as session:
+            return await session.execute(stmt)
 
     async def execute_raw(self, query, params=None):
         """Execute a raw SQL query if needed (fallback option)."""
-        async with self.Session() as session:
-            async with session.begin():
-                result = await session.execute(text(query), params)
-            return result
+        async with self.session() as session:
+            return await session.execute(text(query), params)
 
 # Create the database manager instance
+def _reset_after_fork():
+    for manager in list(DatabaseManager._instances):
+        manager._after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
 db_manager = DatabaseManager(database_url=DATABASE_URL)
@@ -0,0 +1,341 @@
+"""
+An `LLM_Base` that fronts several LLM backends.
+
+Each call goes to the backend with the lowest smoothed (EWMA) latency whose circuit breaker
+admits it. If no answer has arrived once that backend's latency percentile has passed, a
+duplicate request is sent to the next backend and whichever answers first wins; the other
+request is cancelled. A backend that fails too often in a row is skipped until its breaker
+lets a probe call through again.
+
+Backends are usually `HuggingFaceModel`s: Hugging Face models, or any OpenAI-compatible
+endpoint such as a local server (see `LLMRouter.from_config`).
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+
+from llm_utils import LLM_Base, LLMResponseCache, HuggingFaceModel
+from metrics import registry
+
+llm_backend_latency = registry.gauge(
+    "llm_backend_latency_ewma_seconds", "Smoothed latency of successful calls per LLM backend.", ["backend"]
+)
+llm_backend_calls = registry.counter("llm_backend_calls_total", "LLM backend calls by outcome.", ["backend", "outcome"])
+llm_backend_circuit_open = registry.gauge(
+    "llm_backend_circuit_open", "1 while a backend's circuit breaker refuses calls.", ["backend"]
+)
+llm_hedged_calls = registry.counter("llm_hedged_calls_total", "Duplicate LLM requests sent after the hedge deadline.")
+
+
+class LLMUnavailable(RuntimeError):
+    """Raised when every backend failed or has its circuit open; `retry_after` is in seconds."""
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+
+    After `failure_threshold` failures in a row the circuit opens and refuses calls for
+    `reset_timeout` seconds. It then lets a single probe call through (half-open): a success
+    closes the circuit, a failure opens it again.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def available(self) -> bool:
+        """Whether `allow` would admit a call now, without claiming the probe."""
+        state = self.state
+        return state == "closed" or (state == "half-open" and not self.probing)
+
+    def allow(self) -> bool:
+        """Admit a call, claiming the single probe slot when half-open."""
+        if not self.available():
+            return False
+        if self.opened_at is not None:
+            self.probing = True
+        return True
+
+    def retry_after(self) -> float:
+        """Seconds until the circuit admits a probe, 0 if it admits calls now."""
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release(self):
+        """Give back the probe slot of a call that was cancelled before it had an outcome."""
+        self.probing = False
+
+
+class Backend:
+    """One LLM endpoint with its latency statistics and circuit breaker."""
+    def __init__(self, name: str, model: LLM_Base, breaker: Optional[CircuitBreaker] = None,
+                 alpha: float = 0.2, window: int = 200):
+        """
+        Args:
+            name (str): Label used in stats and metrics.
+            model (LLM_Base): Client for the endpoint; give it no cache, the router has its own.
+            breaker (CircuitBreaker): Defaults to 5 failures and 30 seconds.
+            alpha (float): Weight of the newest latency in the EWMA.
+            window (int): Recent latencies kept for percentiles.
+        """
+        self.name = name
+        self.model = model
+        self.breaker = breaker or CircuitBreaker()
+        self.alpha = alpha
+        self.ewma: Optional[float] = None
+        self.latencies = deque(maxlen=window)
+        self.counters = {"success": 0, "failure": 0, "cancelled": 0}
+
+    def observe(self, seconds: float):
+        self.latencies.append(seconds)
+        self.ewma = seconds if self.ewma is None else self.alpha * seconds + (1 - self.alpha) * self.ewma
+        llm_backend_latency.set(self.ewma, backend=self.name)
+
+    def observe_abandoned(self, seconds: float):
+        """
+        A call cancelled after `seconds` would have taken at least that long. It may raise the
+        average so a backend that keeps losing sinks in the ranking, but it is not a sample
+        for the percentiles behind the hedge delay.
+        """
+        self.ewma = seconds if self.ewma is None else max(self.ewma, seconds)
+        llm_backend_latency.set(self.ewma, backend=self.name)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def record(self, outcome: str):
+        """Count a call's outcome ("success", "failure" or "cancelled") and update the breaker."""
+        self.counters[outcome] += 1
+        llm_backend_calls.inc(backend=self.name, outcome=outcome)
+        if outcome == "success":
+            self.breaker.record_success()
+        elif outcome == "failure":
+            self.breaker.record_failure()
+        else:
+            self.breaker.release()
+        llm_backend_circuit_open.set(0 if self.breaker.state == "closed" else 1, backend=self.name)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "state": self.breaker.state,
+            "latency_ewma": self.ewma,
+            "latency_p95": self.percentile(0.95),
+            **self.counters,
+        }
+
+
+def _consume_outcome(task):
+    # Losing requests are cancelled without being awaited; keep their errors from being logged as unretrieved
+    if not task.cancelled():
+        task.exception()
+
+
+class LLMRouter(LLM_Base):
+    """
+    Routes calls across backends by observed latency, hedging slow calls and skipping failing backends.
+
+    Caching and coalescing of identical calls happen once, in the router (see `LLM_Base`).
+    """
+    def __init__(
+        self,
+        backends: Iterable[Backend],
+        cache: Optional[LLMResponseCache] = None,
+        hedge_percentile: float = 0.95,
+        min_hedge_delay: float = 0.05,
+        max_hedges: int = 1,
+        model_name: Optional[str] = None,
+    ):
+        """
+        Args:
+            backends (Iterable[Backend]): Endpoints to route between, in order of preference
+                until their latencies are known.
+            cache (LLMResponseCache): Optional response cache.
+            hedge_percentile (float): Latency percentile of the chosen backend after which a
+                duplicate request goes to the next one.
+            min_hedge_delay (float): Lower bound of the hedge deadline in seconds.
+            max_hedges (int): Duplicate requests allowed per call; 0 disables hedging.
+            model_name (str): Name used in cache keys; defaults to the first backend's model,
+                so responses cached before routing was enabled keep being served.
+        """
+        super().__init__(cache=cache)
+        self.backends = list(backends)
+        if not self.backends:
+            raise ValueError("LLMRouter needs at least one backend.")
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedges = max_hedges
+        self.model_name = model_name or self.backends[0].model.model_name
+        self.counters = {"calls": 0, "hedges": 0, "hedge_wins": 0, "failovers": 0, "unavailable": 0}
+
+    @classmethod
+    def from_config(cls, config: List[Dict[str, Any]], cache: Optional[LLMResponseCache] = None,
+                    failure_threshold: int = 5, reset_timeout: float = 30.0, **options) -> "LLMRouter":
+        """
+        Build a router of `HuggingFaceModel` backends from a list of dicts, e.g. parsed from
+        the LLM_BACKENDS environment variable:
+
+            [{"model": "meta-llama/Llama-3.2-3B-Instruct"},
+             {"name": "local", "model": "llama3.2:3b", "base_url": "http://127.0.0.1:11434", "api_key_env_var": null}]
+
+        Keys besides `name` and `model` are passed to `HuggingFaceModel`; `api_key_env_var`
+        defaults to HUGGINGFACE_API_KEY and null means no authentication.
+        """
+        backends = []
+        for entry in config:
+            entry = dict(entry)
+            model_name = entry.pop("model")
+            name = entry.pop("name", None) or entry.get("base_url") or model_name
+            backends.append(Backend(
+                name,
+                HuggingFaceModel(model_name=model_name, **entry),
+                CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=reset_timeout),
+            ))
+        return cls(backends, cache=cache, **options)
+
+    def ranked(self) -> List[Backend]:
+        """Backends whose circuit admits calls, fastest first; unmeasured ones go first so they get measured."""
+        available = [backend for backend in self.backends if backend.breaker.available()]
+        return sorted(available, key=lambda backend: -1.0 if backend.ewma is None else backend.ewma)
+
+    def hedge_delay(self, backend: Backend) -> Optional[float]:
+        """Seconds to wait for `backend` before hedging, or None while its latency is unknown."""
+        observed = backend.percentile(self.hedge_percentile)
+        return None if observed is None else max(self.min_hedge_delay, observed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "backends": [backend.stats() for backend in self.backends]}
+
+    async def warm_up(self):
+        await asyncio.gather(*(
+            backend.model.warm_up() for backend in self.backends if hasattr(backend.model, "warm_up")
+        ))
+
+    async def aclose(self):
+        await asyncio.gather(*(
+            backend.model.aclose() for backend in self.backends if hasattr(backend.model, "aclose")
+        ))
+
+    def _unavailable(self, message: str) -> LLMUnavailable:
+        self.counters["unavailable"] += 1
+        waits = [backend.breaker.retry_after() for backend in self.backends]
+        return LLMUnavailable(message, retry_after=max(1.0, min(waits)))
+
+    async def _generate(self, messages: List[Dict[str, str]], **params) -> str:
+        self.counters["calls"] += 1
+        queue = self.ranked()
+        running = {}  # task -> (backend, started)
+        errors = []
+        hedges = 0
+
+        def launch():
+            while queue:
+                backend = queue.pop(0)
+                if backend.breaker.allow():
+                    started = time.monotonic()
+                    task = asyncio.ensure_future(backend.model._generate(messages, **params))
+                    running[task] = (backend, started)
+                    return backend, started
+            return None
+
+        latest = launch()
+        if latest is None:
+            raise self._unavailable("Every LLM backend has its circuit open.")
+        try:
+            while running:
+                timeout = None
+                if hedges < self.max_hedges and queue:
+                    delay = self.hedge_delay(latest[0])
+                    if delay is not None:
+                        timeout = max(0.0, latest[1] + delay - time.monotonic())
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Hedge deadline passed: race a duplicate on the next backend
+                    hedges += 1
+                    if launch() is not None:
+                        self.counters["hedges"] += 1
+                        llm_hedged_calls.inc()
+                    continue
+                for task in done:
+                    backend, started = running.pop(task)
+                    if task.exception() is None:
+                        backend.observe(time.monotonic() - started)
+                        backend.record("success")
+                        if backend is not latest[0]:
+                            self.counters["hedge_wins"] += 1
+                        return task.result()
+                    errors.append(f"{backend.name}: {task.exception()}")
+                    backend.record("failure")
+                if not running:
+                    latest = launch()
+                    if latest is not None:
+                        self.counters["failovers"] += 1
+        finally:
+            now = time.monotonic()
+            for task, (backend, started) in running.items():
+                task.cancel()
+                task.add_done_callback(_consume_outcome)
+                backend.observe_abandoned(now - started)
+                backend.record("cancelled")
+        if not errors:
+            raise self._unavailable("Every LLM backend has its circuit open.")
+        raise self._unavailable(f"All LLM backends failed: {'; '.join(errors)}")
+
+    async def _stream(self, messages: List[Dict[str, str]], **params) -> AsyncIterator[str]:
+        """Stream from the fastest available backend, failing over only until the first chunk is sent."""
+        errors = []
+        for backend in self.ranked():
+            if not backend.breaker.allow():
+                continue
+            started = time.monotonic()
+            produced = False
+            outcome = "cancelled"
+            try:
+                async for chunk in backend.model._stream(messages, **params):
+                    produced = True
+                    yield chunk
+                outcome = "success"
+            except Exception as e:
+                outcome = "failure"
+                if produced:
+                    raise
+                errors.append(f"{backend.name}: {e}")
+                continue
+            finally:
+                if outcome == "success":
+                    backend.observe(time.monotonic() - started)
+                backend.record(outcome)
+            return
+        if not errors:
+            raise self._unavailable("Every LLM backend has its circuit open.")
+        raise self._unavailable(f"All LLM backends failed: {'; '.join(errors)}")
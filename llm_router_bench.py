@@ -0,0 +1,117 @@
+"""
+Exercise `LLMRouter` against local stub servers with differing latency and reliability.
+
+Starts three stubs (llm_stub_server.py) in-process:
+
+- fast: quick, but a fraction of calls hit a long tail
+- steady: slower but consistent
+- flaky: quick when it answers, but fails a large fraction of calls
+
+then sends the same sequence of calls to the fast stub alone and to a router over all three,
+and prints latency percentiles, error counts and the router's per-backend stats.
+
+    python llm_router_bench.py --calls 300 --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+
+from llm_router import Backend, CircuitBreaker, LLMRouter
+from llm_stub_server import serve_stub
+from llm_utils import HuggingFaceModel
+
+STUBS = (
+    # name, port offset, behaviour
+    ("fast", 0, {"latency": 0.05, "tail_rate": 0.1, "tail_latency": 1.0}),
+    ("steady", 1, {"latency": 0.15}),
+    ("flaky", 2, {"latency": 0.03, "failure_rate": 0.6}),
+)
+
+
+def _model(port):
+    return HuggingFaceModel(
+        model_name="stub", base_url=f"http://127.0.0.1:{port}", api_key_env_var=None, max_concurrency=64
+    )
+
+
+async def drive(model, calls, concurrency):
+    """Send `calls` distinct prompts with at most `concurrency` in flight; returns (latencies, errors)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], []
+
+    async def one(n):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await model.generate_response(f"prompt {n}")
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(str(e))
+
+    await asyncio.gather(*(one(n) for n in range(calls)))
+    return latencies, errors
+
+
+def summarize(latencies, errors):
+    ordered = sorted(latencies) or [float("nan")]
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+
+    return {
+        "ok": len(latencies),
+        "errors": len(errors),
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 1) if latencies else None,
+    }
+
+
+async def run(args):
+    shutdown = asyncio.Event()
+    servers = [
+        asyncio.create_task(serve_stub(port=args.port + offset, shutdown_trigger=shutdown.wait, **behaviour))
+        for _, offset, behaviour in STUBS
+    ]
+    await asyncio.sleep(1.0)
+    try:
+        single = _model(args.port)
+        router = LLMRouter(
+            [
+                Backend(name, _model(args.port + offset), CircuitBreaker(failure_threshold=3, reset_timeout=2.0))
+                for name, offset, _ in STUBS
+            ],
+            hedge_percentile=args.hedge_percentile,
+        )
+        results = {}
+        for label, model in (("fast stub alone", single), ("router", router)):
+            latencies, errors = await drive(model, args.calls, args.concurrency)
+            results[label] = summarize(latencies, errors)
+            await model.aclose()
+        return results, router.stats()
+    finally:
+        shutdown.set()
+        await asyncio.gather(*servers, return_exceptions=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare one LLM endpoint with the latency-aware router.")
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--port", type=int, default=8101, help="First of three consecutive stub ports")
+    parser.add_argument("--hedge-percentile", type=float, default=0.9)
+    args = parser.parse_args(argv)
+
+    results, router_stats = asyncio.run(run(args))
+    for label, summary in results.items():
+        print(f"{label:<16} {json.dumps(summary)}")
+    print(json.dumps(router_stats, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
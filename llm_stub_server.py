@@ -0,0 +1,137 @@
+"""
+Local stub of an OpenAI-compatible chat-completions API.
+
+Point `HUGGINGFACE_BASE_URL` at it to exercise `HuggingFaceModel` without a real provider:
+
+    python llm_stub_server.py --port 8001 --latency 0.5
+    HUGGINGFACE_BASE_URL=http://127.0.0.1:8001 quart run
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from quart import Quart, Response, jsonify, request
+
+
+def create_stub_app(
+    latency: float = 0.0,
+    reply: str = "This is a stubbed model response.",
+    tail_rate: float = 0.0,
+    tail_latency: float = 0.0,
+    failure_rate: float = 0.0,
+) -> Quart:
+    """
+    Build a Quart app that answers chat-completion calls after a fixed delay.
+
+    A `tail_rate` fraction of calls take `tail_latency` instead, and a `failure_rate` fraction
+    are answered with a 503, to imitate a degraded provider. `GET /stats` reports the calls
+    received and the most answered at once, so a client's concurrency cap can be checked.
+    """
+    stub = Quart(__name__)
+    stub.config['STUB_LATENCY'] = latency
+    stub.config['STUB_REPLY'] = reply
+    stub.config['STUB_TAIL_RATE'] = tail_rate
+    stub.config['STUB_TAIL_LATENCY'] = tail_latency
+    stub.config['STUB_FAILURE_RATE'] = failure_rate
+    stub.config['STUB_CALLS'] = 0
+    stub.config['STUB_IN_FLIGHT'] = 0
+    stub.config['STUB_PEAK_IN_FLIGHT'] = 0
+
+    def _latency():
+        if random.random() < stub.config['STUB_TAIL_RATE']:
+            return stub.config['STUB_TAIL_LATENCY']
+        return stub.config['STUB_LATENCY']
+
+    @stub.route('/v1/chat/completions', methods=['POST'])
+    @stub.route('/models/<path:model>/v1/chat/completions', methods=['POST'])
+    async def chat_completions(model=None):
+        """Mimic the chat-completions response body, or its server-sent event stream."""
+        payload = await request.get_json()
+        stub.config['STUB_CALLS'] += 1
+        # A streamed call counts as in flight until its response starts
+        stub.config['STUB_IN_FLIGHT'] += 1
+        stub.config['STUB_PEAK_IN_FLIGHT'] = max(stub.config['STUB_PEAK_IN_FLIGHT'], stub.config['STUB_IN_FLIGHT'])
+        try:
+            return await _reply(payload, model)
+        finally:
+            stub.config['STUB_IN_FLIGHT'] -= 1
+
+    @stub.route('/stats', methods=['GET'])
+    async def stats():
+        """Calls received so far, and how many were being answered at once at most."""
+        return jsonify({
+            "calls": stub.config['STUB_CALLS'],
+            "in_flight": stub.config['STUB_IN_FLIGHT'],
+            "peak_in_flight": stub.config['STUB_PEAK_IN_FLIGHT'],
+        })
+
+    async def _reply(payload, model):
+        latency = _latency()
+        if random.random() < stub.config['STUB_FAILURE_RATE']:
+            await asyncio.sleep(latency)
+            return jsonify({"error": "Stubbed provider failure."}), 503
+        if payload.get("stream"):
+            return _stream_reply(payload.get("model", model), latency)
+        await asyncio.sleep(latency)
+        return jsonify({
+            "id": f"stub-{stub.config['STUB_CALLS']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", model),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": stub.config['STUB_REPLY']},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    def _stream_reply(model_name, latency):
+        """Spread the reply's words evenly over the call's latency."""
+        words = stub.config['STUB_REPLY'].split(' ')
+        delay = latency / len(words)
+
+        async def events():
+            for i, word in enumerate(words):
+                await asyncio.sleep(delay)
+                chunk = {
+                    "id": f"stub-{stub.config['STUB_CALLS']}",
+                    "object": "chat.completion.chunk",
+                    "model": model_name,
+                    "choices": [{"index": 0, "delta": {"content": word if i == 0 else ' ' + word}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return Response(events(), mimetype='text/event-stream')
+
+    return stub
+
+
+async def serve_stub(host: str = "127.0.0.1", port: int = 8001, latency: float = 0.0, shutdown_trigger=None, **behaviour):
+    """Serve the stub in the current event loop, e.g. from a benchmark or test harness; `behaviour` goes to `create_stub_app`."""
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"{host}:{port}"]
+    config.accesslog = None
+    await serve(create_stub_app(latency, **behaviour), config, shutdown_trigger=shutdown_trigger)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a stub chat-completions server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=float(os.getenv('STUB_LLM_LATENCY', 0)))
+    parser.add_argument('--tail-rate', type=float, default=0.0, help="Fraction of calls that take --tail-latency")
+    parser.add_argument('--tail-latency', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Fraction of calls answered with a 503")
+    args = parser.parse_args()
+    asyncio.run(serve_stub(
+        args.host, args.port, args.latency,
+        tail_rate=args.tail_rate, tail_latency=args.tail_latency, failure_rate=args.failure_rate,
+    ))
@@ -1,79 +1,481 @@
-from huggingface_hub import InferenceClient
 from dotenv import load_dotenv
 import os
-from typing import Union, List, Dict
-import httpx  # For async requests
+from typing import TYPE_CHECKING, Union, List, Dict, Optional, Any, AsyncIterator
+from collections import OrderedDict
+import hashlib
+import json
+import time
+from datetime import timezone
 import asyncio
+import weakref
+from sqlalchemy import Column, String, Text, DateTime, func
+from base import BaseModel
+
+if TYPE_CHECKING:
+    import httpx
 
 # Load environment variables
 load_dotenv()
 
-class LLM_Base:
+
+class LLMCacheEntry(BaseModel):
+    """Persistent tier of the LLM response cache, shared by every worker."""
+    __tablename__ = "llm_response_cache"
+
+    key = Column(String(64), primary_key=True)  # sha256 of model name, messages and sampling params
+    model_name = Column(String, nullable=False)
+    response = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class LLMResponseCache:
+    """
+    Content-addressed, two-tier cache for LLM responses.
+
+    The first tier is an in-process LRU bounded by size and TTL. The second tier is the
+    `llm_response_cache` table, which survives restarts and is shared across workers.
+    """
+    def __init__(self, db_manager=None, max_size: int = 1024, ttl: float = 3600, persistent_ttl: Optional[float] = None):
+        """
+        Args:
+            db_manager (DatabaseManager): Backs the persistent tier. When None only the memory tier is used.
+            max_size (int): Maximum number of entries kept in memory.
+            ttl (float): Seconds an entry stays in the memory tier.
+            persistent_ttl (float): Seconds an entry stays valid in the database, None for no expiry.
+        """
+        self.db_manager = db_manager
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persistent_ttl = persistent_ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.counters = {"memory_hits": 0, "persistent_hits": 0, "misses": 0, "writes": 0, "errors": 0}
+
+    @staticmethod
+    def make_key(model_name: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> str:
+        """Hash the model name, messages and sampling parameters into a cache key."""
+        material = json.dumps(
+            {"model": model_name, "messages": messages, "params": params},
+            sort_keys=True, ensure_ascii=False, separators=(",", ":"),
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        """Return the cached response for a key, promoting persistent hits into memory."""
+        value, outcome = await self._lookup(key)
+        self.counters[outcome] += 1
+        return value
+
+    async def contains(self, key: str) -> bool:
+        """True if `get` would return a response for the key; not counted as a hit or miss."""
+        value, _ = await self._lookup(key)
+        return value is not None
+
+    async def _lookup(self, key: str):
+        """Return (response or None, the counter the lookup falls under)."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                return value, "memory_hits"
+            del self._entries[key]
+
+        if self.db_manager is not None:
+            try:
+                row = await self.db_manager.fetch_one(LLMCacheEntry, {"key": key})
+            except Exception as e:
+                self.counters["errors"] += 1
+                print(f"LLM cache read failed: {e}")
+                row = None
+            if row is not None and not self._is_expired(row):
+                self._remember(key, row.response)
+                return row.response, "persistent_hits"
+
+        return None, "misses"
+
+    async def set(self, key: str, model_name: str, value: str):
+        """Store a response in both tiers."""
+        self._remember(key, value)
+        self.counters["writes"] += 1
+        if self.db_manager is None:
+            return
+        try:
+            await self.db_manager.upsert(
+                LLMCacheEntry,
+                {"key": key, "model_name": model_name, "response": value, "created_at": func.now()},
+                index_elements=["key"],
+            )
+        except Exception as e:
+            # The memory tier already holds the value; a failed write only costs a future miss
+            self.counters["errors"] += 1
+            print(f"LLM cache write failed: {e}")
+
+    def invalidate(self, key: str):
+        """Drop a key from the memory tier."""
+        self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters plus the current memory tier size."""
+        lookups = self.counters["memory_hits"] + self.counters["persistent_hits"] + self.counters["misses"]
+        hits = lookups - self.counters["misses"]
+        return {
+            **self.counters,
+            "memory_entries": len(self._entries),
+            "hit_ratio": hits / lookups if lookups else 0.0,
+        }
+
+    def _remember(self, key: str, value: str):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _is_expired(self, row: LLMCacheEntry) -> bool:
+        if self.persistent_ttl is None or row.created_at is None:
+            return False
+        created_at = row.created_at
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        return time.time() - created_at.timestamp() > self.persistent_ttl
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key onto a single in-flight task.
+
+    The first caller for a key starts the work; callers arriving before it finishes await
+    the same result (or exception). A caller being cancelled does not cancel the shared task.
+    """
     def __init__(self):
-        pass
+        self._in_flight: Dict[Any, asyncio.Future] = {}
+
+    async def do(self, key, func):
+        """Run `func()` for the key unless a call for it is already in flight, and return its result."""
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    def in_flight(self) -> int:
+        """Number of keys currently being computed."""
+        return len(self._in_flight)
+
+    def _forget(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved in case every waiter was cancelled
+            task.exception()
+
+
+class LLM_Base:
+    """
+    Base class for LLM clients.
+
+    Subclasses implement `_generate`; `generate_response` normalises the prompt, serves
+    repeated prompts from the optional `LLMResponseCache` and coalesces concurrent
+    identical calls into one generation.
+    """
+    model_name = None
+
+    def __init__(self, cache: Optional[LLMResponseCache] = None):
+        self.cache = cache
+        self.single_flight = SingleFlight()
+
+    @staticmethod
+    def to_messages(prompt: Union[str, List[Dict[str, str]]]) -> List[Dict[str, str]]:
+        """Convert a string or message-list prompt into chat messages."""
+        if isinstance(prompt, str):
+            # Convert string prompt to message format
+            return [{"role": "user", "content": prompt}]
+        elif isinstance(prompt, list) and all(isinstance(msg, dict) for msg in prompt):
+            # Ensure the message format is correct
+            return prompt
+        raise ValueError("Prompt must be a string or a list of message dictionaries.")
 
-    async def generate_response(self):
+    async def generate_response(
+        self,
+        prompt: Union[str, List[Dict[str, str]]],
+        temperature: float = 0.5,
+        max_tokens: int = 2048,
+        top_p: float = 0.9,
+        bypass_cache: bool = False,
+        **kwargs,
+    ) -> str:
+        """
+        Generate a response, consulting the cache first.
+        Args:
+            prompt (Union[str, List[Dict[str, str]]]): Input prompt as a string or a message list.
+            temperature (float): Sampling temperature.
+            max_tokens (int): Maximum number of tokens in the output.
+            top_p (float): Top-p (nucleus) sampling parameter.
+            bypass_cache (bool): Skip the cache lookup and force a fresh generation; the
+                new response still replaces the cached one.
+        Returns:
+            str: Model's response.
+        """
+        messages = self.to_messages(prompt)
+        params = {"temperature": temperature, "max_tokens": max_tokens, "top_p": top_p}
+        model_name = self.model_name or type(self).__name__
+        key = LLMResponseCache.make_key(model_name, messages, params)
+
+        async def generate():
+            if self.cache is not None and not bypass_cache:
+                cached = await self.cache.get(key)
+                if cached is not None:
+                    return cached
+            response = await self._generate(messages, **params, **kwargs)
+            if self.cache is not None:
+                await self.cache.set(key, model_name, response)
+            return response
+
+        # Forced regenerations only coalesce with each other, never with a cached read
+        return await self.single_flight.do((key, bypass_cache), generate)
+
+    async def is_cached(
+        self,
+        prompt: Union[str, List[Dict[str, str]]],
+        temperature: float = 0.5,
+        max_tokens: int = 2048,
+        top_p: float = 0.9,
+    ) -> bool:
+        """True if `generate_response` with these arguments would be answered from the cache."""
+        if self.cache is None:
+            return False
+        params = {"temperature": temperature, "max_tokens": max_tokens, "top_p": top_p}
+        model_name = self.model_name or type(self).__name__
+        return await self.cache.contains(LLMResponseCache.make_key(model_name, self.to_messages(prompt), params))
+
+    async def stream_response(
+        self,
+        prompt: Union[str, List[Dict[str, str]]],
+        temperature: float = 0.5,
+        max_tokens: int = 2048,
+        top_p: float = 0.9,
+        bypass_cache: bool = False,
+        **kwargs,
+    ) -> AsyncIterator[str]:
+        """
+        Generate a response as an async iterator of text chunks.
+
+        A cached response is yielded in one chunk; a fresh one is cached once the stream completes.
+        Arguments match `generate_response`.
+        """
+        messages = self.to_messages(prompt)
+        params = {"temperature": temperature, "max_tokens": max_tokens, "top_p": top_p}
+        model_name = self.model_name or type(self).__name__
+        key = LLMResponseCache.make_key(model_name, messages, params)
+        if self.cache is not None and not bypass_cache:
+            cached = await self.cache.get(key)
+            if cached is not None:
+                yield cached
+                return
+
+        parts = []
+        async for chunk in self._stream(messages, **params, **kwargs):
+            parts.append(chunk)
+            yield chunk
+        if self.cache is not None:
+            await self.cache.set(key, model_name, "".join(parts))
+
+    async def _generate(self, messages: List[Dict[str, str]], temperature: float, max_tokens: int, top_p: float, **kwargs) -> str:
         raise NotImplementedError("Subclasses must implement this method.")
 
+    async def _stream(self, messages: List[Dict[str, str]], temperature: float, max_tokens: int, top_p: float, **kwargs) -> AsyncIterator[str]:
+        """Yield the response in chunks; backends without streaming yield it whole."""
+        yield await self._generate(messages, temperature=temperature, max_tokens=max_tokens, top_p=top_p, **kwargs)
+
 
 class HuggingFaceModel(LLM_Base):
     """
     Utility class to interact with Hugging Face Inference API asynchronously.
+
+    Requests go through a shared ``httpx.AsyncClient`` so connections to the provider are
+    kept alive and reused, and never block the event loop. The client (and httpx itself) is
+    only loaded on first use or by `warm_up`, so constructing the model is free and does not
+    require the API key to be set yet.
     """
-    def __init__(self, model_name: str, api_key_env_var: str = "HUGGINGFACE_API_KEY"):
+    DEFAULT_BASE_URL = "https://api-inference.huggingface.co/models/{model_name}"
+    _instances = weakref.WeakSet()
+
+    def __init__(
+        self,
+        model_name: str,
+        api_key_env_var: Optional[str] = "HUGGINGFACE_API_KEY",
+        base_url: Optional[str] = None,
+        timeout: Optional[float] = None,
+        max_concurrency: Optional[int] = None,
+        max_connections: Optional[int] = None,
+        cache: Optional[LLMResponseCache] = None,
+    ):
         """
         Initialize the Hugging Face model utility.
         Args:
             model_name (str): Name of the Hugging Face model to use.
-            api_key_env_var (str): Environment variable containing the API key.
+            api_key_env_var (str): Environment variable containing the API key; None for
+                endpoints that need no authentication, such as a local server.
+            base_url (str): Base URL of an OpenAI-compatible chat-completions API.
+                Defaults to `HUGGINGFACE_BASE_URL` or the Hugging Face Inference API.
+            timeout (float): Default per-call timeout in seconds (`LLM_TIMEOUT`, default 60).
+            max_concurrency (int): Maximum in-flight calls (`LLM_MAX_CONCURRENCY`, default 8).
+            max_connections (int): Size of the keep-alive connection pool (defaults to max_concurrency).
+            cache (LLMResponseCache): Optional response cache.
         """
+        super().__init__(cache=cache)
         self.model_name = model_name
-        self.api_key = os.getenv(api_key_env_var)
-        if not self.api_key:
-            raise ValueError(f"API key not found in environment variable: {api_key_env_var}")
-        self.client = InferenceClient(api_key=self.api_key)
+        self.api_key_env_var = api_key_env_var
+        self.api_key = os.getenv(api_key_env_var) if api_key_env_var else None
+        base_url = base_url or os.getenv("HUGGINGFACE_BASE_URL") or self.DEFAULT_BASE_URL
+        self.base_url = base_url.format(model_name=model_name).rstrip("/")
+        self.timeout = timeout if timeout is not None else float(os.getenv("LLM_TIMEOUT", 60))
+        self.max_concurrency = max_concurrency or int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+        self.max_connections = max_connections or self.max_concurrency
+        self._client: Optional["httpx.AsyncClient"] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        HuggingFaceModel._instances.add(self)
 
-    async def generate_response(
+    def _after_fork(self):
+        """Drop the parent's client, semaphore and in-flight calls; the child builds its own on first use."""
+        self._client = None
+        self._semaphore = None
+        self.single_flight = SingleFlight()
+
+    @property
+    def client(self) -> "httpx.AsyncClient":
+        """Shared keep-alive HTTP client, created on first use inside the running loop."""
+        if self._client is None or self._client.is_closed:
+            import httpx
+
+            headers = {}
+            if self.api_key_env_var is not None:
+                self.api_key = self.api_key or os.getenv(self.api_key_env_var)
+                if not self.api_key:
+                    raise ValueError(f"API key not found in environment variable: {self.api_key_env_var}")
+                headers["Authorization"] = f"Bearer {self.api_key}"
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=headers,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return self._client
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        """Concurrency cap shared by every call made through this instance."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def warm_up(self):
+        """
+        Build the client and open a keep-alive connection to the provider ahead of the first call.
+
+        Failures are only reported: the first real call simply connects on its own.
+        """
+        try:
+            await self.client.head("/")
+        except Exception as e:
+            print(f"LLM warm-up failed: {e}")
+
+    async def aclose(self):
+        """Close the pooled HTTP connections."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _generate(
         self, 
-        prompt: Union[str, List[Dict[str, str]]], 
+        messages: List[Dict[str, str]], 
         temperature: float = 0.5, 
         max_tokens: int = 2048, 
-        top_p: float = 0.9
+        top_p: float = 0.9,
+        timeout: Optional[float] = None,
     ) -> str:
         """
         Generate a response from the Hugging Face model.
         Args:
-            prompt (Union[str, List[Dict[str, str]]]): Input prompt as a string or a message list.
-                - String: A simple query, e.g., "What is AI?"
-                - Message list: List of dictionaries with roles and content, e.g.,
-                  [{"role": "user", "content": "Tell me about AI."}]
+            messages (List[Dict[str, str]]): Chat messages with roles and content, e.g.,
+                [{"role": "user", "content": "Tell me about AI."}]
             temperature (float): Sampling temperature.
             max_tokens (int): Maximum number of tokens in the output.
             top_p (float): Top-p (nucleus) sampling parameter.
+            timeout (float): Timeout for this call in seconds, overriding the default.
         Returns:
             str: Model's response.
         """
-        if isinstance(prompt, str):
-            # Convert string prompt to message format
-            messages = [{"role": "user", "content": prompt}]
-        elif isinstance(prompt, list) and all(isinstance(msg, dict) for msg in prompt):
-            # Ensure the message format is correct
-            messages = prompt
-        else:
-            raise ValueError("Prompt must be a string or a list of message dictionaries.")
-        
+        payload = {
+            "model": self.model_name,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "top_p": top_p,
+        }
         try:
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                top_p=top_p
-            )
-            return response.choices[0].message.content
+            async with self.semaphore:
+                response = await self.client.post(
+                    "/v1/chat/completions",
+                    json=payload,
+                    timeout=timeout if timeout is not None else self.timeout,
+                )
+            response.raise_for_status()
+            return response.json()["choices"][0]["message"]["content"]
+        except Exception as e:
+            raise RuntimeError(f"Error while generating response: {e}")
+
+    async def _stream(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float = 0.5,
+        max_tokens: int = 2048,
+        top_p: float = 0.9,
+        timeout: Optional[float] = None,
+    ) -> AsyncIterator[str]:
+        """Stream response tokens from the chat-completions endpoint's server-sent events."""
+        payload = {
+            "model": self.model_name,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "top_p": top_p,
+            "stream": True,
+        }
+        try:
+            async with self.semaphore:
+                async with self.client.stream(
+                    "POST",
+                    "/v1/chat/completions",
+                    json=payload,
+                    timeout=timeout if timeout is not None else self.timeout,
+                ) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data == "[DONE]":
+                            break
+                        choices = json.loads(data).get("choices") or [{}]
+                        token = (choices[0].get("delta") or {}).get("content")
+                        if token:
+                            yield token
         except Exception as e:
             raise RuntimeError(f"Error while generating response: {e}")
 
+
+def _reset_after_fork():
+    for model in list(HuggingFaceModel._instances):
+        model._after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 # Testing the async function
 async def main():
     model_name = "meta-llama/Llama-3.2-3B-Instruct"
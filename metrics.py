@@ -0,0 +1,272 @@
+"""
+In-process metrics with Prometheus text exposition, plus SQLAlchemy engine instrumentation.
+
+`instrument_engine` hooks the engine's cursor and pool events to record query counts and
+durations, pool checkout waits and connections in use. Queries are also attributed to the
+current request through `RequestStats`, which flags N+1 patterns: the same statement
+executed many times while serving one request.
+"""
+import asyncio
+import bisect
+import contextvars
+import re
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple, object] = {}
+
+    def _key(self, labels: Dict[str, object]) -> Tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._values.items(), key=lambda item: tuple(map(str, item[0]))):
+            lines += self._samples(key, value)
+        return lines
+
+    def _samples(self, key: Tuple, value) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """A monotonically increasing total."""
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """A value that can go up and down."""
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, with their sum and count."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Per-bucket counts (the last one is +Inf), then sum
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def _samples(self, key: Tuple, state) -> List[str]:
+        counts, total = state
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = f'le="{_format_value(float(bound))}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+        labels = _format_labels(self.labels, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Holds metrics and scrape-time collectors and renders them in Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, float]]]] = []
+
+    def counter(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def add_collector(self, collect: Callable[[], Iterable[Tuple[str, str, float]]]):
+        """Register a callable returning `(name, help, value)` gauges, evaluated on every scrape."""
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        for collect in self._collectors:
+            try:
+                samples = list(collect())
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+                continue
+            for name, documentation, value in samples:
+                lines += [f"# HELP {name} {documentation}", f"# TYPE {name} gauge", f"{name} {_format_value(value)}"]
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric) or existing.labels != metric.labels:
+                raise ValueError(f"Metric {metric.name} is already registered differently")
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+
+registry = Registry()
+
+db_queries = registry.counter("db_queries_total", "SQL statements executed.", ["operation"])
+db_query_seconds = registry.histogram("db_query_duration_seconds", "SQL statement execution time.", ["operation"])
+db_query_errors = registry.counter("db_query_errors_total", "SQL statements that raised an error.", ["operation"])
+db_pool_wait_seconds = registry.histogram("db_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection.")
+db_pool_in_use = registry.gauge("db_pool_connections_in_use", "Connections currently checked out of the pool.")
+db_n_plus_one = registry.counter(
+    "db_n_plus_one_warnings_total", "Requests that repeated one statement past the N+1 threshold.", ["route"]
+)
+
+_OPERATION = re.compile(r"\s*(\w+)")
+
+
+def statement_operation(statement: str) -> str:
+    """The leading SQL keyword of a statement, e.g. "select"."""
+    match = _OPERATION.match(statement)
+    return match.group(1).lower() if match else "other"
+
+
+class RequestStats:
+    """Queries issued while serving one request."""
+
+    def __init__(self, route: str, n_plus_one_threshold: int = 10):
+        self.route = route
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.statements: Dict[str, int] = {}
+        self.repeated: List[str] = []
+
+    def record(self, statement: str, seconds: float):
+        self.queries += 1
+        self.query_seconds += seconds
+        count = self.statements.get(statement, 0) + 1
+        self.statements[statement] = count
+        if count == self.n_plus_one_threshold:
+            self.repeated.append(statement)
+            db_n_plus_one.inc(route=self.route)
+            print(f"Possible N+1 query on {self.route}: statement ran {count} times: {' '.join(statement.split())[:200]}")
+
+
+current_request_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "current_request_stats", default=None
+)
+
+
+def start_background_task(coro) -> asyncio.Task:
+    """
+    Run `coro` in a task whose queries are not charged to the current request.
+
+    Tasks inherit the context they are created in, so a fire-and-forget refresh started while
+    serving a request would otherwise add its statements to that request's stats.
+    """
+    context = contextvars.copy_context()
+    context.run(current_request_stats.set, None)
+    return asyncio.get_running_loop().create_task(coro, context=context)
+
+
+def instrument_engine(engine):
+    """Attach query, error and pool metrics to an (async or sync) SQLAlchemy engine."""
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        operation = statement_operation(statement)
+        db_queries.inc(operation=operation)
+        db_query_seconds.observe(elapsed, operation=operation)
+        stats = current_request_stats.get()
+        if stats is not None:
+            stats.record(statement, elapsed)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        start = context.connection.info.get("query_start") if context.connection is not None else None
+        if start:
+            start.pop()
+        db_query_errors.inc(operation=statement_operation(context.statement or ""))
+
+    @event.listens_for(sync_engine.pool, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        db_pool_in_use.inc()
+
+    @event.listens_for(sync_engine.pool, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        db_pool_in_use.dec()
+
+    return engine
+
+
+def timed_pool(pool_class):
+    """Subclass `pool_class` so that waiting for a free connection is recorded in `db_pool_wait_seconds`."""
+
+    class TimedPool(pool_class):
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                db_pool_wait_seconds.observe(time.perf_counter() - start)
+
+    TimedPool.__name__ = f"Timed{pool_class.__name__}"
+    return TimedPool
@@ -0,0 +1,253 @@
+"""
+Versioned schema migrations.
+
+Each migration is a synchronous function run on a SQLAlchemy connection inside its own
+transaction; applied versions are recorded in `schema_migrations`. Migrations must be
+idempotent so that databases created before versioning existed can be brought up to date.
+
+    python migrations.py                   # apply pending migrations
+    python migrations.py --list            # show applied and pending migrations
+    python migrations.py --dedupe-reviews  # data cleanup that migration 4 may ask for
+
+Migrations describe the schema as it was when they were written (see `baseline_metadata`),
+not the current models, so that applying version N always produces the same DDL.
+"""
+import argparse
+import asyncio
+
+from sqlalchemy import (
+    Boolean, Column, DateTime, Float, ForeignKey, Integer, MetaData, String, Table, Text, func, inspect, select,
+    text,
+)
+
+from models import (
+    BookRatingStats, backfill_rating_stats, install_book_search, install_sqlite_book_search,
+    SQLITE_BOOK_SEARCH_UPDATE_TRIGGER,
+)
+
+migration_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    migration_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+)
+
+# Arbitrary key for the PostgreSQL advisory lock that serialises concurrent migrators
+MIGRATION_LOCK_ID = 0x5B00C
+
+
+# The schema of databases created before versioning existed, frozen; never edit it to follow the models
+baseline_metadata = MetaData()
+Table(
+    "users",
+    baseline_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("username", String, nullable=False, unique=True),
+    Column("password_hash", String, nullable=False),
+    Column("email", String, nullable=False),
+    Column("full_name", String, nullable=False),
+    Column("is_admin", Boolean),
+)
+Table(
+    "books",
+    baseline_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("title", String, nullable=False),
+    Column("author", String, nullable=False),
+    Column("genre", String, nullable=False),
+    Column("year_published", Integer),
+    Column("summary", String),
+)
+Table(
+    "reviews",
+    baseline_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("book_id", Integer, ForeignKey("books.id", ondelete="CASCADE"), nullable=False),
+    Column("user_id", Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+    Column("review_text", String),
+    Column("rating", Float, nullable=False),
+)
+Table(
+    "book_rating_stats",
+    baseline_metadata,
+    Column("book_id", Integer, ForeignKey("books.id", ondelete="CASCADE"), primary_key=True),
+    Column("review_count", Integer, nullable=False),
+    Column("rating_sum", Float, nullable=False),
+    Column("rating_min", Float),
+    Column("rating_max", Float),
+    *(Column(f"stars_{stars}", Integer, nullable=False) for stars in range(1, 6)),
+)
+Table(
+    "summary_jobs",
+    baseline_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("book_id", Integer, ForeignKey("books.id", ondelete="CASCADE"), nullable=False),
+    Column("batch_id", String(36), index=True),
+    Column("status", String, nullable=False, index=True),
+    Column("regenerate", Boolean, nullable=False),
+    Column("attempts", Integer, nullable=False),
+    Column("max_attempts", Integer, nullable=False),
+    Column("last_error", String),
+    Column("run_after", DateTime(timezone=True), nullable=False),
+    Column("created_at", DateTime(timezone=True), nullable=False),
+    Column("updated_at", DateTime(timezone=True), nullable=False),
+)
+Table(
+    "llm_response_cache",
+    baseline_metadata,
+    Column("key", String(64), primary_key=True),
+    Column("model_name", String, nullable=False),
+    Column("response", Text, nullable=False),
+    Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+)
+
+HOT_PATH_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_books_author ON books (author)",
+    "CREATE INDEX IF NOT EXISTS ix_books_genre ON books (genre)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_reviews_user_book ON reviews (user_id, book_id)",
+    "CREATE INDEX IF NOT EXISTS ix_reviews_book_rating ON reviews (book_id, rating)",
+    "CREATE INDEX IF NOT EXISTS ix_summary_jobs_status_run_after ON summary_jobs (status, run_after)",
+)
+SUPERSEDED_REVIEWS = "FROM reviews WHERE id NOT IN (SELECT max(id) FROM reviews GROUP BY user_id, book_id)"
+
+
+def create_baseline_schema(connection):
+    """Create the baseline tables that do not exist yet."""
+    baseline_metadata.create_all(connection)
+
+
+def add_hot_path_indexes(connection):
+    """Index reviews by book and user (one review per user and book), books by author and genre, and due jobs."""
+    duplicates = connection.execute(text(
+        "SELECT user_id, book_id, count(*) FROM reviews GROUP BY user_id, book_id HAVING count(*) > 1 "
+        "ORDER BY user_id, book_id"
+    )).all()
+    if duplicates:
+        listed = ", ".join(f"user {user_id} book {book_id} ({count} reviews)" for user_id, book_id, count in duplicates[:20])
+        more = f" and {len(duplicates) - 20} more" if len(duplicates) > 20 else ""
+        raise RuntimeError(
+            f"Cannot add the one-review-per-user-and-book index: {len(duplicates)} user/book pairs have several "
+            f"reviews: {listed}{more}. Resolve them, or run `python migrations.py --dedupe-reviews` to keep each "
+            f"pair's latest review, then migrate again."
+        )
+
+    connection.execute(text("DROP INDEX IF EXISTS ix_summary_jobs_status"))
+    for statement in HOT_PATH_INDEXES:
+        connection.execute(text(statement))
+
+
+def dedupe_reviews(connection) -> int:
+    """Delete every review but the latest of each user and book, rebuild the rating aggregates and return the count."""
+    removed = connection.execute(text(f"SELECT count(*) {SUPERSEDED_REVIEWS}")).scalar()
+    if removed:
+        connection.execute(text(f"DELETE {SUPERSEDED_REVIEWS}"))
+        connection.execute(BookRatingStats.__table__.delete())
+        backfill_rating_stats(connection)
+    return removed
+
+
+def add_book_versions(connection):
+    """Add the version columns behind book and review ETags; on SQLite, reindex search only when indexed columns change."""
+    existing = {column["name"] for column in inspect(connection).get_columns("books")}
+    if connection.dialect.name == "sqlite":
+        # SQLite cannot add a column with a non-constant default, so existing rows are stamped afterwards
+        updated_at = "updated_at DATETIME NOT NULL DEFAULT '1970-01-01 00:00:00'"
+    else:
+        updated_at = "updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()"
+    columns = (
+        ("version", "version INTEGER NOT NULL DEFAULT 1"),
+        ("updated_at", updated_at),
+        ("reviews_version", "reviews_version INTEGER NOT NULL DEFAULT 0"),
+    )
+    for name, ddl in columns:
+        if name not in existing:
+            connection.execute(text(f"ALTER TABLE books ADD COLUMN {ddl}"))
+    if connection.dialect.name == "sqlite":
+        if "updated_at" not in existing:
+            connection.execute(text("UPDATE books SET updated_at = CURRENT_TIMESTAMP"))
+        connection.execute(text("DROP TRIGGER IF EXISTS books_fts_update"))
+        connection.execute(text(SQLITE_BOOK_SEARCH_UPDATE_TRIGGER))
+
+
+MIGRATIONS = (
+    (1, "baseline schema", create_baseline_schema),
+    (2, "backfill book rating aggregates", backfill_rating_stats),
+    (3, "book full-text search column and indexes", install_book_search),
+    (4, "hot path indexes", add_hot_path_indexes),
+    (5, "book full-text search index for SQLite", install_sqlite_book_search),
+    (6, "book and review versions for conditional requests", add_book_versions),
+)
+
+
+async def migrate(db_manager, target=None):
+    """Apply pending migrations in order, up to `target` if given. Returns the versions applied."""
+    async with db_manager.engine.begin() as conn:
+        await conn.run_sync(migration_metadata.create_all)
+
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        async with db_manager.engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+            done = await conn.scalar(
+                select(schema_migrations.c.version).where(schema_migrations.c.version == version)
+            )
+            if done is not None:
+                continue
+            print(f"Applying migration {version}: {description}")
+            await conn.run_sync(migration)
+            await conn.execute(schema_migrations.insert().values(version=version, description=description))
+            applied.append(version)
+    return applied
+
+
+async def migration_status(db_manager):
+    """Return (version, description, applied_at or None) for every known migration."""
+    async with db_manager.engine.begin() as conn:
+        await conn.run_sync(migration_metadata.create_all)
+        rows = (await conn.execute(select(schema_migrations.c.version, schema_migrations.c.applied_at))).all()
+    applied = dict(rows)
+    return [(version, description, applied.get(version)) for version, description, _ in MIGRATIONS]
+
+
+async def pending_migrations(db_manager):
+    """Return the versions that have not been applied yet."""
+    return [version for version, _, applied_at in await migration_status(db_manager) if applied_at is None]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply database schema migrations.")
+    parser.add_argument("--list", action="store_true", help="Show migration status instead of migrating")
+    parser.add_argument("--target", type=int, help="Stop after this version")
+    parser.add_argument(
+        "--dedupe-reviews", action="store_true",
+        help="Delete all but each user's latest review of a book (needed before migration 4 if there are duplicates)",
+    )
+    args = parser.parse_args(argv)
+
+    from db_utils import db_manager
+
+    async def run():
+        try:
+            if args.dedupe_reviews:
+                async with db_manager.engine.begin() as conn:
+                    removed = await conn.run_sync(dedupe_reviews)
+                print(f"Removed {removed} superseded duplicate review(s)")
+            elif args.list:
+                for version, description, applied_at in await migration_status(db_manager):
+                    print(f"{version:>4}  {'applied ' + str(applied_at) if applied_at else 'pending':<40}  {description}")
+            else:
+                applied = await migrate(db_manager, args.target)
+                print(f"Applied {len(applied)} migration(s)")
+        finally:
+            await db_manager.engine.dispose()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
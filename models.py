@@ -1,11 +1,14 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Float, Boolean
-from sqlalchemy.orm import relationship, validates
+from sqlalchemy import Column, Integer, String, ForeignKey, Float, Boolean, DateTime, Index, event, update, insert, select, case, or_, and_, func, inspect, cast, literal_column, text
+from sqlalchemy.orm import relationship, validates, Session
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from werkzeug.security import generate_password_hash, check_password_hash
 import re
-from llm_utils import LLM_Base
+import base64
+import json
+from datetime import datetime, timezone
+from llm_utils import LLM_Base, SingleFlight
 from db_utils import DatabaseManager
-from base import BaseModel
+from base import BaseModel, compile_serializer
 
 
 class User(BaseModel):
@@ -46,8 +49,20 @@ class User(BaseModel):
             raise ValueError("Invalid email format.")
         return email
 
+# Concurrent summary generations for the same book share one LLM call and one write
+summary_generations = SingleFlight()
+
+
 class Book(BaseModel):
     __tablename__ = "books"  # Explicitly declare table name
+    __table_args__ = (
+        Index("ix_books_author", "author"),
+        Index("ix_books_genre", "genre"),
+    )
+    # Read back the version and timestamp the UPDATE generated instead of expiring them
+    __mapper_args__ = {"eager_defaults": True}
+    # Served as ETag and Last-Modified headers, not in the JSON
+    _internal_columns = ("version", "updated_at", "reviews_version")
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     title = Column(String, nullable=False)
@@ -55,9 +70,16 @@ class Book(BaseModel):
     genre = Column(String, nullable=False)
     year_published = Column(Integer)
     summary = Column(String)  # This can be generated by LLM
+    # Bumped by every UPDATE of the row (ORM flush, bulk update or Core), for ETags and Last-Modified
+    version = Column(Integer, nullable=False, default=1, server_default=text("1"), onupdate=literal_column("version") + 1)
+    updated_at = Column(DateTime(timezone=True), nullable=False, default=func.now(), server_default=func.now(), onupdate=func.now())
+    # Bumped whenever one of the book's reviews is added, changed or deleted (see _bump_reviews_version)
+    reviews_version = Column(Integer, nullable=False, default=0, server_default=text("0"))
 
     # Establish a relationship to reviews with cascading deletion
     reviews = relationship("Review", back_populates="book", cascade="all, delete-orphan")
+    # Incrementally maintained rating aggregate; load it with joinedload(Book.rating_stats)
+    rating_stats = relationship("BookRatingStats", uselist=False, viewonly=True, lazy="raise")
     
     def __init__(self, title, author, genre, year_published=None, summary=None):
         self.title = title
@@ -66,8 +88,150 @@ class Book(BaseModel):
         self.year_published = year_published
         self.summary = summary
 
-    async def generate_summary(self, llm_model: LLM_Base, db_manager: DatabaseManager):
-        """Generate a book summary using an LLM model and update the book record."""
+    @classmethod
+    def listing(cls, include_rating=False):
+        """
+        Core select and row serializer for book listings, matching `to_dict()`.
+
+        With `include_rating` each row also carries `average_rating` and `review_count` from an
+        outer join on the aggregate table. Both are built once and reused.
+        """
+        listings = cls.__dict__.get("_listings")
+        if listings is None:
+            listings = cls._listings = {}
+        if include_rating not in listings:
+            stmt = cls.row_query()
+            if include_rating:
+                books, stats = cls.__table__, BookRatingStats.__table__
+                stmt = stmt.add_columns(
+                    case((stats.c.review_count > 0, stats.c.rating_sum / stats.c.review_count), else_=0)
+                    .label("average_rating"),
+                    func.coalesce(stats.c.review_count, 0).label("review_count"),
+                ).select_from(books.outerjoin(stats, stats.c.book_id == books.c.id))
+            listings[include_rating] = (stmt, compile_serializer(stmt.selected_columns.keys()))
+        return listings[include_rating]
+
+    @classmethod
+    async def search(cls, db_manager: DatabaseManager, query: str, limit: int = 20, cursor: str = None):
+        """
+        Rank books against a full-text query, with typo-tolerant author matching.
+
+        Matches come from the `search_vector` GIN index (title, author, genre and summary,
+        weighted in that order) or from trigram similarity on the author. Results are
+        ordered by score and paginated with an opaque keyset cursor. On SQLite the
+        `books_fts` FTS5 index and a substring match on the author stand in for both.
+        Returns:
+            tuple: (list of book dicts with their score, cursor for the next page or None)
+        """
+        stmt = cls.search_query(db_manager.engine.dialect.name, query, limit, cursor)
+        result = await db_manager.execute(stmt)
+        rows = [dict(row._mapping) for row in result]
+        next_cursor = encode_search_cursor(rows[-1]["score"], rows[-1]["id"]) if len(rows) == limit else None
+        return rows, next_cursor
+
+    @classmethod
+    def search_query(cls, dialect_name: str, query: str, limit: int = 20, cursor: str = None):
+        """The statement behind `search` for a database dialect ("sqlite" or "postgresql")."""
+        if dialect_name == "sqlite":
+            ranked = cls._sqlite_search_query(query)
+        else:
+            ranked = cls._postgres_search_query(query)
+        stmt = select(ranked).order_by(ranked.c.score.desc(), ranked.c.id)
+        if cursor:
+            after_score, after_id = decode_search_cursor(cursor)
+            stmt = stmt.where(or_(
+                ranked.c.score < after_score,
+                and_(ranked.c.score == after_score, ranked.c.id > after_id),
+            ))
+        return stmt.limit(limit)
+
+    @classmethod
+    def versions_query(cls, book_id: int):
+        """A book's (version, reviews_version), the primary-key lookup behind every conditional read."""
+        return select(cls.version, cls.reviews_version).where(cls.id == book_id)
+
+    @classmethod
+    def _postgres_search_query(cls, query: str):
+        books = cls.__table__
+        search_vector = literal_column("books.search_vector")
+        tsquery = func.websearch_to_tsquery('english', query)
+        score = cast(
+            func.ts_rank_cd(search_vector, tsquery) + func.similarity(books.c.author, query), Float(precision=53)
+        ).label("score")
+        return (
+            select(books.c.id, books.c.title, books.c.author, books.c.genre, books.c.year_published,
+                   books.c.summary, score)
+            .where(or_(search_vector.op("@@")(tsquery), books.c.author.op("%")(query)))
+            .subquery()
+        )
+
+    @classmethod
+    def _sqlite_search_query(cls, query: str):
+        books = cls.__table__
+        author_match = books.c.author.like(f"%{query.strip()}%")
+        terms = re.findall(r"\w+", query)
+        if not terms:
+            score = case((author_match, 0.5), else_=0.0).label("score")
+            return (
+                select(books.c.id, books.c.title, books.c.author, books.c.genre, books.c.year_published,
+                       books.c.summary, score)
+                .where(author_match)
+                .subquery()
+            )
+        # Every term must match, each as a prefix; quoting keeps FTS5 operators out of user input
+        fts_query = " ".join(f'"{term}"*' for term in terms)
+        fts = literal_column("books_fts")
+        matches = (
+            select(literal_column("rowid").label("book_id"),
+                   (-func.bm25(fts, *SQLITE_SEARCH_WEIGHTS)).label("rank"))
+            .select_from(text("books_fts"))
+            .where(fts.op("MATCH")(fts_query))
+            .subquery()
+        )
+        score = cast(
+            func.coalesce(matches.c.rank, 0.0) + case((author_match, 0.5), else_=0.0), Float(precision=53)
+        ).label("score")
+        return (
+            select(books.c.id, books.c.title, books.c.author, books.c.genre, books.c.year_published,
+                   books.c.summary, score)
+            .select_from(books.outerjoin(matches, matches.c.book_id == books.c.id))
+            .where(or_(matches.c.book_id.is_not(None), author_match))
+            .subquery()
+        )
+
+    async def generate_summary(self, llm_model: LLM_Base, db_manager: DatabaseManager, regenerate: bool = False):
+        """
+        Generate a book summary using an LLM model and update the book record.
+
+        Identical prompts are answered from the model's response cache unless `regenerate` is set,
+        and concurrent calls for the same book await a single generation and database write.
+        """
+        self.summary = await summary_generations.do(
+            (self.id, regenerate), lambda: self._generate_and_save_summary(llm_model, db_manager, regenerate)
+        )
+        return self.summary
+
+    async def stream_summary(self, llm_model: LLM_Base, db_manager: DatabaseManager, regenerate: bool = False):
+        """Yield the summary as it is generated, saving it to the book record once complete."""
+        parts = []
+        async for chunk in llm_model.stream_response(self.summary_prompt(), bypass_cache=regenerate):
+            parts.append(chunk)
+            yield chunk
+        self.summary = "".join(parts)
+        await self._save_summary(db_manager)
+
+    async def _generate_and_save_summary(self, llm_model: LLM_Base, db_manager: DatabaseManager, regenerate: bool):
+        self.summary = await llm_model.generate_response(self.summary_prompt(), bypass_cache=regenerate)
+        await self._save_summary(db_manager)
+        return self.summary
+
+    async def _save_summary(self, db_manager: DatabaseManager):
+        # A single UPDATE: the book may be detached, and other columns may have changed since it was loaded
+        # RETURNING hands the id to the similar-books index without a lookup
+        await db_manager.execute(update(Book).where(Book.id == self.id).values(summary=self.summary).returning(Book.id))
+
+    def summary_prompt(self):
+        """Build the chat messages asking the LLM to summarize this book."""
         user_query = f"""Summarize following book: \n"""
         if self.title:
             user_query += f"title: {self.title}\n"
@@ -94,16 +258,16 @@ class Book(BaseModel):
                )
            }
         ]
-       
-               
-        self.summary = await llm_model.generate_response(prompt)
-        # Save or update the book record asynchronously
-        await db_manager.add_or_save(self)
-        
-        return self.summary
+        return prompt
 
 class Review(BaseModel):
     __tablename__ = "reviews"  # Explicitly declare table name
+    __table_args__ = (
+        # One review per user and book; also serves reviews-by-user lookups
+        Index("uq_reviews_user_book", "user_id", "book_id", unique=True),
+        # Reviews by book, and min/max rating rescans for the rating aggregate
+        Index("ix_reviews_book_rating", "book_id", "rating"),
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     book_id = Column(Integer, ForeignKey('books.id', ondelete="CASCADE"), nullable=False)
@@ -114,3 +278,330 @@ class Review(BaseModel):
     # Back-populate relationships
     book = relationship("Book", back_populates="reviews")
     user = relationship("User", back_populates="reviews")
+
+    @classmethod
+    def for_book(cls, book_id: int):
+        """Core select of a book's reviews, as served by GET /books/<id>/reviews."""
+        return cls.row_query().where(cls.book_id == book_id)
+
+    @staticmethod
+    def is_duplicate(error) -> bool:
+        """Whether an IntegrityError is the one-review-per-user-and-book index rejecting a second review."""
+        message = str(getattr(error, "orig", error))
+        # PostgreSQL names the index; SQLite names its columns
+        return "uq_reviews_user_book" in message or "reviews.user_id, reviews.book_id" in message
+
+    @classmethod
+    def favourite_pairs_query(cls, user_id: int):
+        """Distinct (author, genre) pairs of the books a user has reviewed."""
+        return (
+            select(Book.author, Book.genre)
+            .join(cls, cls.book_id == Book.id)
+            .where(cls.user_id == user_id)
+            .distinct()
+        )
+
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+class SummaryJob(BaseModel):
+    """Durable record of a background summary generation."""
+    __tablename__ = "summary_jobs"
+    # Due-job scans filter on status and order by run_after
+    __table_args__ = (Index("ix_summary_jobs_status_run_after", "status", "run_after"),)
+
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    book_id = Column(Integer, ForeignKey('books.id', ondelete="CASCADE"), nullable=False)
+    batch_id = Column(String(36), index=True)  # Set for jobs created by a bulk backfill
+    status = Column(String, nullable=False, default=PENDING)
+    regenerate = Column(Boolean, nullable=False, default=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    last_error = Column(String)
+    run_after = Column(DateTime(timezone=True), nullable=False, default=utcnow)  # Earliest time of the next attempt
+    created_at = Column(DateTime(timezone=True), nullable=False, default=utcnow)
+    updated_at = Column(DateTime(timezone=True), nullable=False, default=utcnow, onupdate=utcnow)
+
+
+# Full-text search support for books. The tsvector is a generated column, so it stays current
+# for every insert and update (ORM, set-based or COPY) without application code.
+BOOK_SEARCH_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "ALTER TABLE books ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(author, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(genre, '')), 'C') || "
+    "setweight(to_tsvector('english', coalesce(summary, '')), 'D')"
+    ") STORED",
+    "CREATE INDEX IF NOT EXISTS ix_books_search_vector ON books USING GIN (search_vector)",
+    "CREATE INDEX IF NOT EXISTS ix_books_author_trgm ON books USING GIN (author gin_trgm_ops)",
+)
+
+
+def install_book_search(connection):
+    """Add the search column and indexes to the books table (PostgreSQL only, idempotent)."""
+    if connection.dialect.name != "postgresql":
+        return
+    for statement in BOOK_SEARCH_DDL:
+        connection.execute(text(statement))
+
+
+# bm25 column weights for title, author, genre and summary, mirroring the tsvector weights
+SQLITE_SEARCH_WEIGHTS = (10.0, 5.0, 2.0, 1.0)
+# Only the indexed columns: version bumps from review writes must not reindex the book
+SQLITE_BOOK_SEARCH_UPDATE_TRIGGER = (
+    "CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author, genre, summary ON books BEGIN "
+    "INSERT INTO books_fts(books_fts, rowid, title, author, genre, summary) "
+    "VALUES ('delete', old.id, old.title, old.author, old.genre, old.summary); "
+    "INSERT INTO books_fts(rowid, title, author, genre, summary) "
+    "VALUES (new.id, new.title, new.author, new.genre, new.summary); END"
+)
+SQLITE_BOOK_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5("
+    "title, author, genre, summary, content='books', content_rowid='id', tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN "
+    "INSERT INTO books_fts(rowid, title, author, genre, summary) "
+    "VALUES (new.id, new.title, new.author, new.genre, new.summary); END",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN "
+    "INSERT INTO books_fts(books_fts, rowid, title, author, genre, summary) "
+    "VALUES ('delete', old.id, old.title, old.author, old.genre, old.summary); END",
+    SQLITE_BOOK_SEARCH_UPDATE_TRIGGER,
+    "INSERT INTO books_fts(books_fts) VALUES ('rebuild')",
+)
+
+
+def install_sqlite_book_search(connection):
+    """Create the FTS5 index over books and the triggers that keep it current (SQLite only, idempotent)."""
+    if connection.dialect.name != "sqlite":
+        return
+    for statement in SQLITE_BOOK_SEARCH_DDL:
+        connection.execute(text(statement))
+
+
+def encode_search_cursor(score, book_id):
+    return base64.urlsafe_b64encode(json.dumps([score, book_id]).encode()).decode()
+
+
+def decode_search_cursor(cursor):
+    """Decode a search cursor into (score, book_id); raises ValueError if it is malformed."""
+    try:
+        score, book_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(score), int(book_id)
+    except Exception:
+        raise ValueError("Invalid cursor.")
+
+
+STAR_BUCKETS = (1, 2, 3, 4, 5)
+
+
+def star_bucket(rating: float) -> int:
+    """Map a rating to the nearest whole star between 1 and 5."""
+    return min(5, max(1, int(rating + 0.5)))
+
+
+class BookRatingStats(BaseModel):
+    """Per-book rating aggregate kept up to date whenever reviews are flushed."""
+    __tablename__ = "book_rating_stats"
+
+    book_id = Column(Integer, ForeignKey('books.id', ondelete="CASCADE"), primary_key=True)
+    review_count = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Float, nullable=False, default=0)
+    rating_min = Column(Float)
+    rating_max = Column(Float)
+    stars_1 = Column(Integer, nullable=False, default=0)
+    stars_2 = Column(Integer, nullable=False, default=0)
+    stars_3 = Column(Integer, nullable=False, default=0)
+    stars_4 = Column(Integer, nullable=False, default=0)
+    stars_5 = Column(Integer, nullable=False, default=0)
+
+    @staticmethod
+    def describe(stats):
+        """Summarise an aggregate row (or its absence, for a book without reviews)."""
+        if stats is None or not stats.review_count:
+            return {
+                "average_rating": 0,
+                "review_count": 0,
+                "rating_min": None,
+                "rating_max": None,
+                "histogram": {str(star): 0 for star in STAR_BUCKETS},
+            }
+        return {
+            "average_rating": stats.rating_sum / stats.review_count,
+            "review_count": stats.review_count,
+            "rating_min": stats.rating_min,
+            "rating_max": stats.rating_max,
+            "histogram": {str(star): getattr(stats, f"stars_{star}") for star in STAR_BUCKETS},
+        }
+
+
+def _apply_rating_delta(connection, book_id, rating, added):
+    """Add or remove one rating from a book's aggregate row; returns the number of rows updated."""
+    stats = BookRatingStats.__table__
+    reviews = Review.__table__
+    star = stats.c[f"stars_{star_bucket(rating)}"]
+    if added:
+        values = {
+            stats.c.review_count: stats.c.review_count + 1,
+            stats.c.rating_sum: stats.c.rating_sum + rating,
+            stats.c.rating_min: case(
+                (or_(stats.c.rating_min.is_(None), stats.c.rating_min > rating), rating), else_=stats.c.rating_min
+            ),
+            stats.c.rating_max: case(
+                (or_(stats.c.rating_max.is_(None), stats.c.rating_max < rating), rating), else_=stats.c.rating_max
+            ),
+            star: star + 1,
+        }
+    else:
+        # Min/max cannot be decremented; rescan only when the removed rating was an extreme
+        remaining = reviews.c.book_id == book_id
+        values = {
+            stats.c.review_count: stats.c.review_count - 1,
+            stats.c.rating_sum: stats.c.rating_sum - rating,
+            stats.c.rating_min: case(
+                (stats.c.rating_min >= rating, select(func.min(reviews.c.rating)).where(remaining).scalar_subquery()),
+                else_=stats.c.rating_min,
+            ),
+            stats.c.rating_max: case(
+                (stats.c.rating_max <= rating, select(func.max(reviews.c.rating)).where(remaining).scalar_subquery()),
+                else_=stats.c.rating_max,
+            ),
+            star: star - 1,
+        }
+    result = connection.execute(update(stats).where(stats.c.book_id == book_id).values(values))
+    return result.rowcount
+
+
+def _create_rating_stats(connection, book_id):
+    """Insert an empty aggregate row for a book unless one exists, e.g. created by a concurrent first review."""
+    if connection.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    values = {"book_id": book_id, "review_count": 0, "rating_sum": 0}
+    values.update({f"stars_{star}": 0 for star in STAR_BUCKETS})
+    connection.execute(
+        dialect_insert(BookRatingStats.__table__).values(values).on_conflict_do_nothing(index_elements=["book_id"])
+    )
+
+
+def _rebuild_rating_stats(connection, book_id=None):
+    """
+    Insert aggregate rows computed from the reviews table.
+
+    With a `book_id` only that book is rebuilt (used after set-based review writes, which
+    delete its row first); without one, rows are backfilled for every reviewed book that lacks one.
+    """
+    stats = BookRatingStats.__table__
+    reviews = Review.__table__
+    bucket = case(
+        (reviews.c.rating < 1.5, 1),
+        (reviews.c.rating < 2.5, 2),
+        (reviews.c.rating < 3.5, 3),
+        (reviews.c.rating < 4.5, 4),
+        else_=5,
+    )
+    aggregate = select(
+        reviews.c.book_id,
+        func.count(reviews.c.id),
+        func.coalesce(func.sum(reviews.c.rating), 0),
+        func.min(reviews.c.rating),
+        func.max(reviews.c.rating),
+        *[func.coalesce(func.sum(case((bucket == star, 1), else_=0)), 0) for star in STAR_BUCKETS],
+    ).group_by(reviews.c.book_id)
+    if book_id is not None:
+        aggregate = aggregate.where(reviews.c.book_id == book_id)
+    else:
+        aggregate = aggregate.where(reviews.c.book_id.not_in(select(stats.c.book_id)))
+    columns = ["book_id", "review_count", "rating_sum", "rating_min", "rating_max"]
+    columns += [f"stars_{star}" for star in STAR_BUCKETS]
+    connection.execute(insert(stats).from_select(columns, aggregate))
+
+
+def _bump_reviews_version(connection, book_ids):
+    """Mark the reviews of these books as changed, leaving the books' own version alone."""
+    books = Book.__table__
+    connection.execute(
+        update(books).where(books.c.id.in_(book_ids))
+        # Naming version and updated_at keeps their onupdate defaults from firing
+        .values(reviews_version=books.c.reviews_version + 1, version=books.c.version, updated_at=books.c.updated_at)
+    )
+
+
+def backfill_rating_stats(connection):
+    """Create missing aggregate rows for books reviewed before `book_rating_stats` existed."""
+    _rebuild_rating_stats(connection)
+
+
+@event.listens_for(Session, "after_flush")
+def maintain_rating_stats(session, flush_context):
+    """Fold review inserts, rating/book changes and deletes into `book_rating_stats` within the same transaction."""
+    deleted_books = {obj.id for obj in session.deleted if isinstance(obj, Book)}
+    changes = {}  # book_id -> [(rating, added)]
+
+    for obj in session.new:
+        if isinstance(obj, Review):
+            changes.setdefault(obj.book_id, []).append((obj.rating, True))
+
+    for obj in session.dirty:
+        if not isinstance(obj, Review) or not session.is_modified(obj):
+            continue
+        state = inspect(obj)
+        rating_history = state.attrs.rating.history
+        book_history = state.attrs.book_id.history
+        if not (rating_history.deleted or book_history.deleted):
+            continue
+        old_rating = rating_history.deleted[0] if rating_history.deleted else obj.rating
+        old_book_id = book_history.deleted[0] if book_history.deleted else obj.book_id
+        changes.setdefault(old_book_id, []).append((old_rating, False))
+        changes.setdefault(obj.book_id, []).append((obj.rating, True))
+
+    for obj in session.deleted:
+        if isinstance(obj, Review) and obj.book_id not in deleted_books:
+            changes.setdefault(obj.book_id, []).append((obj.rating, False))
+
+    if not changes:
+        return
+    connection = session.connection()
+    _bump_reviews_version(connection, list(changes))
+    for book_id, deltas in changes.items():
+        for rating, added in deltas:
+            if not _apply_rating_delta(connection, book_id, rating, added):
+                # First review of the book. Two of them at once would both find no row, so create it
+                # with an upsert (the second waits for the first, then skips) and apply the delta to it
+                _create_rating_stats(connection, book_id)
+                _apply_rating_delta(connection, book_id, rating, added)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def maintain_rating_stats_for_bulk_writes(orm_execute_state):
+    """Set-based UPDATE/DELETE of reviews skip flush events, so rebuild the aggregates of every book they touch."""
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return None
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ is not Review:
+        return None
+    whereclause = orm_execute_state.statement.whereclause
+    affected = select(Review.book_id).distinct()
+    if whereclause is not None:
+        affected = affected.where(whereclause)
+    connection = orm_execute_state.session.connection()
+    book_ids = set(connection.execute(affected).scalars())
+    result = orm_execute_state.invoke_statement()
+    if orm_execute_state.is_update:
+        # Rows may have moved to other books
+        book_ids |= set(connection.execute(affected).scalars())
+    if book_ids:
+        _bump_reviews_version(connection, list(book_ids))
+    stats = BookRatingStats.__table__
+    for book_id in book_ids:
+        connection.execute(stats.delete().where(stats.c.book_id == book_id))
+        _rebuild_rating_stats(connection, book_id)
+    return result
@@ -0,0 +1,333 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from llm_utils import SingleFlight
+from metrics import start_background_task
+
+if TYPE_CHECKING:
+    # NumPy and SciPy take a large share of startup time, so they load with the first build
+    import numpy as np
+    from scipy import sparse
+
+# Ratings above this value pull similar books up, ratings below push them down
+NEUTRAL_RATING = 2.5
+
+
+class _Snapshot:
+    """Immutable matrices built from one read of the reviews table."""
+
+    def __init__(self, ratings: sparse.csr_matrix, similarity: sparse.csr_matrix, user_index: Dict[int, int],
+                 book_ids: np.ndarray, popularity: np.ndarray, built_at: float):
+        import numpy as np
+
+        self.ratings = ratings
+        self.similarity = similarity
+        self.user_index = user_index
+        self.book_ids = book_ids
+        self.popular_order = np.argsort(-popularity, kind="stable")
+        self.built_at = built_at
+
+
+class RecommendationEngine:
+    """
+    Item-item collaborative filtering over the `reviews` table.
+
+    The engine keeps a user x book rating matrix and a sparse book x book cosine similarity
+    matrix (pruned to each book's strongest neighbours). A user's candidates are their
+    centred ratings multiplied through the similarity matrix, so only books that exist in
+    the catalog are ever returned. Matrices are rebuilt off the event loop, either on a
+    schedule once reviews have changed or on demand.
+    """
+
+    def __init__(self, db_manager, refresh_interval: float = 300, neighbours: int = 50):
+        """
+        Args:
+            db_manager (DatabaseManager): Source of the reviews table.
+            refresh_interval (float): Seconds between background rebuilds when reviews changed.
+            neighbours (int): Similar books kept per book in the similarity matrix.
+        """
+        self.db_manager = db_manager
+        self.refresh_interval = refresh_interval
+        self.neighbours = neighbours
+        self._snapshot: Optional[_Snapshot] = None
+        self._dirty = True
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def mark_dirty(self):
+        """Flag that reviews changed so the next scheduled refresh rebuilds the matrices."""
+        self._dirty = True
+
+    async def refresh(self, force: bool = False):
+        """Rebuild the matrices from the reviews table if they are stale (or always, with `force`)."""
+        async with self._lock:
+            if not (force or self._dirty or self._snapshot is None):
+                return
+            self._dirty = False
+            result = await self.db_manager.execute_raw("SELECT user_id, book_id, rating FROM reviews")
+            rows = result.fetchall()
+            self._snapshot = await asyncio.to_thread(self._build, rows)
+
+    def start(self):
+        """Start the periodic background refresh."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        """Stop the periodic background refresh."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def recommend(self, user_id: int, limit: int = 10) -> List[Tuple[int, float]]:
+        """
+        Return up to `limit` (book_id, score) pairs the user has not reviewed yet, best first.
+
+        Users without usable history get the most reviewed books with a score of 0.
+        """
+        import numpy as np
+
+        if self._snapshot is None:
+            await self.refresh()
+        snapshot = self._snapshot
+        row = snapshot.user_index.get(user_id)
+        seen = np.zeros(len(snapshot.book_ids), dtype=bool)
+        picks: List[Tuple[int, float]] = []
+
+        if row is not None:
+            user_ratings = snapshot.ratings.getrow(row)
+            seen[user_ratings.indices] = True
+            weights = user_ratings.copy()
+            weights.data = weights.data - NEUTRAL_RATING
+            scores = np.asarray((weights @ snapshot.similarity).todense()).ravel()
+            scores[seen] = -np.inf
+            candidates = np.flatnonzero(scores > 0)
+            if len(candidates) > limit:
+                candidates = candidates[np.argpartition(-scores[candidates], limit)[:limit]]
+            candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+            picks = [(int(snapshot.book_ids[i]), float(scores[i])) for i in candidates]
+            seen[candidates] = True
+
+        # Fill the remainder with popular books the user has not seen
+        for i in snapshot.popular_order:
+            if len(picks) >= limit:
+                break
+            if not seen[i]:
+                picks.append((int(snapshot.book_ids[i]), 0.0))
+        return picks
+
+    def stats(self) -> Dict[str, float]:
+        """Size and age of the current snapshot."""
+        snapshot = self._snapshot
+        if snapshot is None:
+            return {"built": False}
+        return {
+            "built": True,
+            "users": len(snapshot.user_index),
+            "books": len(snapshot.book_ids),
+            "similarity_entries": int(snapshot.similarity.nnz),
+            "age_seconds": time.time() - snapshot.built_at,
+            "dirty": self._dirty,
+        }
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                # Keep serving the previous snapshot and retry on the next tick
+                self._dirty = True
+                print(f"Recommendation refresh failed: {e}")
+
+    def _build(self, rows) -> _Snapshot:
+        import numpy as np
+        from scipy import sparse
+
+        if not rows:
+            empty = sparse.csr_matrix((0, 0))
+            return _Snapshot(empty, empty, {}, np.array([], dtype=np.int64), np.array([]), time.time())
+
+        data = np.array(rows, dtype=np.float64)
+        user_ids, user_rows = np.unique(data[:, 0].astype(np.int64), return_inverse=True)
+        book_ids, book_cols = np.unique(data[:, 1].astype(np.int64), return_inverse=True)
+        ratings = sparse.csr_matrix(
+            (data[:, 2], (user_rows, book_cols)), shape=(len(user_ids), len(book_ids))
+        )
+
+        # Cosine similarity between book columns
+        norms = np.sqrt(np.asarray(ratings.multiply(ratings).sum(axis=0)).ravel())
+        norms[norms == 0] = 1.0
+        normalized = ratings @ sparse.diags(1.0 / norms)
+        similarity = (normalized.T @ normalized).tocsr()
+        similarity.setdiag(0)
+        similarity.eliminate_zeros()
+        similarity = self._keep_top_neighbours(similarity, self.neighbours)
+
+        popularity = np.diff(ratings.tocsc().indptr)
+        user_index = {int(user_id): i for i, user_id in enumerate(user_ids)}
+        return _Snapshot(ratings, similarity, user_index, book_ids, popularity, time.time())
+
+    @staticmethod
+    def _keep_top_neighbours(matrix: sparse.csr_matrix, k: int) -> sparse.csr_matrix:
+        """Zero all but the `k` largest entries of each row."""
+        import numpy as np
+
+        keep = np.zeros(len(matrix.data), dtype=bool)
+        for i in range(matrix.shape[0]):
+            start, end = matrix.indptr[i], matrix.indptr[i + 1]
+            if end - start <= k:
+                keep[start:end] = True
+            else:
+                keep[start + np.argpartition(matrix.data[start:end], -k)[-k:]] = True
+        matrix.data[~keep] = 0
+        matrix.eliminate_zeros()
+        return matrix
+
+
+class _UserRecommendations:
+    """Cached responses for one user plus the author/genre set they were built from."""
+
+    def __init__(self, pairs: frozenset, created_at: float):
+        self.pairs = pairs
+        self.fingerprint = RecommendationCache.fingerprint(pairs)
+        self.created_at = created_at
+        self.stale = False
+        self.responses: Dict[tuple, dict] = {}
+
+
+class RecommendationCache:
+    """
+    Per-user cache of recommendation responses.
+
+    Each entry stores the fingerprint of the (author, genre) set it was built from and is only
+    invalidated when a new review adds a pair outside that set. In stale-while-revalidate mode
+    an invalidated entry keeps being served while a background task rebuilds it.
+    """
+
+    def __init__(self, max_users: int = 10000, max_age: float = 3600, stale_while_revalidate: bool = True):
+        """
+        Args:
+            max_users (int): Maximum number of users kept, least recently used evicted first.
+            max_age (float): Seconds after which an entry is rebuilt regardless of reviews.
+            stale_while_revalidate (bool): Serve invalidated entries while they refresh in the background.
+        """
+        self.max_users = max_users
+        self.max_age = max_age
+        self.stale_while_revalidate = stale_while_revalidate
+        self._entries: "OrderedDict[int, _UserRecommendations]" = OrderedDict()
+        self._refreshes = SingleFlight()
+        self._background: set = set()
+        # Builds in flight and invalidations seen meanwhile, per user, only while a build is running
+        self._building: Dict[int, int] = {}
+        self._generations: Dict[int, int] = {}
+        self.counters = {"hits": 0, "stale_hits": 0, "misses": 0, "invalidations": 0}
+
+    @staticmethod
+    def fingerprint(pairs) -> str:
+        """Order-independent hash of a set of (author, genre) pairs."""
+        material = "\n".join(f"{author}\t{genre}" for author, genre in sorted(pairs))
+        return hashlib.sha1(material.encode("utf-8")).hexdigest()
+
+    async def get_or_build(self, user_id: int, variant: tuple, build, force: bool = False, background_build=None) -> dict:
+        """
+        Return the cached response for a user and variant (e.g. limit and flags), building it if needed.
+
+        `build` is an async callable returning `(pairs, payload)` where `pairs` is the user's
+        (author, genre) set. Concurrent builds for the same user and variant are coalesced.
+        Stale entries are refreshed in the background with `background_build` (default `build`),
+        which may return None to skip the refresh and keep serving the stale entry.
+        """
+        entry = self._entries.get(user_id)
+        if entry is not None and not force:
+            payload = entry.responses.get(variant)
+            expired = time.monotonic() - entry.created_at > self.max_age
+            if payload is not None and not entry.stale and not expired:
+                self._entries.move_to_end(user_id)
+                self.counters["hits"] += 1
+                return payload
+            if payload is not None and self.stale_while_revalidate:
+                self.counters["stale_hits"] += 1
+                self._refresh_in_background(user_id, variant, background_build or build)
+                return payload
+
+        self.counters["misses"] += 1
+        payload = await self._refreshes.do((user_id, variant), lambda: self._build(user_id, variant, build))
+        if payload is None:
+            # Joined a background refresh that was skipped; build for this caller after all
+            payload = await self._refreshes.do((user_id, variant), lambda: self._build(user_id, variant, build))
+        return payload
+
+    def is_cached(self, user_id: int, variant: tuple) -> bool:
+        """True if `get_or_build` would answer from the cache, fresh or stale, without building first."""
+        entry = self._entries.get(user_id)
+        if entry is None or entry.responses.get(variant) is None:
+            return False
+        fresh = not entry.stale and time.monotonic() - entry.created_at <= self.max_age
+        return fresh or self.stale_while_revalidate
+
+    def note_review(self, user_id: int, author: str, genre: str):
+        """Invalidate a user's entry if a new review changes their author/genre fingerprint."""
+        entry = self._entries.get(user_id)
+        if entry is not None and (author, genre) in entry.pairs:
+            return
+        if user_id in self._building:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+        if entry is None:
+            return
+        self.counters["invalidations"] += 1
+        if self.stale_while_revalidate:
+            entry.stale = True
+        else:
+            del self._entries[user_id]
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.counters, "users": len(self._entries), "refreshing": self._refreshes.in_flight()}
+
+    async def _build(self, user_id: int, variant: tuple, build) -> Optional[dict]:
+        generation = self._generations.get(user_id, 0)
+        self._building[user_id] = self._building.get(user_id, 0) + 1
+        try:
+            built = await build()
+        finally:
+            invalidated = self._generations.get(user_id, 0) != generation
+            self._building[user_id] -= 1
+            if not self._building[user_id]:
+                del self._building[user_id]
+                self._generations.pop(user_id, None)
+        if built is None:
+            return None
+        pairs, payload = built
+        if invalidated:
+            # A review landed while this was built from the older history: answer with it, don't cache it
+            return payload
+        pairs = frozenset(pairs)
+        entry = self._entries.get(user_id)
+        if entry is None or entry.stale or entry.fingerprint != RecommendationCache.fingerprint(pairs):
+            # Responses for other variants were built from a different history
+            entry = _UserRecommendations(pairs, time.monotonic())
+            self._entries[user_id] = entry
+        entry.responses[variant] = payload
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+        return payload
+
+    def _refresh_in_background(self, user_id: int, variant: tuple, build):
+        task = start_background_task(self._refreshes.do((user_id, variant), lambda: self._build(user_id, variant, build)))
+        self._background.add(task)
+        task.add_done_callback(self._background_done)
+
+    def _background_done(self, task):
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Background recommendation refresh failed: {task.exception()}")
@@ -0,0 +1,85 @@
+"""
+Production entry point: serves app.py with Hypercorn across several worker processes.
+
+    python serve.py --workers 4 --bind 0.0.0.0:5000
+
+Workers are started with the `spawn` method, so each one imports the app afresh and opens its
+own database pool and LLM client; nothing with open sockets is inherited from the parent. On
+SIGTERM (or SIGINT) the parent tells every worker to stop accepting connections, finish the
+requests in flight for up to `--graceful-timeout` seconds and run the app's shutdown hooks.
+
+`quart run` and `python app.py` remain the single-process development servers.
+"""
+import argparse
+import os
+import sys
+
+from hypercorn.config import Config
+from hypercorn.run import run
+
+
+def _default_worker_class():
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        return "asyncio"
+    return "uvloop"
+
+
+def build_config(args) -> Config:
+    """Translate the command-line options into a Hypercorn config for `app:app`."""
+    config = Config()
+    config.application_path = "app:app"
+    config.bind = args.bind
+    config.workers = args.workers
+    config.worker_class = args.worker_class
+    config.keep_alive_timeout = args.keep_alive
+    config.backlog = args.backlog
+    config.graceful_timeout = args.graceful_timeout
+    config.max_requests = args.max_requests
+    config.accesslog = "-" if args.access_log else None
+    config.errorlog = "-"
+    return config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the library API with Hypercorn.")
+    parser.add_argument(
+        "--bind", action="append",
+        help="Address to listen on, repeatable (SERVER_BIND, default 0.0.0.0:5000)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("SERVER_WORKERS", os.cpu_count() or 1)),
+        help="Worker processes (SERVER_WORKERS, default one per CPU)",
+    )
+    parser.add_argument(
+        "--worker-class", choices=("asyncio", "uvloop"), default=os.getenv("SERVER_WORKER_CLASS") or _default_worker_class(),
+        help="Event loop implementation (SERVER_WORKER_CLASS, default uvloop when installed)",
+    )
+    parser.add_argument(
+        "--keep-alive", type=float, default=float(os.getenv("SERVER_KEEP_ALIVE", 75)),
+        help="Seconds an idle keep-alive connection stays open; keep it above the load balancer's idle timeout",
+    )
+    parser.add_argument(
+        "--backlog", type=int, default=int(os.getenv("SERVER_BACKLOG", 2048)),
+        help="Pending connections the listening socket queues (SERVER_BACKLOG)",
+    )
+    parser.add_argument(
+        "--graceful-timeout", type=float, default=float(os.getenv("SERVER_GRACEFUL_TIMEOUT", 30)),
+        help="Seconds in-flight requests get to finish on shutdown (SERVER_GRACEFUL_TIMEOUT)",
+    )
+    parser.add_argument(
+        "--max-requests", type=int, default=int(os.getenv("SERVER_MAX_REQUESTS", 0)) or None,
+        help="Restart a worker after this many requests, off by default (SERVER_MAX_REQUESTS)",
+    )
+    parser.add_argument("--access-log", action="store_true", help="Log every request to stdout")
+    args = parser.parse_args(argv)
+    args.bind = args.bind or os.getenv("SERVER_BIND", "0.0.0.0:5000").split(",")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    return run(build_config(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,461 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import re
+import time
+import weakref
+import zlib
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+
+from metrics import start_background_task
+from models import Book
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Bump when tokenisation, weighting or hashing changes so that older snapshots are ignored
+FEATURE_VERSION = 1
+SNAPSHOT_FORMAT = 1
+DF_BUCKETS = 1 << 20
+# Queries over at least this many books are scored on a worker thread
+OFFLOAD_ROWS = 20000
+# Relative weight of a term by the field it came from; author and genre are matched as whole values
+FIELD_WEIGHTS = {"title": 2.0, "summary": 1.0, "author": 3.0, "genre": 2.0}
+INDEXED_FIELDS = ("title", "author", "genre", "summary")
+STOP_WORDS = frozenset(
+    "a an and are as at be but by for from has have he her his in into is it its of on or she that the their "
+    "them they this to was were which who will with".split()
+)
+_WORD = re.compile(r"[^\W_]+")
+
+
+def book_features(title: str, author: str, genre: str, summary: Optional[str]) -> Dict[str, float]:
+    """Weighted terms of a book: title and summary words share one vocabulary, author and genre are single terms."""
+    features: Dict[str, float] = {}
+    for text, weight in ((title, FIELD_WEIGHTS["title"]), (summary, FIELD_WEIGHTS["summary"])):
+        for word in _WORD.findall((text or "").lower()):
+            if len(word) > 1 and word not in STOP_WORDS:
+                features[word] = features.get(word, 0.0) + weight
+    if author:
+        features["author:" + " ".join(author.lower().split())] = FIELD_WEIGHTS["author"]
+    if genre:
+        features["genre:" + " ".join(genre.lower().split())] = FIELD_WEIGHTS["genre"]
+    return features
+
+
+def _hashes(features: Dict[str, float]) -> Tuple[List[int], List[float]]:
+    # crc32 is stable across processes, unlike hash(), so persisted snapshots stay valid
+    return [zlib.crc32(term.encode("utf-8")) for term in features], list(features.values())
+
+
+class _IndexState:
+    """Book vectors (unit rows of a float32 matrix with spare capacity) and the document frequencies behind them."""
+
+    def __init__(self, matrix: np.ndarray, size: int, book_ids: np.ndarray, df: np.ndarray, documents: int,
+                 watermark: list, built_at: float):
+        self.matrix = matrix
+        self.size = size
+        self.book_ids = book_ids
+        self.position = {int(book_id): row for row, book_id in enumerate(book_ids[:size]) if book_id >= 0}
+        self.df = df
+        self.documents = documents
+        self.watermark = watermark
+        self.built_at = built_at
+
+
+class SimilarBooksIndex:
+    """
+    In-memory "more like this" index over the catalog.
+
+    Each book is embedded as a hashed TF-IDF vector of its title, author, genre and summary
+    (no vocabulary or external model, so it works offline) and kept L2-normalised in one
+    float32 matrix; a query is a single matrix-vector product. Books added, edited or deleted
+    through the ORM are re-embedded once their transaction commits (see the session listeners
+    below), reusing the current IDF weights. The full matrix and weights are rebuilt every
+    `refresh_interval` if the catalog changed since the last build (which also covers other
+    worker processes and bulk imports), after `mark_dirty`, or on `refresh(force=True)`.
+
+    With a `snapshot_path` the index is saved after each rebuild and on `stop`, and loaded on
+    `start`; it is rebuilt in the background if the catalog changed since it was written.
+    """
+    _instances = weakref.WeakSet()
+
+    def __init__(self, db_manager, dimensions: int = 256, snapshot_path: Optional[str] = None,
+                 refresh_interval: float = 600, stop_timeout: float = 10.0):
+        """
+        Args:
+            db_manager (DatabaseManager): Source of the books table.
+            dimensions (int): Vector size, a power of two; memory is 4 bytes x dimensions per book.
+            snapshot_path (str): .npz file the index is persisted to, None to keep it in memory only.
+            refresh_interval (float): Seconds between checks for a pending full rebuild.
+            stop_timeout (float): Seconds `stop` lets a running rebuild finish before cancelling it.
+        """
+        if dimensions & (dimensions - 1):
+            raise ValueError("dimensions must be a power of two")
+        self.db_manager = db_manager
+        self.dimensions = dimensions
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.stop_timeout = stop_timeout
+        self._state: Optional[_IndexState] = None
+        self._dirty = False
+        self._unsaved = False
+        self._lock = asyncio.Lock()
+        self._changed: set = set()
+        self._deleted: set = set()
+        self._apply_task: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        self._busy = False
+        self._stopping = False
+        SimilarBooksIndex._instances.add(self)
+
+    def mark_dirty(self):
+        """Flag that books changed outside the ORM (e.g. a bulk import) so the next refresh rebuilds everything."""
+        self._dirty = True
+
+    def start(self):
+        """Load or build the index in the background, then rebuild it whenever it is marked dirty."""
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop background work and persist incremental changes made since the last snapshot."""
+        if self._task is not None:
+            self._stopping = True
+            if self._busy:
+                # Cancelling mid-query can strand a driver connection (and, on SQLite, its thread)
+                await asyncio.wait([self._task], timeout=self.stop_timeout)
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._apply_task is not None:
+            # Let queued updates land in the snapshot rather than dying with the loop mid-query
+            await asyncio.gather(self._apply_task, return_exceptions=True)
+            self._apply_task = None
+        if self.snapshot_path and self._unsaved and self._state is not None:
+            await asyncio.to_thread(self._save, self._state)
+
+    async def refresh(self, force: bool = False):
+        """Rebuild vectors and IDF weights from the whole catalog if dirty or not built yet (or always, with `force`)."""
+        async with self._lock:
+            if not (force or self._dirty or self._state is None):
+                return
+            self._dirty = False
+            # Read the watermark first: if the catalog changes meanwhile, the snapshot just looks stale
+            watermark = await self._watermark()
+            rows = await self.db_manager.fetch_rows(select(Book.id, *(getattr(Book, field) for field in INDEXED_FIELDS)))
+            self._state = await asyncio.to_thread(self._build, rows, watermark)
+            self._unsaved = True
+            if self.snapshot_path:
+                await asyncio.to_thread(self._save, self._state)
+
+    async def similar(self, book_id: int, limit: int = 10) -> Optional[List[Tuple[int, float]]]:
+        """
+        Return up to `limit` (book_id, cosine similarity) pairs most like the book, best first.
+
+        Only books with some similarity are returned; None means the book does not exist.
+        """
+        if self._state is None:
+            await self.refresh()
+        state = self._state
+        row = state.position.get(book_id)
+        if row is None:
+            # Created moments ago and not applied yet: embed it now
+            rows = await self._fetch([book_id])
+            if not rows:
+                return None
+            self._upsert(rows)
+            state = self._state
+            row = state.position[book_id]
+
+        k = min(limit, state.size - 1)
+        if k <= 0:
+            return []
+        if state.size >= OFFLOAD_ROWS:
+            # A scan of a large matrix takes milliseconds; numpy releases the GIL, so keep the loop free
+            return await asyncio.to_thread(self._top, state, row, k)
+        return self._top(state, row, k)
+
+    @staticmethod
+    def _top(state: _IndexState, row: int, k: int) -> List[Tuple[int, float]]:
+        import numpy as np
+
+        matrix = state.matrix[:state.size]
+        scores = matrix @ matrix[row]
+        scores[row] = -np.inf
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(state.book_ids[i]), float(scores[i])) for i in top if scores[i] > 0]
+
+    def note_changes(self, changed: Iterable[int] = (), deleted: Iterable[int] = ()):
+        """Queue committed book changes for re-embedding in the background."""
+        self._changed.update(changed)
+        self._deleted.update(deleted)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # No loop to apply them on (e.g. a synchronous script): rebuild next time instead
+            self._dirty = True
+            return
+        if self._task is None:
+            # Not running, so nothing would wait for the update; the next start rebuilds instead
+            self._dirty = True
+            return
+        if self._apply_task is None or self._apply_task.done():
+            self._apply_task = start_background_task(self._apply_changes())
+
+    def stats(self) -> Dict[str, float]:
+        """Size and age of the index."""
+        state = self._state
+        if state is None:
+            return {"built": False}
+        return {
+            "built": True,
+            "books": len(state.position),
+            "dimensions": self.dimensions,
+            "matrix_bytes": int(state.matrix.nbytes),
+            "age_seconds": time.time() - state.built_at,
+            "dirty": self._dirty,
+            "pending_changes": len(self._changed) + len(self._deleted),
+        }
+
+    async def _run(self):
+        # Busy while querying or building so that `stop` lets the work finish; the sleep is safe to cancel
+        self._busy = True
+        try:
+            if not await self._load_snapshot():
+                await self.refresh()
+        except Exception as e:
+            self._dirty = True
+            print(f"Similar-books index build failed: {e}")
+        finally:
+            self._busy = False
+        while not self._stopping:
+            await asyncio.sleep(self.refresh_interval)
+            self._busy = True
+            try:
+                # Other workers' edits never reach this process's listeners; the watermark catches them
+                if self._state is not None and await self._watermark() != self._state.watermark:
+                    self._dirty = True
+                await self.refresh()
+            except Exception as e:
+                # Keep serving the current vectors and retry on the next tick
+                self._dirty = True
+                print(f"Similar-books index refresh failed: {e}")
+            finally:
+                self._busy = False
+
+    async def _apply_changes(self):
+        # The lock orders these after a running rebuild, which may not have seen them
+        async with self._lock:
+            while self._changed or self._deleted:
+                changed, self._changed = self._changed, set()
+                deleted, self._deleted = self._deleted, set()
+                if self._state is None:
+                    # The first build reads the current catalog anyway
+                    continue
+                for book_id in deleted:
+                    self._remove(book_id)
+                if changed:
+                    try:
+                        rows = await self._fetch(changed)
+                    except Exception as e:
+                        self._dirty = True
+                        print(f"Similar-books update failed: {e}")
+                        continue
+                    self._upsert(rows)
+                    for book_id in changed - {row[0] for row in rows}:
+                        self._remove(book_id)
+
+    async def _fetch(self, book_ids: Iterable[int]):
+        return await self.db_manager.fetch_rows(
+            select(Book.id, *(getattr(Book, field) for field in INDEXED_FIELDS)).where(Book.id.in_(list(book_ids)))
+        )
+
+    async def _watermark(self) -> list:
+        """Row count and latest update of the catalog, to tell whether a snapshot is current."""
+        rows = await self.db_manager.fetch_rows(select(func.count(Book.id), func.max(Book.updated_at)))
+        count, updated_at = rows[0]
+        return [int(count), str(updated_at)]
+
+    async def _load_snapshot(self) -> bool:
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            state = await asyncio.to_thread(self._read, self.snapshot_path)
+        except Exception as e:
+            print(f"Ignoring unreadable similar-books snapshot {self.snapshot_path}: {e}")
+            return False
+        if state is None:
+            return False
+        async with self._lock:
+            if self._state is None:
+                self._state = state
+        if await self._watermark() != state.watermark:
+            self._dirty = True
+            await self.refresh()
+        return True
+
+    def _hashed(self, rows) -> Tuple[List[int], List[Tuple[List[int], List[float]]]]:
+        """Book ids and (term hashes, term weights) of (id, title, author, genre, summary) rows."""
+        return [int(row[0]) for row in rows], [_hashes(book_features(*row[1:])) for row in rows]
+
+    def _vectors(self, hashed, df: np.ndarray, documents: int) -> np.ndarray:
+        """Unit TF-IDF vectors of hashed books under the given document frequencies."""
+        import numpy as np
+
+        vectors = np.zeros((len(hashed), self.dimensions), dtype=np.float32)
+        lengths = [len(terms) for terms, _ in hashed]
+        if not sum(lengths):
+            return vectors
+        hashes = np.fromiter((h for terms, _ in hashed for h in terms), dtype=np.uint32, count=sum(lengths))
+        weights = np.fromiter((w for _, values in hashed for w in values), dtype=np.float64, count=sum(lengths))
+        idf = np.log((1.0 + documents) / (1.0 + df[hashes & (DF_BUCKETS - 1)])) + 1.0
+        # The top hash bit picks a sign so that colliding terms tend to cancel rather than add up
+        signs = np.where(hashes >> 31, -1.0, 1.0)
+        values = (np.log1p(weights) * idf * signs).astype(np.float32)
+        rows_of = np.repeat(np.arange(len(hashed)), lengths)
+        np.add.at(vectors, (rows_of, hashes & (self.dimensions - 1)), values)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _build(self, rows, watermark: list) -> _IndexState:
+        import numpy as np
+
+        ids, hashed = self._hashed(rows)
+        df = np.zeros(DF_BUCKETS, dtype=np.int32)
+        terms = np.fromiter((h for book_terms, _ in hashed for h in book_terms), dtype=np.uint32)
+        np.add.at(df, terms & (DF_BUCKETS - 1), 1)
+        vectors = self._vectors(hashed, df, len(ids))
+        return _IndexState(vectors, len(ids), np.array(ids, dtype=np.int64), df, len(ids), watermark, time.time())
+
+    def _upsert(self, rows):
+        """Embed rows with the current IDF weights and write them in place, appending new books."""
+        import numpy as np
+
+        state = self._state
+        ids, hashed = self._hashed(rows)
+        vectors = self._vectors(hashed, state.df, state.documents)
+        for vector, book_id in zip(vectors, ids):
+            row = state.position.get(book_id)
+            if row is None:
+                if state.size == len(state.matrix):
+                    # Grow geometrically so that a stream of new books costs amortised O(1) copies
+                    capacity = max(16, 2 * len(state.matrix))
+                    matrix = np.zeros((capacity, self.dimensions), dtype=np.float32)
+                    matrix[:state.size] = state.matrix[:state.size]
+                    book_ids = np.full(capacity, -1, dtype=np.int64)
+                    book_ids[:state.size] = state.book_ids[:state.size]
+                    state.matrix, state.book_ids = matrix, book_ids
+                row = state.size
+                state.size += 1
+                state.book_ids[row] = book_id
+                state.position[book_id] = row
+            state.matrix[row] = vector
+        self._unsaved = True
+
+    def _remove(self, book_id: int):
+        state = self._state
+        row = state.position.pop(book_id, None)
+        if row is not None:
+            # Leave a zero row behind; it never scores above 0 and the next rebuild drops it
+            state.matrix[row] = 0
+            state.book_ids[row] = -1
+            self._unsaved = True
+
+    def _meta(self) -> dict:
+        return {"format": SNAPSHOT_FORMAT, "features": FEATURE_VERSION, "dimensions": self.dimensions}
+
+    def _save(self, state: _IndexState):
+        import numpy as np
+
+        meta = {**self._meta(), "documents": state.documents, "watermark": state.watermark, "built_at": state.built_at}
+        # Write then rename, so a crash or a concurrent worker never leaves a torn file behind
+        temporary = f"{self.snapshot_path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            temporary,
+            matrix=state.matrix[:state.size],
+            book_ids=state.book_ids[:state.size],
+            df=state.df,
+            meta=np.array(json.dumps(meta)),
+        )
+        os.replace(temporary, self.snapshot_path)
+        self._unsaved = False
+
+    def _read(self, path: str) -> Optional[_IndexState]:
+        import numpy as np
+
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            if {key: meta.get(key) for key in self._meta()} != self._meta():
+                print(f"Ignoring similar-books snapshot {path} built with different settings")
+                return None
+            return _IndexState(
+                data["matrix"].copy(), len(data["book_ids"]), data["book_ids"].copy(), data["df"].copy(),
+                meta["documents"], meta["watermark"], meta["built_at"],
+            )
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_books(session, flush_context):
+    changed = {obj.id for obj in session.new if isinstance(obj, Book)}
+    for obj in session.dirty:
+        if isinstance(obj, Book) and session.is_modified(obj):
+            state = inspect(obj)
+            if any(state.attrs[field].history.has_changes() for field in INDEXED_FIELDS):
+                changed.add(obj.id)
+    deleted = {obj.id for obj in session.deleted if isinstance(obj, Book)}
+    if changed:
+        session.info.setdefault("changed_book_ids", set()).update(changed)
+    if deleted:
+        session.info.setdefault("deleted_book_ids", set()).update(deleted)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _collect_bulk_book_changes(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return None
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ is not Book:
+        return None
+    session = orm_execute_state.session
+    returning = list(orm_execute_state.statement.exported_columns)
+    if not returning or not returning[0].compare(Book.__table__.c.id):
+        # No ids to read without another query; the next refresh rebuilds everything instead
+        session.info["book_index_dirty"] = True
+        return None
+    # Read the ids from the statement's own RETURNING rows (books or their ids), then hand the caller a fresh copy
+    frozen = orm_execute_state.invoke_statement().freeze()
+    book_ids = {row[0].id if isinstance(row[0], Book) else row[0] for row in frozen().all()}
+    key = "deleted_book_ids" if orm_execute_state.is_delete else "changed_book_ids"
+    session.info.setdefault(key, set()).update(book_ids)
+    return frozen()
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_committed_book_changes(session):
+    deleted = session.info.pop("deleted_book_ids", set())
+    changed = session.info.pop("changed_book_ids", set()) - deleted
+    if session.info.pop("book_index_dirty", False):
+        for index in SimilarBooksIndex._instances:
+            index.mark_dirty()
+    if changed or deleted:
+        for index in SimilarBooksIndex._instances:
+            index.note_changes(changed, deleted)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_book_changes(session):
+    session.info.pop("changed_book_ids", None)
+    session.info.pop("deleted_book_ids", None)
+    session.info.pop("book_index_dirty", None)
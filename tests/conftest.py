@@ -0,0 +1,46 @@
+import os
+import tempfile
+
+import pytest
+
+# app.py reads its configuration at import time, so point it at a throwaway SQLite file first
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(prefix='library-tests-'), 'app.db')}"
+os.environ.setdefault("HUGGINGFACE_API_KEY", "test")
+# Nothing listens here, so a call that slips past a test fails fast instead of leaving the machine
+os.environ.setdefault("HUGGINGFACE_BASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("PASSWORD_HASH_METHOD", "pbkdf2:sha256:1000")
+
+from db_utils import DatabaseManager
+from migrations import migrate
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def empty_database(tmp_path):
+    """A DatabaseManager on a fresh SQLite file with no tables."""
+    db_manager = DatabaseManager(f"sqlite+aiosqlite:///{tmp_path / 'library.db'}")
+    try:
+        yield db_manager
+    finally:
+        await db_manager.engine.dispose()
+
+
+@pytest.fixture
+async def database(empty_database):
+    """A DatabaseManager on a fresh, fully migrated SQLite file."""
+    await migrate(empty_database)
+    return empty_database
+
+
+@pytest.fixture
+async def client():
+    """A test client of the app, serving from the migrated test database."""
+    from app import app, db_manager
+
+    await migrate(db_manager)
+    async with app.test_app() as test_app:
+        yield test_app.test_client()
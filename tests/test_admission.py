@@ -0,0 +1,22 @@
+import pytest
+
+from admission import AdmissionController, Overloaded, RateLimited, TokenBucketLimiter, admit
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_overloaded_calls_refund_the_users_token():
+    limiter = TokenBucketLimiter(rate=0.001, burst=2)
+    controller = AdmissionController(max_in_flight=1, max_queue=0)
+    held = await admit(limiter, controller, "alice")
+    assert limiter.tokens("alice") == pytest.approx(1, abs=0.01)
+
+    with pytest.raises(Overloaded):
+        await admit(limiter, controller, "alice")
+    assert limiter.tokens("alice") == pytest.approx(1, abs=0.01)
+
+    held.release()
+    (await admit(limiter, controller, "alice")).release()
+    with pytest.raises(RateLimited):
+        await admit(limiter, controller, "alice")
+    assert limiter.stats()["refunded"] == 1
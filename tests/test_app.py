@@ -0,0 +1,146 @@
+import itertools
+
+import orjson
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+_names = itertools.count()
+
+
+async def sign_up(client):
+    username = f"reader{next(_names)}"
+    response = await client.post("/register", json={
+        "username": username, "password": "correct horse", "email": f"{username}@example.com", "full_name": "A Reader",
+    })
+    assert (await response.get_json())["is_success"]
+    response = await client.post("/login", json={"username": username, "password": "correct horse"})
+    assert (await response.get_json())["is_success"]
+    return username
+
+
+async def add_book(client, title, **fields):
+    response = await client.post("/books", json={"title": title, "author": "Ursula K. Le Guin", "genre": "Fantasy", **fields})
+    assert response.status_code == 201
+    response = await client.get("/books?limit=100")
+    return next(book["id"] for book in (await response.get_json())["books"] if book["title"] == title)
+
+
+async def test_register_login_and_logout(client):
+    assert (await client.get("/profile")).status_code == 403
+    username = await sign_up(client)
+
+    response = await client.get("/profile")
+    assert response.status_code == 200
+    assert (await response.get_json())["username"] == username
+
+    response = await client.post("/login", json={"username": username, "password": "wrong"})
+    assert not (await response.get_json())["is_success"]
+    await client.post("/logout")
+    assert (await client.get("/profile")).status_code == 403
+
+
+async def test_books_crud(client):
+    await sign_up(client)
+    book_id = await add_book(client, "A Wizard of Earthsea", year_published=1968)
+
+    response = await client.get(f"/books/{book_id}")
+    assert response.status_code == 200
+    assert (await response.get_json())["year_published"] == 1968
+
+    response = await client.put(f"/books/{book_id}", json={"summary": "A young mage learns the cost of power."})
+    assert response.status_code == 200
+    updated = (await response.get_json())["updated_book"]
+    response = await client.get(f"/books/{book_id}")
+    assert await response.get_json() == updated
+    assert updated["summary"] == "A young mage learns the cost of power."
+    # Versions and timestamps travel as ETag and Last-Modified only
+    assert not {"version", "updated_at", "reviews_version"} & set(updated)
+    assert response.headers["ETag"] and response.headers["Last-Modified"]
+
+    response = await client.get("/books/search?q=earthsea")
+    assert book_id in [book["id"] for book in (await response.get_json())["results"]]
+
+    assert (await client.delete(f"/books/{book_id}")).status_code == 200
+    assert (await client.get(f"/books/{book_id}")).status_code == 404
+    assert (await client.delete(f"/books/{book_id}")).status_code == 404
+
+
+async def test_reviews(client):
+    await sign_up(client)
+    book_id = await add_book(client, "The Tombs of Atuan")
+
+    response = await client.post(f"/books/{book_id}/reviews", json={"review_text": "Haunting.", "rating": 5})
+    assert response.status_code == 201
+    response = await client.post(f"/books/{book_id}/reviews", json={"review_text": "Again.", "rating": 1})
+    assert response.status_code == 409
+
+    await sign_up(client)
+    response = await client.post(f"/books/{book_id}/reviews", json={"review_text": "Slow.", "rating": 3})
+    assert response.status_code == 201
+
+    response = await client.get(f"/books/{book_id}/reviews")
+    assert sorted(review["rating"] for review in await response.get_json()) == [3, 5]
+    response = await client.get(f"/books/{book_id}/summary")
+    summary = await response.get_json()
+    assert (summary["average_rating"], summary["review_count"], summary["rating_min"]) == (4, 2, 3)
+
+
+async def test_llm_quota_is_only_spent_on_llm_calls(client):
+    import app
+
+    await sign_up(client)
+    book_id = await add_book(client, "The Left Hand of Darkness")
+    await client.post(f"/books/{book_id}/reviews", json={"review_text": "Cold and brilliant.", "rating": 5})
+    async with client.session_transaction() as session:
+        user_id = session["user_id"]
+    while not app.llm_rate_limiter.take(user_id):
+        pass
+
+    # Nothing here reaches the LLM, so an empty bucket does not matter
+    assert (await client.get("/recommendations")).status_code == 200
+    assert (await client.get("/recommendations?stream=true")).status_code == 200
+    assert (await client.post(f"/books/{book_id}/generate-summary?async=true")).status_code == 202
+
+    response = await client.post(f"/books/{book_id}/generate-summary?regenerate=true")
+    assert response.status_code == 429 and "Retry-After" in response.headers
+    assert (await client.get("/recommendations?explain=true&refresh=true")).status_code == 429
+    # Nor may a background refresh of a stale explained response
+    assert await app.refresh_explained_recommendations(user_id, 10) is None
+    assert app.llm_admission.in_flight == 0
+
+
+async def test_warns_once_about_untrusted_forwarded_for(client, capsys):
+    for _ in range(2):
+        await client.post("/login", json={"username": "nobody", "password": "x"}, headers={"X-Forwarded-For": "203.0.113.9"})
+    assert capsys.readouterr().out.count("TRUSTED_PROXY_HOPS is 0") == 1
+
+
+async def test_book_pages_cover_the_catalog_once(client):
+    await sign_up(client)
+    for number in range(7):
+        await client.post("/books", json={"title": f"Catalogue {number}", "author": "A. Author", "genre": "Fiction"})
+
+    seen, after = [], None
+    while True:
+        response = await client.get("/books?limit=3" + (f"&after={after}" if after is not None else ""))
+        page = await response.get_json()
+        assert len(page["books"]) <= 3
+        seen += [book["id"] for book in page["books"]]
+        after = page["next_after"]
+        if after is None:
+            break
+        assert after == seen[-1]
+    assert seen == sorted(set(seen))
+
+    # Both streamed forms return the same books in the same order
+    response = await client.get("/books")
+    assert [book["id"] for book in await response.get_json()] == seen
+    response = await client.get("/books?format=ndjson")
+    lines = (await response.get_data()).splitlines()
+    assert [orjson.loads(line)["id"] for line in lines] == seen
+    response = await client.get(f"/books?format=ndjson&after={seen[2]}&limit=2")
+    assert [orjson.loads(line)["id"] for line in (await response.get_data()).splitlines()] == seen[3:5]
+
+    assert (await client.get("/books?after=x")).status_code == 400
+    assert (await client.get("/books?limit=0")).status_code == 400
@@ -0,0 +1,81 @@
+import pytest
+from werkzeug.security import generate_password_hash
+
+from auth_manager import AuthManager, LoginThrottle, LoginThrottled, PasswordHasher, expand_hash_method
+from models import User
+
+
+def test_hash_methods_compare_in_expanded_form():
+    assert expand_hash_method("scrypt") == "scrypt:32768:8:1"
+    assert expand_hash_method("pbkdf2:sha256") == expand_hash_method("pbkdf2") == "pbkdf2:sha256:1000000"
+
+    hasher = PasswordHasher("scrypt")
+    assert not hasher.needs_rehash(generate_password_hash("secret", "scrypt:32768:8:1"))
+    assert hasher.needs_rehash(generate_password_hash("secret", "scrypt:16384:8:1"))
+    assert hasher.needs_rehash(generate_password_hash("secret", "pbkdf2:sha256:1000"))
+    assert not PasswordHasher("pbkdf2:sha256").needs_rehash(generate_password_hash("secret", "pbkdf2:sha256:1000000"))
+
+
+@pytest.mark.anyio
+async def test_user_lockout_is_per_client(database):
+    auth = AuthManager(database, user_throttle=LoginThrottle(max_failures=3))
+    for _ in range(3):
+        result = await auth.sign_in("ann", "wrong", client="198.51.100.7")
+        assert not result["is_success"]
+
+    with pytest.raises(LoginThrottled):
+        await auth.sign_in("Ann", "wrong", client="198.51.100.7")
+    # Someone else guessing cannot lock the owner out from their own address
+    assert not (await auth.sign_in("ann", "wrong", client="203.0.113.9"))["is_success"]
+
+
+@pytest.mark.anyio
+async def test_registrations_do_not_count_as_failed_logins(database):
+    auth = AuthManager(
+        database,
+        hasher=PasswordHasher("pbkdf2:sha256:1000", workers=1),
+        client_throttle=LoginThrottle(max_failures=2),
+        registration_throttle=LoginThrottle(max_failures=3),
+    )
+    try:
+        for name in ("ann", "bob", "cat"):
+            assert (await auth.register(name, "secret", f"{name}@example.com", name, client="198.51.100.7"))["is_success"]
+        with pytest.raises(LoginThrottled):
+            await auth.register("dan", "secret", "dan@example.com", "Dan", client="198.51.100.7")
+        # Sign-ups from a shared address leave its logins alone
+        assert (await auth.sign_in("ann", "wrong", client="198.51.100.7")).get("is_success") is False
+    finally:
+        await auth.hasher.shutdown()
+
+
+@pytest.mark.anyio
+async def test_identity_cache_is_invalidated_when_the_user_changes(database):
+    await database.execute(User.__table__.insert().values(
+        id=1, username="ann", password_hash="x", email="ann@example.com", full_name="Ann",
+    ))
+    auth = AuthManager(database)
+    assert (await auth.load_identity(1))["full_name"] == "Ann"
+    assert (await auth.load_identity(1))["full_name"] == "Ann"
+    assert (auth.identities.counters["misses"], auth.identities.counters["hits"]) == (1, 1)
+
+    # A flushed ORM change
+    user = await database.fetch_one(User, {"id": 1})
+    user.full_name = "Ann Leckie"
+    await database.add_or_save(user)
+    assert (await auth.load_identity(1))["full_name"] == "Ann Leckie"
+
+    # A set-based UPDATE
+    await database.update_one_or_more(User, {"id": 1}, {"email": "leckie@example.com"})
+    assert (await auth.load_identity(1))["email"] == "leckie@example.com"
+
+    # Nothing is dropped for a transaction that rolls back
+    invalidations = auth.identities.counters["invalidations"]
+    with pytest.raises(RuntimeError):
+        async with database.unit_of_work():
+            await database.update_one_or_more(User, {"id": 1}, {"full_name": "Nobody"})
+            raise RuntimeError("abort")
+    assert auth.identities.counters["invalidations"] == invalidations
+    assert (await auth.load_identity(1))["full_name"] == "Ann Leckie"
+
+    await database.delete_where(User, {"id": 1})
+    assert await auth.load_identity(1) is None
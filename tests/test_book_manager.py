@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from book_manager import SmartLibrary
+from models import Book, SummaryJob
+
+
+class SlowModel:
+    """Answers every prompt after a short delay, signalling when the first call starts."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.started = asyncio.Event()
+
+    async def generate_response(self, prompt, bypass_cache=False):
+        self.started.set()
+        await asyncio.sleep(self.delay)
+        return "A summary."
+
+
+@pytest.mark.anyio
+async def test_stop_lets_running_job_finish(database):
+    await database.execute(Book.__table__.insert().values(id=1, title="Dune", author="Herbert", genre="SF"))
+    model = SlowModel(delay=0.2)
+    library = SmartLibrary(db_manager=database, llm_model=model, workers=2, poll_interval=0.05)
+    library.start()
+    try:
+        job = await library.generate_summary_for_book(1)
+        await asyncio.wait_for(model.started.wait(), timeout=5)
+    finally:
+        await library.stop()
+
+    assert (await library.get_job(job["id"]))["status"] == SummaryJob.SUCCEEDED
+    assert (await database.fetch_one(Book, {"id": 1})).summary == "A summary."
+    assert library._tasks == []
+
+
+@pytest.mark.anyio
+async def test_stop_cancels_jobs_that_outlast_the_timeout(database):
+    await database.execute(Book.__table__.insert().values(id=1, title="Dune", author="Herbert", genre="SF"))
+    model = SlowModel(delay=60)
+    library = SmartLibrary(db_manager=database, llm_model=model, workers=1, poll_interval=0.05, stop_timeout=0.1)
+    library.start()
+    try:
+        job = await library.generate_summary_for_book(1)
+        await asyncio.wait_for(model.started.wait(), timeout=5)
+    finally:
+        await asyncio.wait_for(library.stop(), timeout=5)
+
+    # Left running; the next process re-queues it once the lease expires
+    assert (await library.get_job(job["id"]))["status"] == SummaryJob.RUNNING
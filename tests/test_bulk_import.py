@@ -0,0 +1,62 @@
+import pytest
+
+from bulk_import import import_books
+from models import Book
+
+pytestmark = pytest.mark.anyio
+
+
+async def chunked(data: bytes, size: int = 7):
+    # Small chunks split lines, and even characters, across reads
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+async def titles(database):
+    return {book.id: book.title for book in await database.fetch_all(Book)}
+
+
+async def test_csv_import_loads_valid_rows_and_reports_bad_ones(database):
+    data = (
+        "title,author,genre,year_published\r\n"
+        "Dune,Frank Herbert,SF,1965\r\n"
+        ",Nobody,SF,\r\n"
+        "Emma,Jane Austen,Romance,eighteen-fifteen\r\n"
+        "Kindred,Octavia E. Butler,SF\r\n"
+        "\r\n"
+        "Beloved,Toni Morrison,Fiction,1987\r\n"
+    ).encode() + "Cien años,García Márquez,Fiction,1967\n".encode("latin-1")
+    report = await import_books(database, chunked(data), "csv", batch_size=1)
+
+    assert (report["rows"], report["loaded"], report["invalid"], report["batches"]) == (6, 2, 4, 2)
+    assert [error["line"] for error in report["row_errors"]] == [3, 4, 5, 8]
+    assert "title is required" in report["row_errors"][0]["error"]
+    assert "must be an integer" in report["row_errors"][1]["error"]
+    assert "Expected 4 fields" in report["row_errors"][2]["error"]
+    assert "UTF-8" in report["row_errors"][3]["error"]
+    assert sorted((await titles(database)).values()) == ["Beloved", "Dune"]
+
+
+async def test_ndjson_conflicts(database):
+    await database.execute(Book.__table__.insert().values(id=1, title="Old title", author="A", genre="G"))
+    rows = b'{"id": 1, "title": "New title", "author": "A", "genre": "G"}\n{"id": 2, "title": "Two", "author": "A", "genre": "G"}\n'
+
+    # A conflicting id fails its whole batch
+    report = await import_books(database, chunked(rows), "ndjson")
+    assert (report["loaded"], report["failed_batches"]) == (0, 1)
+    assert report["batch_errors"][0]["first_line"] == 1 and report["batch_errors"][0]["last_line"] == 2
+    assert await titles(database) == {1: "Old title"}
+
+    report = await import_books(database, chunked(rows), "ndjson", on_conflict="skip")
+    assert report["loaded"] == 1
+    assert await titles(database) == {1: "Old title", 2: "Two"}
+
+    report = await import_books(database, chunked(rows), "ndjson", on_conflict="update")
+    assert report["loaded"] == 2
+    assert await titles(database) == {1: "New title", 2: "Two"}
+    assert (await database.fetch_one(Book, {"id": 1})).version == 2
+
+    report = await import_books(database, chunked(b'{"title": "T", "author": "A", "genre": "G", "pages": 3}\n[1]\n{'), "ndjson")
+    errors = [error["error"] for error in report["row_errors"]]
+    assert errors[:2] == ["Unknown fields: pages", "Row must be an object."]
+    assert errors[2].startswith("Unparseable line")
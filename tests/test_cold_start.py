@@ -0,0 +1,25 @@
+import json
+import os
+import subprocess
+import sys
+
+# Loaded lazily by the code that needs them; importing any of these at startup is a regression
+DEFERRED_MODULES = ("numpy", "scipy", "pandas", "huggingface_hub", "httpx")
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_LOADED_AT_IMPORT = f"""
+import json, sys
+import app
+print(json.dumps([module for module in {DEFERRED_MODULES!r} if module in sys.modules]))
+"""
+
+
+def test_app_imports_without_heavy_modules_or_credentials():
+    env = dict(os.environ)
+    env.pop("HUGGINGFACE_API_KEY", None)
+    result = subprocess.run(
+        [sys.executable, "-c", _LOADED_AT_IMPORT], cwd=REPO, env=env, capture_output=True, text=True, timeout=120,
+    )
+    assert result.returncode == 0, result.stderr
+    assert json.loads(result.stdout.strip().splitlines()[-1]) == []
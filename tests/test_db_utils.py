@@ -0,0 +1,18 @@
+import pytest
+
+from models import Book
+
+
+@pytest.mark.anyio
+async def test_checkpoint_returns_the_connection_to_the_pool(database):
+    await database.execute(Book.__table__.insert().values(id=1, title="Dune", author="Herbert", genre="SF"))
+    pool = database.engine.sync_engine.pool
+    async with database.unit_of_work():
+        await database.fetch_one(Book, {"id": 1})
+        assert pool.checkedout() == 1
+        await database.checkpoint()
+        assert pool.checkedout() == 0
+        # The unit of work carries on in a new transaction
+        await database.execute(Book.__table__.update().where(Book.id == 1).values(title="Dune Messiah"))
+        assert pool.checkedout() == 1
+    assert (await database.fetch_one(Book, {"id": 1})).title == "Dune Messiah"
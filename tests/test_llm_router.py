@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+from llm_router import Backend, LLMRouter
+
+
+class SleepyModel:
+    model_name = "stub"
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def _generate(self, messages, **params):
+        await asyncio.sleep(self.latency)
+        return f"answered after {self.latency}"
+
+
+@pytest.mark.anyio
+async def test_cancelled_hedge_loser_is_not_a_latency_sample():
+    slow, fast = Backend("slow", SleepyModel(1.0)), Backend("fast", SleepyModel(0.01))
+    for _ in range(5):
+        slow.observe(0.02)
+    fast.observe(0.03)
+    router = LLMRouter([slow, fast], min_hedge_delay=0.05)
+
+    assert await router._generate([{"role": "user", "content": "hi"}]) == "answered after 0.01"
+    assert router.counters["hedge_wins"] == 1
+    assert slow.counters["cancelled"] == 1
+    # The loser sinks in the ranking but its percentile window only holds completed calls
+    assert list(slow.latencies) == [0.02] * 5
+    assert slow.ewma >= 0.05
+    assert router.ranked()[0] is fast
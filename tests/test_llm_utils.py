@@ -0,0 +1,133 @@
+import asyncio
+import socket
+
+import httpx
+import pytest
+
+from llm_stub_server import serve_stub
+from llm_utils import HuggingFaceModel, LLM_Base, LLMResponseCache, SingleFlight
+
+pytestmark = pytest.mark.anyio
+
+
+class CountingModel(LLM_Base):
+    model_name = "counting"
+
+    def __init__(self, cache=None):
+        super().__init__(cache=cache)
+        self.calls = 0
+
+    async def _generate(self, messages, **params):
+        self.calls += 1
+        return f"answer {self.calls}"
+
+
+def test_cache_key_ignores_parameter_order_only():
+    messages = [{"role": "user", "content": "Summarise Dune."}]
+    key = LLMResponseCache.make_key("m", messages, {"temperature": 0.5, "top_p": 0.9})
+    assert key == LLMResponseCache.make_key("m", messages, {"top_p": 0.9, "temperature": 0.5})
+    assert key != LLMResponseCache.make_key("m", messages, {"temperature": 0.6, "top_p": 0.9})
+    assert key != LLMResponseCache.make_key("other", messages, {"temperature": 0.5, "top_p": 0.9})
+    assert key != LLMResponseCache.make_key("m", [{"role": "user", "content": "Summarise Emma."}], {"temperature": 0.5, "top_p": 0.9})
+
+
+async def test_responses_are_served_from_memory_then_the_database(database):
+    model = CountingModel(LLMResponseCache(database))
+    assert await model.generate_response("Summarise Dune.") == "answer 1"
+    assert await model.generate_response("Summarise Dune.") == "answer 1"
+    assert model.cache.counters["memory_hits"] == 1
+
+    # A new worker starts with an empty memory tier but shares the table
+    restarted = CountingModel(LLMResponseCache(database))
+    assert await restarted.generate_response("Summarise Dune.") == "answer 1"
+    assert restarted.calls == 0
+    assert restarted.cache.counters["persistent_hits"] == 1
+    assert await restarted.is_cached("Summarise Dune.")
+
+    assert await restarted.generate_response("Summarise Dune.", bypass_cache=True) == "answer 1"
+    assert restarted.calls == 1
+    assert await model.generate_response("Summarise Dune.", temperature=0.1) == "answer 2"
+
+
+async def test_expired_entries_are_misses(database):
+    cache = LLMResponseCache(database, ttl=0, persistent_ttl=0)
+    await cache.set("k", "m", "stale")
+    assert await cache.get("k") is None
+    assert cache.stats()["misses"] == 1
+
+    cache = LLMResponseCache(max_size=1)
+    await cache.set("a", "m", "first")
+    await cache.set("b", "m", "second")
+    assert (await cache.get("a"), await cache.get("b")) == (None, "second")
+
+
+async def test_concurrent_identical_calls_share_one_generation():
+    release = asyncio.Event()
+
+    class GatedModel(CountingModel):
+        async def _generate(self, messages, **params):
+            await release.wait()
+            return await super()._generate(messages, **params)
+
+    model = GatedModel()
+    calls = [asyncio.ensure_future(model.generate_response("Summarise Dune.")) for _ in range(5)]
+    other = asyncio.ensure_future(model.generate_response("Summarise Emma."))
+    await asyncio.sleep(0)
+    assert model.single_flight.in_flight() == 2
+    release.set()
+    assert await asyncio.gather(*calls) == ["answer 1"] * 5
+    assert await other == "answer 2"
+    assert model.single_flight.in_flight() == 0
+
+
+async def test_single_flight_shares_errors_and_survives_a_cancelled_caller():
+    flight = SingleFlight()
+    started, release = asyncio.Event(), asyncio.Event()
+
+    async def fail():
+        started.set()
+        await release.wait()
+        raise RuntimeError("provider down")
+
+    first = asyncio.ensure_future(flight.do("k", fail))
+    await started.wait()
+    second = asyncio.ensure_future(flight.do("k", fail))
+    quitter = asyncio.ensure_future(flight.do("k", fail))
+    await asyncio.sleep(0)
+    quitter.cancel()
+    release.set()
+    for caller in (first, second):
+        with pytest.raises(RuntimeError, match="provider down"):
+            await caller
+    with pytest.raises(asyncio.CancelledError):
+        await quitter
+
+    # The failure is not remembered: the next call runs again
+    assert await flight.do("k", lambda: asyncio.sleep(0, result="recovered")) == "recovered"
+
+
+async def test_calls_share_one_client_within_the_concurrency_cap():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    shutdown = asyncio.Event()
+    server = asyncio.ensure_future(serve_stub(port=port, latency=0.05, shutdown_trigger=shutdown.wait))
+    model = HuggingFaceModel("stub", api_key_env_var=None, base_url=f"http://127.0.0.1:{port}", max_concurrency=2)
+    try:
+        client = model.client
+        for _ in range(100):
+            try:
+                await client.get("/stats")
+                break
+            except httpx.ConnectError:
+                await asyncio.sleep(0.05)
+
+        replies = await asyncio.gather(*(model.generate_response(f"Summarise book {i}.") for i in range(6)))
+        assert replies == ["This is a stubbed model response."] * 6
+        assert model.client is client
+        stats = (await client.get("/stats")).json()
+        assert (stats["calls"], stats["peak_in_flight"]) == (6, 2)
+    finally:
+        await model.aclose()
+        shutdown.set()
+        await server
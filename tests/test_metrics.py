@@ -0,0 +1,46 @@
+import pytest
+from sqlalchemy import select
+
+from metrics import RequestStats, current_request_stats, db_n_plus_one, start_background_task
+from models import Book
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_background_tasks_are_not_charged_to_the_request(database):
+    stats = RequestStats("/books")
+    token = current_request_stats.set(stats)
+    try:
+        await database.fetch_rows(select(Book.id))
+        await start_background_task(database.fetch_rows(select(Book.id)))
+    finally:
+        current_request_stats.reset(token)
+    assert stats.queries == 1
+
+
+async def test_repeated_statements_are_flagged_once(database, capsys):
+    stats = RequestStats("/books/<int:book_id>", n_plus_one_threshold=3)
+    before = db_n_plus_one.value(route=stats.route)
+    token = current_request_stats.set(stats)
+    try:
+        for book_id in range(5):
+            await database.fetch_rows(select(Book.title).where(Book.id == book_id))
+        await database.fetch_rows(select(Book.id))
+    finally:
+        current_request_stats.reset(token)
+
+    assert stats.queries == 6
+    assert len(stats.repeated) == 1 and "books.title" in stats.repeated[0]
+    assert db_n_plus_one.value(route=stats.route) == before + 1
+    assert capsys.readouterr().out.count("Possible N+1 query on /books/<int:book_id>") == 1
+
+
+async def test_metrics_endpoint_reports_requests_by_route(client):
+    await client.get("/books/1")
+    response = await client.get("/metrics")
+    assert response.mimetype == "text/plain"
+    text = (await response.get_data()).decode()
+    assert "# TYPE http_request_duration_seconds histogram" in text
+    assert 'http_request_duration_seconds_count{method="GET",route="/books/<int:book_id>",status="403"}' in text
+    assert 'db_queries_total{operation="select"}' in text
+    assert "db_pool_connections_in_use " in text
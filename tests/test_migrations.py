@@ -0,0 +1,58 @@
+import pytest
+from sqlalchemy import inspect, text
+
+from base import Base
+from migrations import MIGRATIONS, dedupe_reviews, migrate, pending_migrations
+
+pytestmark = pytest.mark.anyio
+
+
+def schema(connection):
+    inspector = inspect(connection)
+    tables = {}
+    for table in inspector.get_table_names():
+        if table == "schema_migrations" or table.startswith("books_fts"):
+            continue
+        tables[table] = (
+            {column["name"] for column in inspector.get_columns(table)},
+            {index["name"] for index in inspector.get_indexes(table)},
+        )
+    return tables
+
+
+async def test_migrations_build_the_model_schema(database):
+    assert await pending_migrations(database) == []
+    async with database.engine.connect() as conn:
+        migrated = await conn.run_sync(schema)
+    for table in Base.metadata.sorted_tables:
+        columns, indexes = migrated[table.name]
+        assert columns == {column.name for column in table.columns}, table.name
+        assert {index.name for index in table.indexes} <= indexes, table.name
+
+
+async def test_migrations_are_idempotent(database):
+    assert await migrate(database) == []
+
+
+async def test_duplicate_reviews_block_the_unique_index(empty_database):
+    await migrate(empty_database, target=3)
+    async with empty_database.engine.begin() as conn:
+        await conn.execute(text(
+            "INSERT INTO users (username, password_hash, email, full_name, is_admin) VALUES ('ann', 'x', 'a@x.com', 'Ann', 0)"
+        ))
+        await conn.execute(text("INSERT INTO books (title, author, genre) VALUES ('Dune', 'Frank Herbert', 'SF')"))
+        await conn.execute(text(
+            "INSERT INTO reviews (book_id, user_id, review_text, rating) VALUES (1, 1, 'old', 2), (1, 1, 'new', 5)"
+        ))
+
+    with pytest.raises(RuntimeError, match="user 1 book 1 \\(2 reviews\\)"):
+        await migrate(empty_database)
+    async with empty_database.engine.connect() as conn:
+        assert await conn.scalar(text("SELECT count(*) FROM reviews")) == 2
+
+    async with empty_database.engine.begin() as conn:
+        assert await conn.run_sync(dedupe_reviews) == 1
+    assert await migrate(empty_database) == [version for version, _, _ in MIGRATIONS if version > 3]
+    async with empty_database.engine.connect() as conn:
+        assert (await conn.execute(text("SELECT review_text FROM reviews"))).scalars().all() == ["new"]
+        assert (await conn.execute(text("SELECT review_count, rating_sum FROM book_rating_stats"))).one() == (1, 5)
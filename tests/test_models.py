@@ -0,0 +1,92 @@
+import pytest
+from sqlalchemy import Column, MetaData, String, Table
+from sqlalchemy.exc import IntegrityError
+
+from base import BaseModel
+from models import Book, BookRatingStats, Review, User, _create_rating_stats
+
+pytestmark = pytest.mark.anyio
+
+
+async def seed(database, users=2):
+    await database.execute(Book.__table__.insert().values(id=1, title="Dune", author="Herbert", genre="SF"))
+    for user_id in range(1, users + 1):
+        await database.execute(User.__table__.insert().values(
+            id=user_id, username=f"reader{user_id}", password_hash="x", email=f"r{user_id}@example.com", full_name="R",
+        ))
+
+
+async def test_first_review_aggregate_row_is_created_once(database):
+    await seed(database)
+    # A concurrent first review may have created the row already; creating it again is a no-op
+    async with database.engine.begin() as conn:
+        await conn.run_sync(_create_rating_stats, 1)
+        await conn.run_sync(_create_rating_stats, 1)
+    await database.add_or_save(Review(book_id=1, user_id=1, review_text="Vast.", rating=5))
+    await database.add_or_save(Review(book_id=1, user_id=2, review_text="Dry.", rating=2))
+
+    stats = BookRatingStats.describe(await database.fetch_one(BookRatingStats, {"book_id": 1}))
+    assert (stats["review_count"], stats["average_rating"], stats["rating_min"], stats["rating_max"]) == (2, 3.5, 2, 5)
+    assert stats["histogram"] == {"1": 0, "2": 1, "3": 0, "4": 0, "5": 1}
+
+
+async def test_only_the_review_index_is_a_duplicate_review(database):
+    await seed(database, users=1)
+    await database.add_or_save(Review(book_id=1, user_id=1, review_text="Vast.", rating=5))
+
+    with pytest.raises(IntegrityError) as duplicate:
+        await database.add_or_save(Review(book_id=1, user_id=1, review_text="Again.", rating=4))
+    assert Review.is_duplicate(duplicate.value)
+
+    with pytest.raises(IntegrityError) as missing_user:
+        await database.add_or_save(Review(book_id=1, user_id=99, review_text="Who?", rating=4))
+    assert not Review.is_duplicate(missing_user.value)
+
+
+async def test_row_serializer_matches_to_dict(database):
+    await seed(database)
+    await database.add_or_save(Review(book_id=1, user_id=1, review_text="Vast.", rating=5))
+    for model in (User, Book, Review):
+        instance = (await database.fetch_all(model))[0]
+        async with database.engine.connect() as conn:
+            row = (await conn.execute(model.row_query().where(model.id == instance.id))).one()
+        assert model.row_serializer()(row) == instance.to_dict()
+
+
+def test_to_dict_of_a_single_column_model():
+    class Tag(BaseModel):
+        __table__ = Table("tags", MetaData(), Column("name", String, primary_key=True))
+
+    assert Tag(name="fantasy").to_dict() == {"name": "fantasy"}
+
+
+async def test_search_ranks_title_matches_first(database):
+    for book_id, title, author, summary in [
+        (1, "Children of Dune", "Frank Herbert", None),
+        (2, "Arrakis Travel Guide", "Anon", "Sand, spice and the dunes of Arrakis."),
+        (3, "A Wizard of Earthsea", "Ursula K. Le Guin", None),
+        (4, "The Dispossessed", "Ursula K. Le Guin", None),
+    ]:
+        await database.execute(Book.__table__.insert().values(id=book_id, title=title, author=author, genre="SF", summary=summary))
+
+    results, cursor = await Book.search(database, "dune")
+    assert [book["id"] for book in results] == [1, 2] and cursor is None
+    assert results[0]["score"] > results[1]["score"] > 0
+    # Terms match as prefixes, and author substrings also count
+    assert [book["id"] for book in (await Book.search(database, "earth"))[0]] == [3]
+    assert sorted(book["id"] for book in (await Book.search(database, "Le Guin"))[0]) == [3, 4]
+    with pytest.raises(ValueError):
+        await Book.search(database, "dune", cursor="not a cursor")
+
+
+async def test_search_cursor_breaks_score_ties_by_id(database):
+    for book_id in (5, 3, 4, 1, 2):
+        await database.execute(Book.__table__.insert().values(id=book_id, title="Solaris", author="Stanisław Lem", genre="SF"))
+
+    seen, cursor = [], None
+    while True:
+        results, cursor = await Book.search(database, "solaris", limit=2, cursor=cursor)
+        seen += [book["id"] for book in results]
+        if cursor is None:
+            break
+    assert seen == [1, 2, 3, 4, 5]
@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+import query_plans
+from db_utils import DatabaseManager
+from migrations import migrate
+
+pytestmark = pytest.mark.anyio
+
+
+def assert_indexed(results):
+    failed = [f"{name}: {detail}" for name, passed, detail in results if not passed]
+    assert not failed, "\n".join(failed)
+
+
+async def test_hot_queries_use_indexes_on_sqlite(database):
+    assert_indexed(await query_plans.check_plans(database))
+
+
+@pytest.mark.skipif(not os.getenv("TEST_DATABASE_URL"), reason="TEST_DATABASE_URL (a disposable PostgreSQL database) is not set")
+async def test_hot_queries_use_indexes_on_postgresql():
+    db_manager = DatabaseManager(os.environ["TEST_DATABASE_URL"])
+    try:
+        await migrate(db_manager)
+        await query_plans.seed(db_manager, books=20000, users=2000, reviews_per_user=10)
+        assert_indexed(await query_plans.check_plans(db_manager))
+    finally:
+        await db_manager.engine.dispose()
+
+
+async def test_full_scans_are_reported(database):
+    # Guards the checker itself: an unindexed filter must fail
+    from sqlalchemy import select
+    from models import Book
+
+    async with database.engine.connect() as conn:
+        scans, detail = await query_plans.explain(conn, select(Book).where(Book.year_published == 1999), {"books"})
+    assert scans == {"books"}, detail
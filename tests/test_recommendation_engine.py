@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from models import Book, Review, User
+from recommendation_engine import RecommendationCache, RecommendationEngine
+
+pytestmark = pytest.mark.anyio
+
+
+def builder(pairs, payload, calls=None):
+    async def build():
+        if calls is not None:
+            calls.append(payload)
+        return pairs, payload
+    return build
+
+
+async def settle(cache):
+    while cache._background:
+        await asyncio.gather(*cache._background)
+
+
+async def test_item_item_scores(database):
+    for user_id in (1, 2, 3):
+        await database.execute(User.__table__.insert().values(
+            id=user_id, username=f"reader{user_id}", password_hash="x", email=f"r{user_id}@example.com", full_name="R",
+        ))
+    for book_id in (10, 11, 12, 13):
+        await database.execute(Book.__table__.insert().values(id=book_id, title=f"Book {book_id}", author="A", genre="G"))
+    ratings = [(1, 10, 5), (1, 11, 5), (2, 10, 5), (2, 12, 1), (3, 11, 4), (3, 13, 3)]
+    await database.execute(Review.__table__.insert().values([
+        {"user_id": user_id, "book_id": book_id, "rating": rating} for user_id, book_id, rating in ratings
+    ]))
+    engine = RecommendationEngine(database)
+
+    # Books 12 and 13 each share one reader with a book user 1 loved: cosine 1/sqrt(2) and 4/sqrt(41)
+    assert await engine.recommend(1) == [
+        (12, pytest.approx(2.5 / 2 ** 0.5)), (13, pytest.approx(2.5 * 4 / 41 ** 0.5)),
+    ]
+    # Nothing similar to book 13 was rated by user 2, so it only comes in as a popular fill-in
+    assert await engine.recommend(2) == [(11, pytest.approx(2.5 * 5 / (2 * 41) ** 0.5)), (13, 0.0)]
+    # Readers without reviews get the most reviewed books
+    assert await engine.recommend(99, limit=2) == [(10, 0.0), (11, 0.0)]
+
+
+async def test_stale_entry_is_kept_when_its_background_refresh_is_skipped():
+    cache = RecommendationCache()
+    old = {"recommendations": ["old"]}
+    assert await cache.get_or_build(1, (10, True), builder({("Herbert", "SF")}, old)) == old
+    cache.note_review(1, "Austen", "Romance")
+
+    async def declined():
+        return None
+
+    assert await cache.get_or_build(1, (10, True), builder(set(), None), background_build=declined) == old
+    await settle(cache)
+    # Still stale, so the next request tries again
+    new = {"recommendations": ["new"]}
+    pairs = {("Herbert", "SF"), ("Austen", "Romance")}
+    assert await cache.get_or_build(1, (10, True), builder(set(), None), background_build=builder(pairs, new)) == old
+    await settle(cache)
+    assert await cache.get_or_build(1, (10, True), builder(set(), None)) == new
+
+
+async def test_review_during_a_build_keeps_its_result_out_of_the_cache():
+    cache = RecommendationCache()
+    started, release = asyncio.Event(), asyncio.Event()
+    calls = []
+
+    async def slow_build():
+        calls.append("slow")
+        started.set()
+        await release.wait()
+        return {("Herbert", "SF")}, {"recommendations": ["before the review"]}
+
+    pending = asyncio.ensure_future(cache.get_or_build(1, (10, False), slow_build))
+    await started.wait()
+    cache.note_review(1, "Austen", "Romance")
+    release.set()
+    # The caller still gets its answer
+    assert await pending == {"recommendations": ["before the review"]}
+
+    after = {"recommendations": ["after the review"]}
+    pairs = {("Herbert", "SF"), ("Austen", "Romance")}
+    assert await cache.get_or_build(1, (10, False), builder(pairs, after, calls)) == after
+    assert calls == ["slow", after]
+    assert cache._building == {} and cache._generations == {}
@@ -0,0 +1,57 @@
+import pytest
+from sqlalchemy import event
+
+import similar_books  # registers the book change listeners
+from models import Book
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_set_based_writes_report_ids_without_extra_queries(database):
+    for book_id, title in ((1, "Dune"), (2, "Emma")):
+        await database.execute(Book.__table__.insert().values(id=book_id, title=title, author="A", genre="G"))
+    statements = []
+    event.listen(database.engine.sync_engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: statements.append(statement.split()[0]))
+
+    async with database.unit_of_work() as unit_of_work:
+        await database.update_one_or_more(Book, {"id": 1}, {"title": "Dune Messiah"})
+        await database.delete_where(Book, {"id": 2})
+        info = unit_of_work.session.sync_session.info
+        assert (info["changed_book_ids"], info["deleted_book_ids"]) == ({1}, {2})
+    assert statements == ["UPDATE", "DELETE"]
+
+
+async def test_index_follows_inserts_updates_and_deletes(database):
+    for book_id, title, author, genre, summary in [
+        (1, "Dune", "Frank Herbert", "SF", "Spice, sandworms and politics on a desert planet."),
+        (2, "Children of Dune", "Frank Herbert", "SF", "The desert planet after the jihad."),
+        (3, "Emma", "Jane Austen", "Romance", "A matchmaker meddles in village courtships."),
+    ]:
+        await database.execute(Book.__table__.insert().values(id=book_id, title=title, author=author, genre=genre, summary=summary))
+    index = similar_books.SimilarBooksIndex(database, refresh_interval=3600)
+    index.start()
+
+    async def ids_like(book_id):
+        if index._apply_task is not None:
+            await index._apply_task
+        return [neighbour for neighbour, _ in await index.similar(book_id)]
+
+    try:
+        await index.refresh()
+        assert (await ids_like(1))[0] == 2
+
+        book = Book("Dune Messiah", "Frank Herbert", "SF", summary="An emperor of the desert planet.")
+        await database.add_or_save(book)
+        assert set((await ids_like(1))[:2]) == {2, book.id}
+
+        book.title, book.author, book.genre, book.summary = "Persuasion", "Jane Austen", "Romance", "A second chance at courtship."
+        await database.add_or_save(book)
+        assert (await ids_like(3))[0] == book.id
+        assert book.id not in await ids_like(1)
+
+        await database.delete_where(Book, {"id": 2})
+        assert 2 not in await ids_like(1)
+        assert await index.similar(2) is None
+    finally:
+        await index.stop()